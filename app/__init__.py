@@ -1,33 +1,129 @@
 # Main application factory for the api
+#
+# Everything a worker needs is imported here rather than on first use, so a
+# server preloading the app (gunicorn --preload) pays for the imports once in
+# the master and the forked workers share them.
 
+import time
+_import_started = time.perf_counter()
+
+import logging
+import os
+import weakref
 from flask import Flask
+from app import migrations
 from app.extensions import db
+from app.models import User, Team, TeamMember, TodoItem, TodoCounter, Settings, ResourceVersion, SyncState, SyncTombstone, PurgeJob, register_sqlite_pragmas
+from app.blueprints.blueprint_users import users_bp
+from app.blueprints.blueprint_authentication import auth_bp
+from app.blueprints.blueprint_teams import teams_bp
+from app.blueprints.blueprint_todos import todos_bp
+from app.blueprints.blueprint_settings import settings_bp
+from app.blueprints.blueprint_blobs import blobs_bp
+from app.blueprints.blueprint_system import system_bp
+from app.commands import register_commands
+from app.errors.handlers import register_error_handlers
+from app.util.auth import configure_hashing
+from app.util.cache import configure_caches
+from app.util.compression import init_compression
+from app.util.metrics import init_metrics, record_startup
+from app.util.purge import init_purger
+from app.util.write_queue import init_write_queue
+
+logger = logging.getLogger('app')
+
+record_startup('import', time.perf_counter() - _import_started)
+
+# Apps whose engines a forked worker must not reuse
+_apps = weakref.WeakSet()
 
 def create_app():
     """Create and configure the Flask application."""
+    boot_started = time.perf_counter()
     app = Flask(__name__)
-    
+
     # Create a configuration object
     app.config.from_object('app.config.Config')
 
     # Initialize extensions, blueprints, etc.
     with app.app_context():
-        
-        # Initialize the database and import models
-        from app.models import User, Team, TodoItem, Settings
+
+        # Initialize the database
         db.init_app(app)
-        db.create_all()
+        register_sqlite_pragmas(db.engines[None], app.config['SQLITE_PRAGMAS'])
+        if 'readonly' in db.engines:
+            register_sqlite_pragmas(db.engines['readonly'], app.config['SQLITE_READ_ONLY_PRAGMAS'])
+        # Check the stamped schema version, creating or migrating only when it is not current
+        status = migrations.schema_status(db.engine)
+        if status == 'empty':
+            db.create_all(bind_key=None)
+            migrations.stamp(db.engine)
+        elif status == 'behind' and app.config['MIGRATE_ON_STARTUP']:
+            db.create_all(bind_key=None)
+            migrations.upgrade(db.engine)
+        elif status == 'behind':
+            logger.warning('Database schema is behind the code, run flask db-upgrade')
+        elif status == 'ahead':
+            logger.warning('Database schema is newer than the code, deploy the matching release')
 
         # Register blueprints
-        from app.blueprints.blueprint_users import users_bp
         app.register_blueprint(users_bp)
-        from app.blueprints.blueprint_authentication import auth_bp
         app.register_blueprint(auth_bp)
-        from app.blueprints.blueprint_teams import teams_bp
         app.register_blueprint(teams_bp)
-        from app.blueprints.blueprint_todos import todos_bp
         app.register_blueprint(todos_bp)
-        from app.blueprints.blueprint_settings import settings_bp
         app.register_blueprint(settings_bp)
+        app.register_blueprint(blobs_bp)
+        app.register_blueprint(system_bp)
+
+        # Record request latency and SQL statements
+        init_metrics(app, db.engines.values())
+
+        # Size the per-worker caches
+        configure_caches(app.config)
+
+        # Configure password hashing
+        configure_hashing(app.config)
+
+        # Batch the commits of concurrent writes when enabled
+        init_write_queue(app)
+
+        # Compress responses the client accepts encoded
+        init_compression(app)
+
+        # Remove deleted accounts and teams in the background
+        init_purger(app)
+
+        # Close the boot connections so a preloading master forks without open SQLite handles
+        for engine in db.engines.values():
+            engine.dispose()
+
+    # Register error handlers
+    register_error_handlers(app)
+
+    # Register command line commands
+    register_commands(app)
+
+    _apps.add(app)
+    record_startup('boot', time.perf_counter() - boot_started)
+    return app
+
+# Drop the pooled connections of an app without closing them
+def dispose_engines(app, close: bool = True) -> None:
+    """Empty the connection pools of the app's engines.
+
+    With close=False the connections are only forgotten, which is what a forked
+    child must do with the connections of its parent.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+    async_db = app.extensions.get('async_db')
+    if async_db is not None:
+        async_db['engine'].sync_engine.dispose(close=close)
+
+# Every forked worker opens its own SQLite connections
+def _after_fork_in_child() -> None:
+    for app in list(_apps):
+        dispose_engines(app, close=False)
 
-    return app
\ No newline at end of file
+os.register_at_fork(after_in_child=_after_fork_in_child)
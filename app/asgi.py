@@ -0,0 +1,205 @@
+# ASGI application for the api
+#
+# Requests for endpoints that have a coroutine view (see app.util.async_db.async_view)
+# run on the event loop with an AsyncSession, so an idle poll costs a coroutine
+# rather than a thread. Every other endpoint runs the regular Flask WSGI app on a
+# bounded thread pool. Both share the Flask app: routing, sessions, decorators,
+# before/after request hooks and error handlers.
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from flask import g
+from werkzeug.exceptions import HTTPException
+from app import create_app
+from app.util.auth import shutdown_hashing
+from app.util.async_db import ASYNC_VIEWS, UseSyncView, init_async_db, close_async_session, dispose_async_db
+
+class AsgiApp:
+    """ASGI wrapper serving coroutine views on the event loop and sync views on a thread pool."""
+
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=app.config['ASGI_THREADS'], thread_name_prefix='wsgi')
+        init_async_db(app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+        environ = _build_environ(scope)
+        view = self._match_async_view(environ)
+        if view is not None:
+            # Coroutine views serve GETs, whose bodies are empty or small, so theirs is read up front
+            environ['wsgi.input'] = io.BytesIO(await _read_body(receive))
+            if await self._run_async_view(view, environ, send):
+                return
+            environ['wsgi.input'].seek(0)
+        else:
+            # Sync views read the body from the pool thread as they consume it, uploads are never buffered whole
+            environ['wsgi.input'] = io.BufferedReader(ReceiveStream(receive, asyncio.get_running_loop()))
+        await self._run_wsgi(environ, send)
+
+    # Find the coroutine view of the requested endpoint, if there is one
+    def _match_async_view(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        return ASYNC_VIEWS.get(endpoint)
+
+    # Dispatch to a coroutine view the way Flask dispatches to a sync one
+    async def _run_async_view(self, view, environ, send) -> bool:
+        ctx = self.app.request_context(environ)
+        ctx.push()
+        error = None
+        try:
+            try:
+                try:
+                    rv = self.app.preprocess_request()
+                    if rv is None:
+                        rv = await view(**ctx.request.view_args)
+                except UseSyncView:
+                    # The sync view serves and records this request
+                    g.pop('_metrics', None)
+                    return False
+                except Exception as e:
+                    rv = self.app.handle_user_exception(e)
+                response = self.app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                response = self.app.handle_exception(e)
+            finally:
+                await close_async_session()
+            # Coroutine views return in-memory bodies, so they are sent without a thread hop
+            started = {}
+            def start_response(status, headers, exc_info=None):
+                started['status'] = int(status.split(' ', 1)[0])
+                started['headers'] = headers
+            chunks = list(response(environ, start_response))
+            await send(_start_message(started))
+            await send({'type': 'http.response.body', 'body': b''.join(chunks), 'more_body': False})
+            return True
+        finally:
+            ctx.pop(error)
+
+    # Run the WSGI app and its response iteration on one pool thread
+    async def _run_wsgi(self, environ, send) -> None:
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            started = {}
+            def start_response(status, headers, exc_info=None):
+                started['status'] = int(status.split(' ', 1)[0])
+                started['headers'] = headers
+            iterable = self.app.wsgi_app(environ, start_response)
+            try:
+                sent_start = False
+                for chunk in iterable:
+                    if not sent_start:
+                        send_from_thread(_start_message(started))
+                        sent_start = True
+                    if chunk:
+                        send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if not sent_start:
+                    send_from_thread(_start_message(started))
+                send_from_thread({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+
+        await loop.run_in_executor(self.executor, run)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await dispose_async_db(self.app)
+                self.executor.shutdown(wait=False)
+                shutdown_hashing()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+class ReceiveStream(io.RawIOBase):
+    """Request body read from the ASGI receive channel by a thread of the pool, one message at a time."""
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._chunk = b''
+        self._more_body = True
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            # A client that went away ends the body early
+            self._chunk = message.get('body', b'')
+            self._more_body = message['type'] == 'http.request' and message.get('more_body', False)
+        count = min(len(buffer), len(self._chunk))
+        buffer[:count] = self._chunk[:count]
+        self._chunk = self._chunk[count:]
+        return count
+
+# Read a whole request body on the event loop
+async def _read_body(receive) -> bytes:
+    body = io.BytesIO()
+    while True:
+        message = await receive()
+        body.write(message.get('body', b''))
+        if message['type'] != 'http.request' or not message.get('more_body'):
+            return body.getvalue()
+
+# Build the WSGI environ of an ASGI http scope, wsgi.input is set by the caller
+def _build_environ(scope: dict) -> dict:
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        # The server has already removed any chunked framing, the body ends where the stream does
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+# Build the ASGI response start message from WSGI status and headers
+def _start_message(started: dict) -> dict:
+    return {
+        'type': 'http.response.start',
+        'status': started['status'],
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in started['headers']]
+    }
+
+def create_asgi_app():
+    """Create the Flask application and wrap it for ASGI servers."""
+    return AsgiApp(create_app())
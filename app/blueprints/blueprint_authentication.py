@@ -1,9 +1,12 @@
 # Authentication Blueprint
 
 from flask import Blueprint, request, jsonify, session
+from sqlalchemy import update
 from app.models import User
 from app.extensions import db
-from werkzeug.security import check_password_hash
+from app.util.auth import verify_password, hash_password, needs_rehash
+from app.util.lookups import get_user_row_by_email, invalidate_user
+from app.util.write_queue import run_write, commit_write, after_commit
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -12,11 +15,25 @@ def login():
     data = request.json
     if not data or not data.get('email') or not data.get('password'):
         return jsonify({'error': 'Email and password required'}), 400
-    user = User.query.filter_by(email=data['email']).first()
-    if not user or not check_password_hash(user.password, data['password']):
+    user = get_user_row_by_email(data['email'])
+    if not user or not verify_password(data['password'], user['password']):
         return jsonify({'error': 'Username / Password is incorrect'}), 401
-    session['user_public_id'] = user.public_id
-    response = jsonify({'message': 'Login successful', 'public_id': user.public_id})
+    # Transparently upgrade hashes made with outdated parameters
+    if needs_rehash(user['password']):
+        password = hash_password(data['password'])
+
+        def rehash():
+            db.session.execute(
+                update(User)
+                .where(User.public_id == user['public_id'], User.password == user['password'])
+                .values(password=password)
+            )
+            commit_write()
+            after_commit(lambda: invalidate_user(user['public_id'], user['email']))
+
+        run_write(rehash)
+    session['user_public_id'] = user['public_id']
+    response = jsonify({'message': 'Login successful', 'public_id': user['public_id']})
     return response
 
 @auth_bp.route('/logout', methods=['POST'])
@@ -0,0 +1,31 @@
+# Blueprint for stored images
+
+import os
+from flask import Blueprint, jsonify, send_file, current_app
+from app.util.blobstore import blob_path, blob_mimetype, is_valid_digest
+from app.util.decorators import login_required
+
+blobs_bp = Blueprint('blobs', __name__, url_prefix='/blobs')
+
+# Stream a stored image by its content digest
+@blobs_bp.route('/<digest>', methods=['GET'])
+@login_required
+def get_blob(digest):
+    if not is_valid_digest(digest):
+        return jsonify({'error': 'Image not found'}), 404
+    path = blob_path(digest)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Image not found'}), 404
+    # The digest is the content, so the ETag never changes and the response can be cached forever
+    response = send_file(
+        path,
+        mimetype=blob_mimetype(path),
+        etag=digest,
+        conditional=True,
+        max_age=current_app.config['BLOB_CACHE_MAX_AGE']
+    )
+    # Images sit behind the login, keep them out of shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
@@ -1,35 +1,45 @@
 import datetime
 from flask import Blueprint, request, jsonify, session
 from uuid import uuid4
-from app.extensions import db
 from app.models import Settings
-from app.util.decorators import login_required
+from app.util.decorators import login_required, etag_conditional
+from app.util.versions import bump_versions, resource_versions_query, request_version
+from app.util.lookups import invalidate_settings, current_user_id, current_user_id_cached
+from app.util.async_db import async_view
+from app.util.readers import SYNC_READER, ASYNC_READER, run_sync
+from app.util.write_queue import group_commit, commit_write, after_commit
 
 settings_bp = Blueprint('settings', __name__, url_prefix='/settings')
 
 # Get current user's settings
 @settings_bp.route('/', methods=['GET'])
 @login_required
+@etag_conditional(lambda: resource_versions_query('user', current_user_id()))
 def get_settings():
-    settings = Settings.query.filter_by(user_public_id=session['user_public_id']).first()
-    if not settings or settings.user_public_id != session['user_public_id']:
+    return run_sync(_read_settings(SYNC_READER))
+
+# Coroutine version of get_settings served by the ASGI entry point
+@async_view(settings_bp, 'get_settings')
+@login_required
+@etag_conditional(lambda: resource_versions_query('user', current_user_id_cached()))
+async def get_settings_async():
+    return await _read_settings(ASYNC_READER)
+
+# Body of get_settings and get_settings_async
+async def _read_settings(reader):
+    settings = await reader.settings_row(session['user_public_id'], request_version('user', reader.user_id()))
+    if not settings or settings['user_public_id'] != session['user_public_id']:
         return jsonify({'error': 'Settings not found or access denied'}), 404
-    return jsonify({
-        'public_id': settings.public_id,
-        'user_public_id': settings.user_public_id,
-        'theme': settings.theme,
-        'separate_teams_todos': settings.separate_teams_todos,
-        'hide_completed_todos': settings.hide_completed_todos,
-        'language': settings.language,
-        'timezone': settings.timezone
-    })
+    return jsonify(settings)
 
 # Update current user's settings
 @settings_bp.route('/edit', methods=['PUT'])
 @login_required
+@group_commit
 def edit_settings():
-    settings = Settings.query.filter_by(user_public_id=session['user_public_id']).first()
-    if not settings or settings.user_public_id != session['user_public_id']:
+    user_public_id = session['user_public_id']
+    settings = Settings.query.filter_by(user_id=current_user_id()).first()
+    if not settings:
         return jsonify({'error': 'Settings not found or access denied'}), 404
     data = request.json
     if not data:
@@ -37,20 +47,26 @@ def edit_settings():
     for field in ['theme', 'separate_teams_todos', 'hide_completed_todos', 'language', 'timezone']:
         if field in data:
             setattr(settings, field, data[field])
-    db.session.commit()
+    bump_versions(users=[settings.user_id])
+    commit_write()
+    after_commit(lambda: invalidate_settings(user_public_id))
     return jsonify({'message': 'Settings updated', 'public_id': settings.public_id})
 
 # Reset current user's settings to default
 @settings_bp.route('/reset', methods=['POST'])
 @login_required
+@group_commit
 def reset_settings():
-    settings = Settings.query.filter_by(user_public_id=session['user_public_id']).first()
-    if not settings or settings.user_public_id != session['user_public_id']:
+    user_public_id = session['user_public_id']
+    settings = Settings.query.filter_by(user_id=current_user_id()).first()
+    if not settings:
         return jsonify({'error': 'Settings not found or access denied'}), 404
     settings.theme = 'light'
     settings.separate_teams_todos = False
     settings.hide_completed_todos = False
     settings.language = 'en'
     settings.timezone = 'UTC'
-    db.session.commit()
+    bump_versions(users=[settings.user_id])
+    commit_write()
+    after_commit(lambda: invalidate_settings(user_public_id))
     return jsonify({'message': 'Settings reset to default', 'public_id': settings.public_id})
\ No newline at end of file
@@ -0,0 +1,29 @@
+# Blueprint for operational endpoints, served only to callers holding SYSTEM_TOKEN
+
+from flask import Blueprint, Response, jsonify
+from app.util.cache import cache_stats
+from app.util.decorators import system_token_required
+from app.extensions import db
+from app.util.metrics import render_metrics
+from app.util.purge import purge_status
+
+system_bp = Blueprint('system', __name__)
+
+# Hit and miss counters of this worker's caches
+@system_bp.route('/cache/stats', methods=['GET'])
+@system_token_required
+def get_cache_stats():
+    return jsonify(cache_stats())
+
+# Request, SQL and cache metrics of this worker in the Prometheus text format
+@system_bp.route('/metrics', methods=['GET'])
+@system_token_required
+def get_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Backlog of the background purger
+@system_bp.route('/purge/stats', methods=['GET'])
+@system_token_required
+def get_purge_stats():
+    with db.engine.connect() as connection:
+        return jsonify(purge_status(connection))
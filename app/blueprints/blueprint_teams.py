@@ -1,121 +1,164 @@
 import datetime
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, current_app
 from uuid import uuid4
 from app.extensions import db
-from app.models import Team
-from app.util.decorators import login_required
+from app.models import Team, User
+from app.util.decorators import login_required, etag_conditional
+from app.util.query_budget import query_budget, LIST_QUERY_BUDGET
+from app.util.async_db import async_view
+from app.util.readers import SYNC_READER, ASYNC_READER, run_sync
+from app.util.lookups import current_user_id, current_user_id_cached, team_id_for
+from app.util.serializers import TEAM_SERIALIZER, InvalidFields, json_response
+from app.util.blobstore import store_base64_image
+from app.util.versions import bump_versions, user_versions_query, resource_versions_query
+from app.util.write_queue import group_commit, commit_write, after_commit
+from app.util.purge import mark_team_deleted, wake_purger
+from app.util.memberships import user_team_ids_query, is_team_member, team_members, resolve_members, add_team_member, set_team_members
 
 teams_bp = Blueprint('teams', __name__, url_prefix='/teams')
 
 # Create a new team
 @teams_bp.route('/create', methods=['POST'])
 @login_required
+@group_commit
 def create_team():
     data = request.json
     if not data or not data.get('name'):
         return jsonify({'error': 'Team name is required'}), 400
+    members = data.get('members', [session['user_public_id']])
+    if not isinstance(members, list):
+        return jsonify({'error': 'Members must be a list of user public IDs'}), 400
+    members, missing = resolve_members(members)
+    if missing:
+        return jsonify({'error': 'Unknown members', 'members': missing}), 400
+    try:
+        team_image_hash = store_base64_image(data.get('team_image'))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid team_image: {e}'}), 400
     now = datetime.datetime.utcnow()
     team = Team(
         public_id=str(uuid4()),
-        owner_public_id=session['user_public_id'],
+        owner_id=current_user_id(),
         name=data['name'],
         description=data.get('description'),
-        members=data.get('members', [session['user_public_id']]),
-        team_image=data.get('team_image'),
+        team_image_hash=team_image_hash,
         is_active=True,
         deleted=False,
         last_activity=now,
         created_on=now
     )
     db.session.add(team)
-    db.session.commit()
+    db.session.flush()
+    set_team_members(team, members)
+    bump_versions(users=members.values(), teams=[team.id])
+    commit_write()
     return jsonify({'message': 'Team created', 'public_id': team.public_id}), 201
 
 # Get all teams for the logged-in user (where user is a member)
 @teams_bp.route('/', methods=['GET'])
 @login_required
+@query_budget(LIST_QUERY_BUDGET)
+@etag_conditional(lambda: user_versions_query(current_user_id()))
 def get_teams():
-    teams = Team.query.filter(Team.members.contains([session['user_public_id']])).all()
-    return jsonify([
-        {
-            'public_id': t.public_id,
-            'name': t.name,
-            'description': t.description,
-            'members': t.members,
-            'team_image': t.team_image,
-            'is_active': t.is_active,
-            'deleted': t.deleted,
-            'last_activity': t.last_activity,
-            'created_on': t.created_on
-        } for t in teams
-    ])
+    return run_sync(_list_teams(SYNC_READER))
+
+# Coroutine version of get_teams served by the ASGI entry point
+@async_view(teams_bp, 'get_teams')
+@login_required
+@query_budget(LIST_QUERY_BUDGET)
+@etag_conditional(lambda: user_versions_query(current_user_id_cached()))
+async def get_teams_async():
+    return await _list_teams(ASYNC_READER)
+
+# Body of get_teams and get_teams_async
+async def _list_teams(reader):
+    return await reader.list_response(TEAM_SERIALIZER, Team.id.in_(user_team_ids_query(reader.user_id())))
 
 # Get a specific team by public_id
 @teams_bp.route('/<public_id>', methods=['GET'])
 @login_required
+@etag_conditional(lambda public_id: resource_versions_query('team', team_id_for(public_id)))
 def get_team(public_id):
-    team = Team.query.filter_by(public_id=public_id).first()
-    if not team or session['user_public_id'] not in (team.members or []):
+    try:
+        names = TEAM_SERIALIZER.request_fields()
+    except InvalidFields as e:
+        return jsonify({'error': str(e)}), 400
+    team = None
+    team_id = team_id_for(public_id)
+    if is_team_member(team_id, current_user_id()):
+        team = TEAM_SERIALIZER.first(Team.id == team_id, names=names)
+    if not team:
         return jsonify({'error': 'Team not found or access denied'}), 404
-    return jsonify({
-        'public_id': team.public_id,
-        'name': team.name,
-        'description': team.description,
-        'members': team.members,
-        'team_image': team.team_image,
-        'is_active': team.is_active,
-        'deleted': team.deleted,
-        'last_activity': team.last_activity,
-        'created_on': team.created_on
-    })
+    return json_response(team)
 
 # Update a team
 @teams_bp.route('/edit/<public_id>', methods=['PUT'])
 @login_required
+@group_commit
 def edit_team(public_id):
-    team = Team.query.filter_by(public_id=public_id).first()
-    if not team or session['user_public_id'] != team.owner_public_id:
+    team = Team.query.filter_by(public_id=public_id, deleted_on=None).first()
+    if not team or team.owner_id != current_user_id():
         return jsonify({'error': 'Team not found or you are not the owner'}), 403
     data = request.json
     if not data:
         return jsonify({'error': 'No data provided'}), 400
-    for field in ['name', 'description', 'members', 'team_image', 'is_active', 'deleted']:
+    previous_members = list(team_members(team.id).values())
+    members = None
+    if 'members' in data:
+        if not isinstance(data['members'], list):
+            return jsonify({'error': 'Members must be a list of user public IDs'}), 400
+        members, missing = resolve_members(data['members'])
+        if missing:
+            return jsonify({'error': 'Unknown members', 'members': missing}), 400
+    # The image is stored once the request is known to be valid, a rejected one leaves no blob behind
+    if 'team_image' in data:
+        try:
+            team.team_image_hash = store_base64_image(data['team_image'])
+        except ValueError as e:
+            return jsonify({'error': f'Invalid team_image: {e}'}), 400
+    if members is not None:
+        set_team_members(team, members)
+    for field in ['name', 'description', 'is_active']:
         if field in data:
             setattr(team, field, data[field])
     team.last_activity = datetime.datetime.utcnow()
-    db.session.commit()
+    bump_versions(users=previous_members + list((members or {}).values()), teams=[team.id])
+    commit_write()
     return jsonify({'message': 'Team updated', 'public_id': team.public_id})
 
 # Delete a team
 @teams_bp.route('/delete/<public_id>', methods=['DELETE'])
 @login_required
+@group_commit
 def delete_team(public_id):
-    team = Team.query.filter_by(public_id=public_id).first()
-    if not team or session['user_public_id'] != team.owner_public_id:
+    team = Team.query.filter_by(public_id=public_id, deleted_on=None).first()
+    if not team or team.owner_id != current_user_id():
         return jsonify({'error': 'Team not found or you are not the owner'}), 403
-    db.session.delete(team)
-    db.session.commit()
+    # Mark the team deleted now, the purger removes its todos in the background
+    members = mark_team_deleted(team)
+    bump_versions(users=members, teams=[team.id])
+    commit_write()
+    after_commit(lambda: wake_purger(current_app))
     return jsonify({'message': 'Team deleted', 'public_id': public_id})
 
 # Invite a member to a team by profile name
 @teams_bp.route('/invite/<team_name>', methods=['POST'])
 @login_required
+@group_commit
 def invite_member(team_name):
-    from app.models import User
-    team = Team.query.filter_by(name=team_name).first()
-    if not team or session['user_public_id'] != team.owner_public_id:
+    team = Team.query.filter_by(name=team_name, deleted_on=None).first()
+    if not team or team.owner_id != current_user_id():
         return jsonify({'error': 'Team not found or you are not the owner'}), 403
     data = request.json
     if not data or 'profile_name' not in data:
         return jsonify({'error': 'Profile name is required'}), 400
-    user = User.query.filter_by(profile_name=data['profile_name']).first()
+    user = User.query.filter_by(profile_name=data['profile_name'], deleted_on=None).first()
     if not user:
         return jsonify({'error': 'User not found'}), 404
-    if user.public_id in (team.members or []):
+    if is_team_member(team.id, user.id):
         return jsonify({'error': 'User is already a member'}), 400
-    members = team.members or []
-    members.append(user.public_id)
-    team.members = members
+    add_team_member(team, user)
     team.last_activity = datetime.datetime.utcnow()
-    db.session.commit()
+    bump_versions(users=[user.id], teams=[team.id])
+    commit_write()
     return jsonify({'message': f"User '{user.profile_name}' invited to team.", 'team_name': team.name, 'user_public_id': user.public_id})
\ No newline at end of file
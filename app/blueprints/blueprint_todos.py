@@ -1,15 +1,40 @@
 import datetime
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, current_app
 from uuid import uuid4
+from sqlalchemy import select, insert, update, delete
 from app.extensions import db
 from app.models import TodoItem
-from app.util.decorators import login_required
+from app.util.counters import todo_stats
+from app.util.decorators import login_required, etag_conditional
+from app.util.query_budget import query_budget, LIST_QUERY_BUDGET
+from app.util.filters import InvalidFilter, todo_filters, time_dependent
+from app.util.lookups import current_user_id, current_user_id_cached, team_id_for
+from app.util.memberships import user_team_ids, user_team_ids_query
+from app.util.pagination import list_response, ranked_list_response
+from app.util.async_db import async_view
+from app.util.readers import SYNC_READER, ASYNC_READER, run_sync
+from app.util.search import InvalidSearch, match_expression, match_todos
+from app.util.serializers import TODO_SERIALIZER, InvalidFields, json_response
+from app.util.sync import InvalidSyncCursor, SyncCursorExpired, parse_since, todo_changes
+from app.util.versions import bump_versions, user_versions_query, resource_versions_query, request_version
+from app.util.write_queue import group_commit, commit_write
 
 todos_bp = Blueprint('todos', __name__, url_prefix='/todos')
 
+# Translate the team a todo is assigned to, it must be one of the user's teams
+def _assigned_team(assigned_to, teams) -> tuple:
+    """Return (team_id, error) for an assigned_to value, a falsy value unassigns the todo."""
+    if not assigned_to:
+        return None, None
+    team_id = team_id_for(assigned_to)
+    if team_id is None or team_id not in teams:
+        return None, 'Not a member of the assigned team'
+    return team_id, None
+
 # Create a new todo item
 @todos_bp.route('/create', methods=['POST'])
 @login_required
+@group_commit
 def create_todo():
     data = request.json
     if not data or not data.get('title'):
@@ -22,121 +47,288 @@ def create_todo():
             due_date = datetime.datetime.fromisoformat(due_date)
         except ValueError:
             return jsonify({'error': 'Invalid due_date format. Use ISO 8601 format.'}), 400
+    user_id = current_user_id()
+    team_id, error = _assigned_team(data.get('assigned_to'), user_team_ids(user_id) if data.get('assigned_to') else ())
+    if error:
+        return jsonify({'error': error}), 400
     todo = TodoItem(
         public_id=str(uuid4()),
-        user_public_id=session['user_public_id'],
+        user_id=user_id,
         title=data['title'],
         summary=data.get('summary'),
         due_date=due_date,
         completed=data.get('completed', False),
         priority=data.get('priority', 'normal'),
-        assigned_to=data.get('assigned_to'),
+        team_id=team_id,
         shared_with=data.get('shared_with'),
         created_by=session['user_public_id'],
         created_on=now,
         visibility=data.get('visibility', 'public')
     )
     db.session.add(todo)
-    db.session.commit()
+    bump_versions(users=[todo.user_id], teams=[todo.team_id])
+    commit_write()
     return jsonify({'message': 'Todo created', 'public_id': todo.public_id}), 201
 
+# Todos a user can see: their own and those assigned to any of their teams
+def visible_todos(user_id: int):
+    return (TodoItem.user_id == user_id) | (TodoItem.team_id.in_(user_team_ids_query(user_id)))
+
 # Get all todo items for the logged-in user, including todos assigned to any teams they are a part of
+# ?overdue= compares with the clock, so those listings carry no ETag
+# The settings providing the filter defaults and the team of ?assigned_to= add a statement each to the budget on a cache miss
 @todos_bp.route('/', methods=['GET'])
 @login_required
+@query_budget(LIST_QUERY_BUDGET + 2)
+@etag_conditional(lambda: user_versions_query(current_user_id()), unless=lambda: time_dependent(request.args))
 def get_todos():
-    from app.models import Team
-    user_public_id = session['user_public_id']
-    # Get all teams the user is a member of
-    teams = Team.query.filter(Team.members.contains([user_public_id])).all()
-    team_ids = [team.public_id for team in teams]
-    # Query for todos owned by the user or assigned to any of their teams
-    todos = TodoItem.query.filter(
-        (TodoItem.user_public_id == user_public_id) |
-        (TodoItem.assigned_to.in_(team_ids))
-    ).all()
-    # Return todos as JSON
-    return jsonify([
-        {
-            'public_id': t.public_id,
-            'title': t.title,
-            'summary': t.summary,
-            'due_date': t.due_date,
-            'completed': t.completed,
-            'priority': t.priority,
-            'assigned_to': t.assigned_to,
-            'shared_with': t.shared_with,
-            'created_by': t.created_by,
-            'created_on': t.created_on,
-            'visibility': t.visibility
-        } for t in todos
-    ])
+    return run_sync(_list_todos(SYNC_READER))
+
+# Coroutine version of get_todos served by the ASGI entry point
+@async_view(todos_bp, 'get_todos')
+@login_required
+@query_budget(LIST_QUERY_BUDGET + 2)
+@etag_conditional(lambda: user_versions_query(current_user_id_cached()), unless=lambda: time_dependent(request.args))
+async def get_todos_async():
+    return await _list_todos(ASYNC_READER)
+
+# Body of get_todos and get_todos_async
+async def _list_todos(reader):
+    # Return todos owned by the user or assigned to any of their teams, filtered and sorted in SQL
+    assigned_to = request.args.get('assigned_to')
+    if assigned_to not in (None, '', 'none', 'any'):
+        reader.require_team_key(assigned_to)
+    try:
+        user_id = reader.user_id()
+        settings = await reader.settings_row(session['user_public_id'], request_version('user', user_id))
+        criteria, order = todo_filters(request.args, user_id, settings)
+    except InvalidFilter as e:
+        return jsonify({'error': str(e)}), 400
+    return await reader.list_response(TODO_SERIALIZER, *criteria, order=order)
+
+# Search the titles and summaries of the todos the user can see, best matches first
+@todos_bp.route('/search', methods=['GET'])
+@login_required
+@query_budget(LIST_QUERY_BUDGET)
+@etag_conditional(lambda: user_versions_query(current_user_id()))
+def search_todos():
+    try:
+        expression = match_expression(request.args.get('q', ''))
+    except InvalidSearch as e:
+        return jsonify({'error': str(e)}), 400
+    return ranked_list_response(
+        TODO_SERIALIZER,
+        lambda statement: match_todos(statement.where(visible_todos(current_user_id())), expression)
+    )
+
+# Counts of the user's todos and of their teams' todos, read from the maintained counters
+# The id of the session user adds a statement to the budget on a cache miss
+@todos_bp.route('/stats', methods=['GET'])
+@login_required
+@query_budget(2)
+def get_todo_stats():
+    return json_response(todo_stats(current_user_id()))
+
+# Todos changed or deleted since the client's last sync, for offline clients
+# The id of the session user adds a statement to the budget on a cache miss
+@todos_bp.route('/changes', methods=['GET'])
+@login_required
+@query_budget(4)
+def get_todo_changes():
+    try:
+        since = parse_since(request.args.get('since'))
+        names = TODO_SERIALIZER.request_fields()
+    except (InvalidSyncCursor, InvalidFields) as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        changes = todo_changes(current_user_id(), since, TODO_SERIALIZER, names)
+    except SyncCursorExpired:
+        return jsonify({'error': 'Cursor expired, resync from since=0'}), 410
+    return json_response(changes)
 
 # Get a specific todo item by public_id
 @todos_bp.route('/<public_id>', methods=['GET'])
 @login_required
+@etag_conditional(lambda public_id: resource_versions_query('user', current_user_id()))
 def get_todo(public_id):
-    todo = TodoItem.query.filter_by(public_id=public_id, user_public_id=session['user_public_id']).first()
+    try:
+        names = TODO_SERIALIZER.request_fields()
+    except InvalidFields as e:
+        return jsonify({'error': str(e)}), 400
+    todo = TODO_SERIALIZER.first(
+        TodoItem.public_id == public_id,
+        TodoItem.user_id == current_user_id(),
+        names=names
+    )
     if not todo:
         return jsonify({'error': 'Todo not found'}), 404
-    return jsonify({
-        'public_id': todo.public_id,
-        'title': todo.title,
-        'summary': todo.summary,
-        'due_date': todo.due_date,
-        'completed': todo.completed,
-        'priority': todo.priority,
-        'assigned_to': todo.assigned_to,
-        'shared_with': todo.shared_with,
-        'created_by': todo.created_by,
-        'created_on': todo.created_on,
-        'visibility': todo.visibility
-    })
+    return json_response(todo)
 
 # Update a todo item
 @todos_bp.route('/edit/<public_id>', methods=['PUT'])
 @login_required
+@group_commit
 def edit_todo(public_id):
-    todo = TodoItem.query.filter_by(public_id=public_id, user_public_id=session['user_public_id']).first()
+    todo = TodoItem.query.filter_by(public_id=public_id, user_id=current_user_id()).first()
     if not todo:
         return jsonify({'error': 'Todo not found'}), 404
     data = request.json
     if not data:
         return jsonify({'error': 'No data provided'}), 400
-    for field in ['title', 'summary', 'due_date', 'completed', 'priority', 'assigned_to', 'shared_with', 'visibility']:
+    # Parsed like create_todo does, the due counters bucket the stored date
+    if data.get('due_date') and isinstance(data['due_date'], str):
+        try:
+            data['due_date'] = datetime.datetime.fromisoformat(data['due_date'])
+        except ValueError:
+            return jsonify({'error': 'Invalid due_date format. Use ISO 8601 format.'}), 400
+    previous_team = todo.team_id
+    if 'assigned_to' in data:
+        team_id, error = _assigned_team(data['assigned_to'], user_team_ids(todo.user_id) if data['assigned_to'] else ())
+        if error:
+            return jsonify({'error': error}), 400
+        todo.team_id = team_id
+    for field in ['title', 'summary', 'due_date', 'completed', 'priority', 'shared_with', 'visibility']:
         if field in data:
             setattr(todo, field, data[field])
-    db.session.commit()
+    bump_versions(users=[todo.user_id], teams=[previous_team, todo.team_id])
+    commit_write()
     return jsonify({'message': 'Todo updated', 'public_id': todo.public_id})
 
 # Delete a todo item
 @todos_bp.route('/delete/<public_id>', methods=['DELETE'])
 @login_required
+@group_commit
 def delete_todo(public_id):
-    todo = TodoItem.query.filter_by(public_id=public_id, user_public_id=session['user_public_id']).first()
+    todo = TodoItem.query.filter_by(public_id=public_id, user_id=current_user_id()).first()
     if not todo:
         return jsonify({'error': 'Todo not found'}), 404
     db.session.delete(todo)
-    db.session.commit()
+    bump_versions(users=[todo.user_id], teams=[todo.team_id])
+    commit_write()
     return jsonify({'message': 'Todo deleted', 'public_id': public_id})
 
 # Get all todos assigned to a specific team by team public_id
 @todos_bp.route('/team/<team_public_id>', methods=['GET'])
 @login_required
+@query_budget(LIST_QUERY_BUDGET)
+@etag_conditional(lambda team_public_id: resource_versions_query('team', team_id_for(team_public_id)))
 def get_team_todos(team_public_id):
-    todos = TodoItem.query.filter_by(assigned_to=team_public_id).all()
-    return jsonify([
-        {
-            'public_id': t.public_id,
-            'title': t.title,
-            'summary': t.summary,
-            'due_date': t.due_date,
-            'completed': t.completed,
-            'priority': t.priority,
-            'assigned_to': t.assigned_to,
-            'shared_with': t.shared_with,
-            'created_by': t.created_by,
-            'created_on': t.created_on,
-            'visibility': t.visibility
-        } for t in todos
-    ])
+    team_id = team_id_for(team_public_id)
+    if team_id is None:
+        return jsonify({'error': 'Team not found'}), 404
+    return list_response(TODO_SERIALIZER, TodoItem.team_id == team_id)
+
+# Fields a client may set on a todo item
+TODO_FIELDS = ['title', 'summary', 'due_date', 'completed', 'priority', 'assigned_to', 'shared_with', 'visibility']
+BULK_OPERATIONS = ['create', 'update', 'complete', 'delete']
+
+# Validate the fields of a single bulk operation
+def _bulk_values(item: dict, op: str):
+    """Return (values, error) for the writable fields of a bulk operation."""
+    if op == 'complete':
+        completed = item.get('completed', True)
+        if not isinstance(completed, bool):
+            return None, 'completed must be a boolean'
+        return {'completed': completed}, None
+    values = {field: item[field] for field in TODO_FIELDS if field in item}
+    if op == 'create' and not values.get('title'):
+        return None, 'Title is required'
+    if op == 'update' and not values:
+        return None, 'No data provided'
+    if 'title' in values and not values['title']:
+        return None, 'Title is required'
+    if values.get('due_date') and isinstance(values['due_date'], str):
+        try:
+            values['due_date'] = datetime.datetime.fromisoformat(values['due_date'])
+        except ValueError:
+            return None, 'Invalid due_date format. Use ISO 8601 format.'
+    return values, None
+
+# Apply a batch of create, update, complete and delete operations in one transaction
+@todos_bp.route('/bulk', methods=['POST'])
+@login_required
+@group_commit
+def bulk_todos():
+    data = request.json
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'A non-empty operations list is required'}), 400
+    if len(operations) > current_app.config['BULK_MAX_OPERATIONS']:
+        return jsonify({'error': f"At most {current_app.config['BULK_MAX_OPERATIONS']} operations are allowed"}), 400
+    user_public_id = session['user_public_id']
+    user_id = current_user_id()
+
+    # Resolve every referenced todo owned by the user with a single query
+    referenced = {item.get('public_id') for item in operations
+                  if isinstance(item, dict) and item.get('op') != 'create' and isinstance(item.get('public_id'), str)}
+    owned, previous_teams = {}, {}
+    if referenced:
+        for public_id, todo_id, team_id in db.session.execute(
+            select(TodoItem.public_id, TodoItem.id, TodoItem.team_id).where(
+                TodoItem.public_id.in_(referenced),
+                TodoItem.user_id == user_id
+            )
+        ):
+            owned[public_id] = todo_id
+            previous_teams[public_id] = team_id
+    teams = set(user_team_ids(user_id)) if any(isinstance(item, dict) and item.get('assigned_to') for item in operations) else set()
+
+    # Validate everything before writing anything
+    now = datetime.datetime.utcnow()
+    results, inserts, updates, deletes = [], [], [], []
+    seen = set()
+    for index, item in enumerate(operations):
+        op = item.get('op') if isinstance(item, dict) else None
+        result = {'index': index, 'op': op}
+        results.append(result)
+        if op not in BULK_OPERATIONS:
+            result['error'] = f"op must be one of {', '.join(BULK_OPERATIONS)}"
+            continue
+        if op != 'create':
+            public_id = item.get('public_id')
+            result['public_id'] = public_id
+            if public_id not in owned:
+                result['error'] = 'Todo not found'
+                continue
+            if public_id in seen:
+                result['error'] = 'Duplicate operation for todo'
+                continue
+            seen.add(public_id)
+            if op == 'delete':
+                deletes.append(owned[public_id])
+                continue
+        values, error = _bulk_values(item, op)
+        if not error and 'assigned_to' in values:
+            values['team_id'], error = _assigned_team(values.pop('assigned_to'), teams)
+        if error:
+            result['error'] = error
+            continue
+        if op == 'create':
+            values.setdefault('completed', False)
+            values.setdefault('priority', 'normal')
+            values.setdefault('visibility', 'public')
+            values.update(user_id=user_id, created_by=user_public_id, created_on=now)
+            inserts.append((result, values))
+        else:
+            values['id'] = owned[item['public_id']]
+            updates.append(values)
+    if any('error' in result for result in results):
+        return jsonify({'error': 'Validation failed, no operations were applied', 'results': results}), 400
 
+    # Run the writes as batched statements and commit once
+    for result, values in inserts:
+        values['public_id'] = result['public_id'] = str(uuid4())
+    if inserts:
+        db.session.execute(insert(TodoItem), [values for _, values in inserts])
+    if updates:
+        db.session.execute(update(TodoItem), updates)
+    if deletes:
+        db.session.execute(delete(TodoItem).where(TodoItem.id.in_(deletes)))
+    affected_teams = [previous_teams[public_id] for public_id in seen]
+    affected_teams += [values.get('team_id') for _, values in inserts]
+    affected_teams += [values.get('team_id') for values in updates]
+    bump_versions(users=[user_id], teams=affected_teams)
+    commit_write()
+    for result in results:
+        result['status'] = 201 if result['op'] == 'create' else 200
+    return jsonify({'message': 'Bulk operations applied', 'results': results})
@@ -1,12 +1,23 @@
 # Blueprint for users
 
 import datetime
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, current_app, Response, stream_with_context
+from sqlalchemy import update
 from uuid import uuid4
 from app.extensions import db
-from app.models import User, Settings
-from app.util.utility_functions import validate_name, validate_email, validate_password, hash_password, verify_password, encode_image_to_base64
-from app.util.decorators import login_required
+from app.models import User, Settings, Team, name_key
+from app.util.utility_functions import validate_name, validate_email, validate_password, hash_password, verify_password
+from app.util.blobstore import store_base64_image
+from app.util.decorators import login_required, etag_conditional
+from app.util.query_budget import query_budget, LIST_QUERY_BUDGET
+from app.util.versions import bump_versions, user_versions_query
+from app.util.lookups import get_user_row, invalidate_user, lookup_users_by_prefix, current_user_id
+from app.util.memberships import user_team_ids_query
+from app.util.pagination import list_response
+from app.util.serializers import TEAM_SERIALIZER, json_response
+from app.util.write_queue import group_commit, commit_write, after_commit
+from app.util.account_data import export_lines, import_lines
+from app.util.purge import mark_user_deleted, wake_purger
 
 users_bp = Blueprint('users', __name__, url_prefix='/users')
 
@@ -45,19 +56,25 @@ def create_user():
     if existing_user:
         return jsonify({"error": "User already exists"}), 400
 
+    # Store the profile picture in the blob store
+    try:
+        profile_picture_hash = store_base64_image(new_user_data.get('profile_picture'))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid profile_picture: {e}'}), 400
+
+    # Hash before queueing the insert, the writer must not wait on it
+    password = hash_password(new_user_data.get('password'))
+
     # Use current UTC time for timestamps
     now = datetime.datetime.utcnow()
-    profile_picture = new_user_data.get('profile_picture')
-    if profile_picture and not isinstance(profile_picture, bytes):
-        profile_picture = b''
 
     # Create a new user instance and initial settings
     new_user = User(
         public_id=str(uuid4()),
         profile_name=new_user_data.get('profile_name'),
         email=new_user_data.get('email'),
-        password=hash_password(new_user_data.get('password')),
-        profile_picture=encode_image_to_base64(profile_picture) if profile_picture else None,
+        password=password,
+        profile_picture_hash=profile_picture_hash,
         last_password_change=now,
         joined_on=now,
         last_update=now,
@@ -66,7 +83,7 @@ def create_user():
 
     new_settings = Settings(
         public_id=str(uuid4()),
-        user_public_id=new_user.public_id,
+        user=new_user,
         theme='light',
         separate_teams_todos=False,
         hide_completed_todos=False,
@@ -74,10 +91,30 @@ def create_user():
         timezone='UTC'
     )
 
-    db.session.add_all([new_user, new_settings])
-    db.session.commit()
+    @group_commit
+    def insert_user():
+        db.session.add_all([new_user, new_settings])
+        commit_write()
+        return jsonify({"message": "New user created!"}), 201
 
-    return jsonify({"message": "New user created!"}), 201
+    return insert_user()
+
+# Find users by the start of their profile name, for the invite type-ahead
+@users_bp.route('/lookup', methods=['GET'])
+@login_required
+@query_budget(1)
+def lookup_users():
+    prefix = request.args.get('prefix', '').strip()
+    if not prefix:
+        return jsonify({'error': 'prefix is required'}), 400
+    try:
+        limit = int(request.args.get('limit', current_app.config['USER_LOOKUP_DEFAULT_LIMIT']))
+    except ValueError:
+        return jsonify({'error': 'Limit must be an integer'}), 400
+    if limit < 1:
+        return jsonify({'error': 'Limit must be positive'}), 400
+    limit = min(limit, current_app.config['USER_LOOKUP_MAX_LIMIT'])
+    return json_response(lookup_users_by_prefix(prefix, limit))
 
 # Get user information by public id
 @login_required
@@ -85,10 +122,10 @@ def create_user():
 def get_user(public_id):
     if session.get('user_public_id') != public_id:
         return jsonify({'error': 'Unauthorized: You can only view your own profile.'}), 403
-    user = User.query.filter_by(public_id=public_id).first()
+    user = get_user_row(public_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
-    return jsonify({'public_id': user.public_id, 'profile_name': user.profile_name})
+    return jsonify({'public_id': user['public_id'], 'profile_name': user['profile_name'], 'profile_picture': user['profile_picture_hash']})
 
 # Edit user information by public id
 @login_required
@@ -96,7 +133,7 @@ def get_user(public_id):
 def edit_user(public_id):
     if session.get('user_public_id') != public_id:
         return jsonify({'error': 'Unauthorized: You can only edit your own profile.'}), 403
-    user = User.query.filter_by(public_id=public_id).first()
+    user = User.query.filter_by(public_id=public_id, deleted_on=None).first()
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
@@ -104,61 +141,90 @@ def edit_user(public_id):
     if not data:
         return jsonify({'error': 'No data provided'}), 400
 
+    # Validate and hash here, only the resulting update goes through the writer
+    values = {}
     if 'profile_name' in data:
-        user.profile_name = data['profile_name']
+        name_validation = validate_name(data['profile_name'])
+        if name_validation is not True:
+            return name_validation
+        values['profile_name'] = data['profile_name']
+        values['profile_name_key'] = name_key(data['profile_name'])
     if 'email' in data:
-        user.email = data['email']
-    if 'profile_picture' in data:
-        profile_picture = data['profile_picture']
-        if profile_picture and not isinstance(profile_picture, bytes):
-            profile_picture = b''
-        user.profile_picture = encode_image_to_base64(profile_picture) if profile_picture else None
+        values['email'] = data['email']
     if 'password' in data and 'new_password' in data:
         if validate_password(data['new_password']) is not True:
             return jsonify({'error': 'Invalid password format'}), 400
         if verify_password(data['password'], user.password) is not True:
             return jsonify({'error': 'Current password is incorrect'}), 400
-        user.password = hash_password(data['new_password'])
-        user.last_password_change = datetime.datetime.utcnow()
-        user.last_update = datetime.datetime.utcnow()
+        values['password'] = hash_password(data['new_password'])
+        values['last_password_change'] = datetime.datetime.utcnow()
+        values['last_update'] = datetime.datetime.utcnow()
+    # The picture is stored once the request is known to be valid, a rejected one leaves no blob behind
+    if 'profile_picture' in data:
+        try:
+            values['profile_picture_hash'] = store_base64_image(data['profile_picture'])
+        except ValueError as e:
+            return jsonify({'error': f'Invalid profile_picture: {e}'}), 400
+
+    previous_email = user.email
 
-    db.session.commit()
-    return jsonify({'message': 'User updated', 'public_id': user.public_id})
+    @group_commit
+    def update_user():
+        if values:
+            db.session.execute(update(User).where(User.public_id == public_id).values(**values))
+        commit_write()
+        after_commit(lambda: invalidate_user(public_id, previous_email, values.get('email', previous_email)))
+        return jsonify({'message': 'User updated', 'public_id': public_id})
+
+    return update_user()
 
 # Delete user by public id
 @login_required
 @users_bp.route('/delete/<public_id>', methods=['DELETE'])
+@group_commit
 def delete_user(public_id):
     if session.get('user_public_id') != public_id:
         return jsonify({'error': 'Unauthorized: You can only delete your own profile.'}), 403
-    user = User.query.filter_by(public_id=public_id).first()
+    user = User.query.filter_by(public_id=public_id, deleted_on=None).first()
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
-    db.session.delete(user)
-    db.session.commit()
+    # Mark the account deleted now, the purger removes its data in the background
+    email = user.email
+    users, teams = mark_user_deleted(user)
+    bump_versions(users=users, teams=teams)
+    commit_write()
+    after_commit(lambda: invalidate_user(public_id, email))
+    after_commit(lambda: wake_purger(current_app))
+    session.pop('user_public_id', None)
     return jsonify({'message': 'User deleted', 'public_id': public_id})
 
 # Get all teams the user is a part of
 @users_bp.route('/<public_id>/teams', methods=['GET'])
 @login_required
+@query_budget(LIST_QUERY_BUDGET)
+@etag_conditional(lambda public_id: user_versions_query(current_user_id()))
 def get_user_teams(public_id):
-    from app.models import Team
-    from flask import session
     # Only allow the user to see their own teams
     if session.get('user_public_id') != public_id:
         return jsonify({'error': 'Unauthorized: You can only view your own teams.'}), 403
-    teams = Team.query.filter(Team.members.contains([public_id])).all()
-    return jsonify([
-        {
-            'public_id': t.public_id,
-            'name': t.name,
-            'description': t.description,
-            'members': t.members,
-            'team_image': t.team_image,
-            'is_active': t.is_active,
-            'deleted': t.deleted,
-            'last_activity': t.last_activity,
-            'created_on': t.created_on
-        } for t in teams
-    ])
\ No newline at end of file
+    return list_response(TEAM_SERIALIZER, Team.id.in_(user_team_ids_query(current_user_id())))
+
+# Export the user's settings, teams and todos as NDJSON
+@users_bp.route('/<public_id>/export', methods=['GET'])
+@login_required
+def export_user(public_id):
+    if session.get('user_public_id') != public_id:
+        return jsonify({'error': 'Unauthorized: You can only export your own data.'}), 403
+    response = Response(stream_with_context(export_lines(public_id)), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename="todone-{public_id}.ndjson"'
+    return response
+
+# Import todos and settings from an NDJSON export
+@users_bp.route('/<public_id>/import', methods=['POST'])
+@login_required
+def import_user(public_id):
+    if session.get('user_public_id') != public_id:
+        return jsonify({'error': 'Unauthorized: You can only import into your own account.'}), 403
+    report = import_lines(public_id, request.stream)
+    return jsonify({'message': 'Import finished', **report.as_dict()})
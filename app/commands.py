@@ -0,0 +1,78 @@
+# Command line commands for the api
+
+import click
+from app import migrations
+from app.extensions import db
+from app.util.counters import rebuild_todo_counters
+from app.util.memberships import backfill_team_members
+from app.util.purge import purge_pending, purge_status
+from app.util.sync import compact_tombstones
+
+def register_commands(app):
+    """Register the maintenance commands on the Flask CLI."""
+
+    # Populate team_members from the legacy Team.members column
+    @app.cli.command('backfill-team-members')
+    def backfill_team_members_command():
+        """Backfill the team membership table from Team.members."""
+        inserted = backfill_team_members()
+        click.echo(f'Inserted {inserted} team membership rows.')
+
+    # Apply pending schema migrations
+    @app.cli.command('db-upgrade')
+    def db_upgrade_command():
+        """Bring the database schema up to the latest version."""
+        # Tables added since the last release are created before the migrations fill them
+        db.create_all(bind_key=None)
+        applied = migrations.upgrade(db.engine)
+        click.echo(f"Applied migrations: {', '.join(map(str, applied)) or 'none'}")
+
+    # Show the schema version
+    @app.cli.command('db-version')
+    def db_version_command():
+        """Show the schema version of the database."""
+        with db.engine.connect() as connection:
+            click.echo(f'Schema version {migrations.current_version(connection)} of {migrations.latest_version()}')
+
+    # Recount the dashboard counters
+    @app.cli.command('reconcile-counters')
+    def reconcile_counters_command():
+        """Rebuild todo_counters from todo_items."""
+        with db.engine.connect() as connection:
+            # Hold the write lock so no todo changes between the delete and the recount
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                rows = rebuild_todo_counters(connection)
+                connection.exec_driver_sql('COMMIT')
+            except Exception:
+                connection.exec_driver_sql('ROLLBACK')
+                raise
+        click.echo(f'Rebuilt {rows} todo counters.')
+
+    # Drop tombstones older than the retention
+    @app.cli.command('compact-tombstones')
+    @click.option('--retention-days', type=int, default=None, help='Defaults to SYNC_TOMBSTONE_RETENTION_DAYS.')
+    def compact_tombstones_command(retention_days):
+        """Delete old delta sync tombstones, expiring the cursors that predate them."""
+        if retention_days is None:
+            retention_days = app.config['SYNC_TOMBSTONE_RETENTION_DAYS']
+        with db.engine.begin() as connection:
+            removed = compact_tombstones(connection, retention_days)
+        click.echo(f'Removed {removed} tombstones older than {retention_days} days.')
+
+    # Purge deleted accounts and teams
+    @app.cli.command('purge')
+    @click.option('--chunk-size', type=int, default=None, help='Defaults to PURGE_CHUNK_SIZE.')
+    def purge_command(chunk_size):
+        """Remove the rows of every deleted account and team still waiting for the purger."""
+        removed = purge_pending(db.engine, chunk_size or app.config['PURGE_CHUNK_SIZE'])
+        click.echo(f'Removed {removed} rows.')
+
+    # Show the purge backlog
+    @app.cli.command('purge-status')
+    def purge_status_command():
+        """Show the unfinished purge jobs and the age of the oldest."""
+        with db.engine.connect() as connection:
+            status = purge_status(connection)
+        click.echo(f"{status['pending']} pending jobs, oldest {status['lag_seconds']:.0f}s, {status['rows_removed']} rows removed so far.")
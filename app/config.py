@@ -4,17 +4,134 @@ import os
 
 cwd = os.getcwd()
 
+# SQLite storage engine profiles, selected with the TODONE_DB_PROFILE environment variable
+SQLITE_PROFILES = {
+    'default': {
+        'pragmas': {
+            'foreign_keys': 'ON'
+        },
+        'engine_options': {},
+        'read_only_bind': False
+    },
+    'production': {
+        'pragmas': {
+            'foreign_keys': 'ON',
+            'journal_mode': 'WAL',  # Readers no longer block behind the writer
+            'synchronous': 'NORMAL',  # Safe with WAL, fsync only at checkpoints
+            'busy_timeout': 5000,  # Wait up to 5s for the writer lock instead of failing
+            'mmap_size': 268435456,  # 256MB of memory mapped reads
+            'cache_size': -65536,  # 64MB page cache per connection
+            'temp_store': 'MEMORY'
+        },
+        'engine_options': {
+            'pool_size': 10,
+            'max_overflow': 10,
+            'pool_timeout': 10,
+            'pool_recycle': 3600,
+            'pool_pre_ping': True
+        },
+        'read_only_bind': True
+    }
+}
+
 class Config:
     """Base configuration class."""
-    print(cwd + "/app/data/todone.db")
     
     # Flask settings
     TESTING = True
     SECRET_KEY = 'NotASecretKey'
 
     # Database settings
-    SQLALCHEMY_DATABASE_URI = "sqlite:///" + cwd + "/app/data/todone.db"
+    DATABASE_PATH = cwd + "/app/data/todone.db"
+    SQLALCHEMY_DATABASE_URI = "sqlite:///" + DATABASE_PATH
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    MIGRATE_ON_STARTUP = True  # Otherwise run 'flask db-upgrade' at deploy time
+
+    # Storage engine profile
+    SQLITE_PROFILE = os.environ.get('TODONE_DB_PROFILE', 'default')
+    SQLITE_PRAGMAS = SQLITE_PROFILES[SQLITE_PROFILE]['pragmas']
+    SQLALCHEMY_ENGINE_OPTIONS = SQLITE_PROFILES[SQLITE_PROFILE]['engine_options']
+    # GET handlers read through a read-only URI connection when the profile enables it
+    SQLALCHEMY_BINDS = {
+        'readonly': "sqlite:///file:" + DATABASE_PATH + "?mode=ro&uri=true"
+    } if SQLITE_PROFILES[SQLITE_PROFILE]['read_only_bind'] else {}
+    SQLITE_READ_ONLY_PRAGMAS = {
+        'query_only': 'ON',
+        'busy_timeout': SQLITE_PRAGMAS.get('busy_timeout', 0),
+        'mmap_size': SQLITE_PRAGMAS.get('mmap_size', 0),
+        'cache_size': SQLITE_PRAGMAS.get('cache_size', -2000)
+    }
+
+    # Blob store settings
+    BLOB_STORE_PATH = cwd + "/app/data/blobs"
+    BLOB_CACHE_MAX_AGE = 31536000
+    MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+    # Password hashing settings
+    PASSWORD_HASH_METHOD = 'scrypt'  # 'scrypt' or 'pbkdf2:sha256'
+    PASSWORD_HASH_ITERATIONS = 32768  # scrypt cost factor N, or pbkdf2 iterations
+    PASSWORD_HASH_WORKERS = 2  # Processes per worker, 0 hashes in the request thread
+    PASSWORD_HASH_QUEUE_DEPTH = 16  # Hashes queued or running before answering 503
+    PASSWORD_HASH_TIMEOUT = 10
+
+    # Cache settings, per worker process
+    CACHE_TTL = 60
+    SETTINGS_CACHE_SIZE = 10000
+    USER_CACHE_SIZE = 10000
+    KEY_CACHE_SIZE = 50000  # public_id -> id mappings of users and teams, they never go stale
+    KEY_CACHE_TTL = 3600
+
+    # Response compression settings
+    COMPRESSION_MIN_SIZE = 1024  # Smaller bodies are sent as they are
+    COMPRESSION_GZIP_LEVEL = 5
+    COMPRESSION_ZSTD_LEVEL = 3  # Used when the zstandard package is installed
+    COMPRESSION_CACHE_SIZE = 256  # Compressed bodies of ETagged responses kept per worker
+    COMPRESSION_CACHE_TTL = 3600
+    COMPRESSION_CACHE_MAX_ENTRY_BYTES = 256 * 1024  # Larger compressed bodies are not cached
+
+    # Instrumentation settings
+    SLOW_REQUEST_SECONDS = 0.5  # Requests slower than this are logged with their SQL statements
+    SLOW_QUERY_SECONDS = 0.1  # SQL statements slower than this are logged
+    # Exceeded query budgets raise instead of logging a warning, the test suite turns it on
+    QUERY_BUDGET_STRICT = os.environ.get('TODONE_QUERY_BUDGET_STRICT', '0') == '1'
+
+    # Operational endpoints (/metrics, /cache/stats, /purge/stats) answer only requests
+    # carrying this token as 'Authorization: Bearer <token>', unset they are not served
+    SYSTEM_TOKEN = os.environ.get('TODONE_SYSTEM_TOKEN')
+
+    # ASGI settings, threads running the sync views of one worker
+    ASGI_THREADS = 32
+
+    # Pagination settings
+    PAGINATION_DEFAULT_LIMIT = 100
+    PAGINATION_MAX_LIMIT = 1000
+    STREAM_YIELD_PER = 500
+
+    # User lookup settings, the type-ahead of the invite dialog
+    USER_LOOKUP_DEFAULT_LIMIT = 10
+    USER_LOOKUP_MAX_LIMIT = 50
+
+    # Bulk operation settings
+    BULK_MAX_OPERATIONS = 1000
+
+    # Account import settings
+    IMPORT_BATCH_SIZE = 500  # Todos written per transaction
+    IMPORT_MAX_LINE_BYTES = 64 * 1024
+    IMPORT_MAX_ERRORS = 100  # Rejected lines listed in the report, the rest are only counted
+
+    # Group commit settings, the mutating views of a worker share one writer thread
+    WRITE_QUEUE_ENABLED = os.environ.get('TODONE_WRITE_QUEUE', '0') == '1'
+    WRITE_QUEUE_WINDOW_MS = 1  # How long the writer waits for more work once a batch has started
+    WRITE_QUEUE_MAX_BATCH = 64  # Units of work committed together at most
+
+    # Purge settings, deleted accounts and teams are removed by a background thread of each worker
+    PURGE_ENABLED = True  # Otherwise run 'flask purge' periodically
+    PURGE_CHUNK_SIZE = 500  # Rows deleted per transaction
+    PURGE_PAUSE_MS = 5  # Pause between chunks so other writers get the lock
+    PURGE_POLL_SECONDS = 30  # How often an idle purger looks for jobs queued by other workers
+
+    # Delta sync settings
+    SYNC_TOMBSTONE_RETENTION_DAYS = 30  # Clients that have not synced for longer resync from since=0
 
     # Session cookie settings
     SESSION_COOKIE_NAME = 'session'
@@ -1 +1,15 @@
-# Error handlers for the api
\ No newline at end of file
+# Error handlers for the api
+
+from flask import jsonify
+from app.util.auth import HashingBusy
+
+def register_error_handlers(app):
+    """Register the JSON error handlers on the app."""
+
+    # The password hashing pool is saturated, ask the client to come back shortly
+    @app.errorhandler(HashingBusy)
+    def handle_hashing_busy(error):
+        response = jsonify({'error': 'Server is busy, please retry shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
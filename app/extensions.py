@@ -1,5 +1,16 @@
 # Extension declarations for the api
 
+from flask import has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 
-db = SQLAlchemy()
\ No newline at end of file
+class RoutingSession(Session):
+    """Session that sends the reads of GET requests to the read-only bind when one is configured."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_request_context()
+                and request.method in ('GET', 'HEAD') and 'readonly' in self._db.engines):
+            return self._db.engines['readonly']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
@@ -0,0 +1,293 @@
+# Versioned schema migrations for the api
+#
+# The schema version of a database is stamped in SQLite's PRAGMA user_version.
+# Each migration runs in its own BEGIN IMMEDIATE transaction together with the
+# version stamp, so concurrent workers apply it exactly once.
+
+import logging
+from sqlalchemy import ForeignKeyConstraint, MetaData, Table, inspect, text
+from sqlalchemy.schema import CreateTable
+from app.models import (
+    User, Team, TodoItem, Settings, name_key, TODO_SEARCH_DDL, TODO_COUNTER_DDL, TODO_SYNC_DDL, TEAM_MEMBER_SYNC_DDL
+)
+from app.util.blobstore import store_blob
+from app.util.counters import rebuild_todo_counters
+from app.util.memberships import backfill_team_members
+from app.util.utility_functions import decode_image_from_base64
+
+logger = logging.getLogger('app.migrations')
+
+MIGRATIONS = []
+
+def migration(version: int, description: str, foreign_keys: bool = True):
+    """Register a function as the migration to the given schema version.
+
+    Migrations rebuilding tables pass foreign_keys=False, so dropping a table
+    does not cascade to the rows referencing it; the references are checked
+    before the migration commits instead.
+    """
+    def decorator(f):
+        f.foreign_keys = foreign_keys
+        MIGRATIONS.append((version, description, f))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return f
+    return decorator
+
+# Latest schema version known to this code
+def latest_version() -> int:
+    """Return the version of the newest registered migration."""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+# Read the schema version of a database
+def current_version(connection) -> int:
+    """Return the schema version stamped in the database."""
+    return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+# Stamp a schema version without running migrations
+def stamp(engine, version: int = None) -> None:
+    """Mark the database as being at the given version, the latest by default."""
+    version = latest_version() if version is None else version
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.exec_driver_sql(f'PRAGMA user_version = {int(version)}')
+
+# Compare the stamped schema version with the code
+def schema_status(engine) -> str:
+    """Return 'current', 'behind', 'ahead' or 'empty' for the database of the engine.
+
+    A current database costs a single PRAGMA, the tables are only inspected
+    when the stamp is behind.
+    """
+    with engine.connect() as connection:
+        version = current_version(connection)
+    if version == latest_version():
+        return 'current'
+    if version > latest_version():
+        return 'ahead'
+    # Databases created before versioning have tables but no stamp
+    return 'behind' if inspect(engine).has_table('users') else 'empty'
+
+# Bring a database up to the latest version
+def upgrade(engine) -> list:
+    """Apply every pending migration in order, returning the versions applied."""
+    applied = []
+    with engine.connect() as connection:
+        # Manage transactions by hand so DDL and the version stamp commit together
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        for version, description, f in MIGRATIONS:
+            if current_version(connection) >= version:
+                continue
+            # The pragma is a no-op inside a transaction, so it is switched before BEGIN
+            foreign_keys = connection.exec_driver_sql('PRAGMA foreign_keys').scalar()
+            if not f.foreign_keys:
+                connection.exec_driver_sql('PRAGMA foreign_keys = OFF')
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                # Another worker may have migrated while we waited for the lock
+                if current_version(connection) >= version:
+                    connection.exec_driver_sql('ROLLBACK')
+                    continue
+                f(connection)
+                if not f.foreign_keys and connection.exec_driver_sql('PRAGMA foreign_key_check').first() is not None:
+                    raise RuntimeError(f'Migration {version} left rows violating a foreign key')
+                connection.exec_driver_sql(f'PRAGMA user_version = {int(version)}')
+                connection.exec_driver_sql('COMMIT')
+            except Exception:
+                connection.exec_driver_sql('ROLLBACK')
+                raise
+            finally:
+                connection.exec_driver_sql(f'PRAGMA foreign_keys = {int(foreign_keys)}')
+            applied.append(version)
+    return applied
+
+# Column names of a table, empty when it does not exist
+def _table_columns(connection, table: str) -> list:
+    return [row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info({table})')]
+
+# Add a column unless it already exists
+def _add_column(connection, table: str, column: str, ddl: str) -> None:
+    if column not in _table_columns(connection, table):
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+# Create an index unless it already exists
+def _create_index(connection, name: str, table: str, columns: str) -> None:
+    connection.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})'))
+
+# Translate a public ID column of the legacy row to the id of the user or team it names
+def _key_expression(target: str, column: str) -> str:
+    return f'(SELECT id FROM {target} WHERE public_id = old.{column})'
+
+# Tables keyed by public IDs before migration 1, in foreign key order, with the (target, legacy column) of their integer keys
+INTEGER_KEYS = [
+    (User.__table__, {}),
+    (Team.__table__, {'owner_id': ('users', 'owner_public_id')}),
+    (Settings.__table__, {'user_id': ('users', 'user_public_id')}),
+    (TodoItem.__table__, {'user_id': ('users', 'user_public_id'), 'team_id': ('teams', 'assigned_to')})
+]
+
+# Rebuild a table keyed like its model, the SQLite procedure for changes ALTER TABLE can not make
+def _rebuild_table(connection, metadata: MetaData, table, mapping: dict) -> None:
+    """Copy the rows of the legacy table into a new one with the integer keys of the model.
+
+    The new table has the model's definition of the legacy columns and the
+    keys; the columns added by later migrations are left to them. Rows whose
+    NOT NULL keys name a missing user or team are dropped, nullable keys are
+    cleared; both are logged.
+    """
+    _log_dangling_references(connection, table, mapping)
+    legacy = _table_columns(connection, table.name)
+    columns = [column for column in table.columns if column.name in legacy or column.name in mapping]
+    # Copied columns lose their foreign keys, the model's constraints are declared again
+    foreign_keys = [
+        ForeignKeyConstraint(
+            constraint.column_keys, [element.target_fullname for element in constraint.elements],
+            ondelete=constraint.ondelete
+        )
+        for constraint in table.foreign_key_constraints
+    ]
+    rebuilt = Table(
+        table.name, metadata, *[column._copy() for column in columns], *foreign_keys,
+        sqlite_autoincrement=table.dialect_options['sqlite']['autoincrement']
+    )
+    ddl = str(CreateTable(rebuilt).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(ddl.replace(f'CREATE TABLE {table.name} (', f'CREATE TABLE {table.name}_new (', 1))
+    names = ', '.join(column.name for column in columns)
+    keys = {name: _key_expression(target, column) for name, (target, column) in mapping.items()}
+    expressions = ', '.join(f'{keys.get(column.name, "old." + column.name)} AS {column.name}' for column in columns)
+    conditions = [f'{name} IS NOT NULL' for name in mapping if not table.columns[name].nullable]
+    connection.exec_driver_sql(
+        f'INSERT INTO {table.name}_new ({names}) SELECT {names} FROM (SELECT {expressions} FROM {table.name} AS old)'
+        + (f' WHERE {" AND ".join(conditions)}' if conditions else '')
+    )
+    connection.exec_driver_sql(f'DROP TABLE {table.name}')
+    connection.exec_driver_sql(f'ALTER TABLE {table.name}_new RENAME TO {table.name}')
+
+# Report the rows a rebuild is about to drop or clear a reference of
+def _log_dangling_references(connection, table, mapping: dict) -> None:
+    for name, (target, column) in mapping.items():
+        public_ids = connection.exec_driver_sql(
+            f'SELECT public_id FROM {table.name} AS old '
+            f'WHERE old.{column} IS NOT NULL AND {_key_expression(target, column)} IS NULL ORDER BY id'
+        ).scalars().all()
+        if not public_ids:
+            continue
+        if table.columns[name].nullable:
+            logger.warning(
+                'Cleared %s of %d %s rows naming a missing row of %s: %s',
+                column, len(public_ids), table.name, target, ', '.join(public_ids)
+            )
+        else:
+            logger.warning(
+                'Dropped %d %s rows whose %s names a missing row of %s: %s',
+                len(public_ids), table.name, column, target, ', '.join(public_ids)
+            )
+
+# Give the teams of missing owners to their longest standing member
+def _hand_over_orphaned_teams(connection) -> None:
+    """Make the earliest joined user still listed in Team.members the owner of a team whose owner is gone.
+
+    Teams without such a member are left to the rebuild, which drops them.
+    """
+    members = "CASE WHEN json_valid(teams.members) THEN teams.members ELSE '[]' END"
+    heir = (
+        f'(SELECT users.public_id FROM json_each({members}) AS member JOIN users ON users.public_id = member.value '
+        f'ORDER BY users.joined_on IS NULL, users.joined_on, users.id LIMIT 1)'
+    )
+    orphaned = 'owner_public_id NOT IN (SELECT public_id FROM users)'
+    rows = connection.exec_driver_sql(
+        f'SELECT public_id, owner_public_id, {heir} FROM teams WHERE {orphaned} ORDER BY id'
+    ).all()
+    for public_id, owner, new_owner in rows:
+        if new_owner is not None:
+            logger.warning('Team %s of missing user %s was handed to its member %s', public_id, owner, new_owner)
+    connection.exec_driver_sql(f'UPDATE teams SET owner_public_id = {heir} WHERE {orphaned} AND {heir} IS NOT NULL')
+
+@migration(1, 'Key internal references by integer ids instead of public IDs', foreign_keys=False)
+def _add_integer_keys(connection):
+    # Ids are kept, so the references of the rebuilt rows stay valid
+    _hand_over_orphaned_teams(connection)
+    metadata = MetaData()
+    for table, mapping in INTEGER_KEYS:
+        _rebuild_table(connection, metadata, table, mapping)
+
+@migration(2, 'Backfill team_members from Team.members')
+def _backfill_team_members(connection):
+    backfill_team_members(connection)
+
+@migration(3, 'Add secondary indexes for the hot query columns')
+def _add_query_indexes(connection):
+    _create_index(connection, 'ix_todo_items_user_completed_due', 'todo_items', 'user_id, completed, due_date')
+    _create_index(connection, 'ix_todo_items_team_completed_due', 'todo_items', 'team_id, completed, due_date')
+    _create_index(connection, 'ix_teams_name', 'teams', 'name')
+    _create_index(connection, 'ix_teams_owner_id', 'teams', 'owner_id')
+    _create_index(connection, 'ix_users_profile_name', 'users', 'profile_name')
+    _create_index(connection, 'ix_settings_user_id', 'settings', 'user_id')
+    connection.execute(text('ANALYZE'))
+
+@migration(4, 'Move inline profile pictures and team images to the blob store')
+def _move_images_to_blob_store(connection):
+    _add_column(connection, 'users', 'profile_picture_hash', 'VARCHAR(64)')
+    _add_column(connection, 'teams', 'team_image_hash', 'VARCHAR(64)')
+    for table, column in [('users', 'profile_picture'), ('teams', 'team_image')]:
+        rows = connection.execute(text(f'SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL')).all()
+        for row_id, image in rows:
+            # Earlier versions stored the base64 text rather than the raw bytes
+            if isinstance(image, bytes) and image.isascii():
+                image = image.decode('ascii')
+            if isinstance(image, str):
+                image = decode_image_from_base64(image) or image.encode('utf-8')
+            connection.execute(
+                text(f'UPDATE {table} SET {column}_hash = :digest, {column} = NULL WHERE id = :id'),
+                {'digest': store_blob(image) if image else None, 'id': row_id}
+            )
+
+@migration(5, 'Add the todo_items_fts full-text index')
+def _add_todo_search_index(connection):
+    for statement in TODO_SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql("INSERT INTO todo_items_fts (todo_items_fts) VALUES ('rebuild')")
+
+@migration(6, 'Add the todo_counters triggers and count existing todos')
+def _add_todo_counters(connection):
+    for statement in TODO_COUNTER_DDL:
+        connection.exec_driver_sql(statement)
+    rebuild_todo_counters(connection)
+
+@migration(7, 'Add the change sequence and tombstones of the delta sync feed')
+def _add_change_sequence(connection):
+    _add_column(connection, 'todo_items', 'change_seq', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(connection, 'team_members', 'change_seq', 'INTEGER NOT NULL DEFAULT 0')
+    _create_index(connection, 'ix_todo_items_user_change_seq', 'todo_items', 'user_id, change_seq')
+    _create_index(connection, 'ix_todo_items_team_change_seq', 'todo_items', 'team_id, change_seq')
+    for statement in TODO_SYNC_DDL + TEAM_MEMBER_SYNC_DDL:
+        connection.exec_driver_sql(statement)
+    # Existing rows share the first position, so any cursor from here on is newer
+    connection.exec_driver_sql('UPDATE todo_items SET change_seq = 1')
+    connection.exec_driver_sql('UPDATE team_members SET change_seq = 1')
+    connection.exec_driver_sql(
+        "INSERT INTO sync_state (name, value) VALUES ('change_seq', 1) "
+        "ON CONFLICT (name) DO UPDATE SET value = max(value, 1)"
+    )
+
+@migration(8, 'Add the case-folded profile name key of the user lookup')
+def _add_profile_name_key(connection):
+    _add_column(connection, 'users', 'profile_name_key', "VARCHAR(120) NOT NULL DEFAULT ''")
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            text('SELECT id, profile_name FROM users WHERE id > :last_id ORDER BY id LIMIT 10000'),
+            {'last_id': last_id}
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            text('UPDATE users SET profile_name_key = :key WHERE id = :id'),
+            [{'key': name_key(profile_name), 'id': row_id} for row_id, profile_name in rows]
+        )
+        last_id = rows[-1][0]
+    _create_index(connection, 'ix_users_profile_name_key', 'users', 'profile_name_key')
+
+@migration(9, 'Add the deletion marks of users and teams for the background purger')
+def _add_deletion_marks(connection):
+    _add_column(connection, 'users', 'deleted_on', 'DATETIME')
+    _add_column(connection, 'teams', 'deleted_on', 'DATETIME')
@@ -1,10 +1,15 @@
 # Models for the api
 
+import unicodedata
 from app.extensions import db
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, BLOB, BOOLEAN, JSON, event
-from sqlalchemy.engine import Engine
-import sqlite3
+from sqlalchemy import Column, Integer, String, DateTime, BLOB, BOOLEAN, JSON, Index, DDL, event
+from sqlalchemy.orm import deferred
+
+# Case-insensitive search key of a name, comparable with the binary collation of SQLite
+def name_key(name: str) -> str:
+    """Return the NFKC normalized, case-folded form of a name."""
+    return unicodedata.normalize('NFKC', name).casefold() if name is not None else None
 
 class User(db.Model):
     """User model for the application."""
@@ -14,13 +19,27 @@ class User(db.Model):
     id = Column(Integer, primary_key=True)
     public_id = Column(String(120), unique=True, nullable=False)
     profile_name = Column(String(120), nullable=False)
+    # Maintained by writers that change profile_name, inserts derive it from profile_name
+    profile_name_key = Column(
+        String(120), nullable=False,
+        default=lambda context: name_key(context.get_current_parameters().get('profile_name'))
+    )
     email = Column(String(120), unique=True, nullable=False)
     password = Column(String(128), nullable=False)
     last_password_change = Column(DateTime, default=datetime.utcnow)
     joined_on = Column(DateTime, default=datetime.utcnow)
     last_update = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     last_activity = Column(DateTime, default=datetime.utcnow)
-    profile_picture = Column(BLOB, nullable=True)
+    profile_picture_hash = Column(String(64), nullable=True)  # Digest of the image in the blob store
+    profile_picture = deferred(Column(BLOB, nullable=True))  # Legacy inline image, moved to the blob store
+    deleted_on = Column(DateTime, nullable=True)  # Set when the account is deleted, the purger then removes the row
+    
+    __table_args__ = (
+        Index('ix_users_profile_name', 'profile_name'),
+        Index('ix_users_profile_name_key', 'profile_name_key'),
+        # Ids are never reused, so a cached public_id -> id mapping can not go stale
+        {'sqlite_autoincrement': True},
+    )
     
     def __repr__(self):
         return f'<User {self.name}>'
@@ -32,7 +51,7 @@ class Settings(db.Model):
     
     id = Column(Integer, primary_key=True)
     public_id = Column(String(120), unique=True, nullable=False)
-    user_public_id = Column(String(120), db.ForeignKey('users.public_id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     theme = Column(String(50), default='light')
     separate_teams_todos = Column(BOOLEAN, default=False)
     hide_completed_todos = Column(BOOLEAN, default=False)
@@ -41,6 +60,10 @@ class Settings(db.Model):
     
     user = db.relationship('User', backref=db.backref('settings', passive_deletes=True), passive_deletes=True)
     
+    __table_args__ = (
+        Index('ix_settings_user_id', 'user_id'),
+    )
+    
     def __repr__(self):
         return f'<Setting {self.key} for User {self.user_id}>'
 
@@ -51,22 +74,50 @@ class TodoItem(db.Model):
     
     id = Column(Integer, primary_key=True)
     public_id = Column(String(120), unique=True, nullable=False)
-    user_public_id = Column(String(120), db.ForeignKey('users.public_id'), nullable=False)
+    user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False)
     visibility = Column(String(50), default='public')  # 'public', 'private', 'team'
     title = Column(String(200), nullable=False)
     summary = Column(String(500), nullable=True)
     due_date = Column(DateTime, nullable=True)
     completed = Column(BOOLEAN, default=False)
     priority = Column(String(50), default='normal')  # 'low', 'normal', 'high'
-    assigned_to = Column(String(120), nullable=True)
+    team_id = Column(Integer, db.ForeignKey('teams.id'), nullable=True)  # The team the todo is assigned to
     shared_with = Column(JSON, nullable=True)  # List of user public IDs
     created_by = Column(String(50), nullable=False)
     created_on = Column(DateTime, default=datetime.utcnow)
+    change_seq = Column(Integer, nullable=False, default=0)  # Position in the change sequence, set by TODO_SYNC_DDL
     
     user = db.relationship('User', backref='todo_items')
     
+    # Owner and team listings filter on completion and sort or range on the due date,
+    # the change feed ranges on the change sequence of each owner and team
+    __table_args__ = (
+        Index('ix_todo_items_user_completed_due', 'user_id', 'completed', 'due_date'),
+        Index('ix_todo_items_team_completed_due', 'team_id', 'completed', 'due_date'),
+        Index('ix_todo_items_user_change_seq', 'user_id', 'change_seq'),
+        Index('ix_todo_items_team_change_seq', 'team_id', 'change_seq'),
+    )
+    
     def __repr__(self):
-        return f'<TodoItem {self.title} for User {self.user_public_id}>'
+        return f'<TodoItem {self.title} for User {self.user_id}>'
+
+# Full-text index over todo titles and summaries. It is an external content FTS5
+# table, so it only stores the index, and triggers keep it in step with todo_items.
+TODO_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS todo_items_fts USING fts5("
+    "title, summary, content='todo_items', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS todo_items_fts_insert AFTER INSERT ON todo_items BEGIN "
+    "INSERT INTO todo_items_fts (rowid, title, summary) VALUES (new.id, new.title, new.summary); END",
+    "CREATE TRIGGER IF NOT EXISTS todo_items_fts_delete AFTER DELETE ON todo_items BEGIN "
+    "INSERT INTO todo_items_fts (todo_items_fts, rowid, title, summary) VALUES ('delete', old.id, old.title, old.summary); END",
+    "CREATE TRIGGER IF NOT EXISTS todo_items_fts_update AFTER UPDATE OF title, summary ON todo_items BEGIN "
+    "INSERT INTO todo_items_fts (todo_items_fts, rowid, title, summary) VALUES ('delete', old.id, old.title, old.summary); "
+    "INSERT INTO todo_items_fts (rowid, title, summary) VALUES (new.id, new.title, new.summary); END"
+]
+for statement in TODO_SEARCH_DDL:
+    event.listen(TodoItem.__table__, 'after_create', DDL(statement))
+event.listen(TodoItem.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS todo_items_fts'))
 
 class Team(db.Model):
     """Team model for the application."""
@@ -75,24 +126,211 @@ class Team(db.Model):
     
     id = Column(Integer, primary_key=True)
     public_id = Column(String(120), unique=True, nullable=False)
-    owner_public_id = Column(String(120), nullable=False)
+    owner_id = Column(Integer, db.ForeignKey('users.id'), nullable=False)
     name = Column(String(120), nullable=False)
     description = Column(String(500), nullable=True)
     members = Column(JSON, nullable=True)  # List of user public IDs
-    team_image = Column(BLOB, nullable=True)
+    team_image_hash = Column(String(64), nullable=True)  # Digest of the image in the blob store
+    team_image = deferred(Column(BLOB, nullable=True))  # Legacy inline image, moved to the blob store
     is_active = Column(BOOLEAN, default=True)
     deleted = Column(BOOLEAN, default=False)
+    deleted_on = Column(DateTime, nullable=True)  # Set when the team is deleted, the purger then removes the row
     last_activity = Column(DateTime, default=datetime.utcnow)
     created_on = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        Index('ix_teams_name', 'name'),
+        Index('ix_teams_owner_id', 'owner_id'),
+        # Ids are never reused, so a cached public_id -> id mapping can not go stale
+        {'sqlite_autoincrement': True},
+    )
+    
     def __repr__(self):
         return f'<Team {self.name}>'
 
-# Ensure foreign key constraints are enforced in SQLite
-# This is necessary for SQLite as it does not enforce foreign key constraints by default.
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    if isinstance(dbapi_connection, sqlite3.Connection):
+class TeamMember(db.Model):
+    """Team membership association for the application."""
+    
+    __tablename__ = 'team_members'
+    
+    # The primary key indexes team -> members, the secondary index covers member -> teams
+    team_id = Column(Integer, db.ForeignKey('teams.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    role = Column(String(50), default='member')  # 'owner', 'member'
+    joined_on = Column(DateTime, default=datetime.utcnow)
+    change_seq = Column(Integer, nullable=False, default=0)  # Position in the change sequence, set by TEAM_MEMBER_SYNC_DDL
+    
+    __table_args__ = (
+        Index('ix_team_members_user_team', 'user_id', 'team_id'),
+    )
+    
+    def __repr__(self):
+        return f'<TeamMember {self.user_id} of Team {self.team_id}>'
+
+class PurgeJob(db.Model):
+    """A deleted account or team whose rows the background purger removes."""
+    
+    __tablename__ = 'purge_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(20), nullable=False)  # 'user', 'team'
+    public_id = Column(String(120), nullable=False)
+    requested_on = Column(DateTime, default=datetime.utcnow)
+    started_on = Column(DateTime, nullable=True)
+    finished_on = Column(DateTime, nullable=True)
+    rows_removed = Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        Index('ix_purge_jobs_finished_on', 'finished_on'),
+    )
+    
+    def __repr__(self):
+        return f'<PurgeJob {self.kind} {self.public_id}>'
+
+class ResourceVersion(db.Model):
+    """Change counter of a user or team, bumped by every write and used to build ETags."""
+    
+    __tablename__ = 'resource_versions'
+    
+    scope = Column(String(20), primary_key=True)  # 'user', 'team'
+    ref_id = Column(Integer, primary_key=True)  # users.id or teams.id, by scope
+    version = Column(Integer, nullable=False, default=0)
+    updated_on = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ResourceVersion {self.scope} {self.ref_id} v{self.version}>'
+
+class TodoCounter(db.Model):
+    """Count of the todos of a user or team in one bucket, maintained by triggers on todo_items."""
+    
+    __tablename__ = 'todo_counters'
+    
+    scope = Column(String(20), primary_key=True)  # 'user' (owner), 'team' (assignee)
+    ref_id = Column(Integer, primary_key=True)  # users.id or teams.id, by scope
+    bucket = Column(String(20), primary_key=True)  # 'total', 'open', 'completed', 'open:<priority>', 'due:<YYYY-MM-DD>'
+    count = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<TodoCounter {self.scope} {self.ref_id} {self.bucket}={self.count}>'
+
+# Counter buckets as (bucket, condition) SQL over a todo_items row named {row}.
+# Open todos are also counted per priority and per due day, so overdue and
+# due-today counts are a range read over a handful of day buckets.
+TODO_COUNTER_SCOPES = [('user', 'user_id'), ('team', 'team_id')]
+TODO_COUNTER_BUCKETS = [
+    ("'total'", "1"),
+    ("CASE WHEN coalesce({row}.completed, 0) THEN 'completed' ELSE 'open' END", "1"),
+    ("'open:' || coalesce({row}.priority, 'normal')", "NOT coalesce({row}.completed, 0)"),
+    ("'due:' || date({row}.due_date)", "NOT coalesce({row}.completed, 0) AND {row}.due_date IS NOT NULL")
+]
+
+# Statements adding delta to every counter of a todo_items row
+def _todo_counter_statements(row: str, delta: int) -> str:
+    statements = []
+    for scope, column in TODO_COUNTER_SCOPES:
+        for bucket, condition in TODO_COUNTER_BUCKETS:
+            statements.append(
+                f"INSERT INTO todo_counters (scope, ref_id, bucket, count) "
+                f"SELECT '{scope}', {row}.{column}, {bucket.format(row=row)}, {delta} "
+                f"WHERE {row}.{column} IS NOT NULL AND {condition.format(row=row)} "
+                f"ON CONFLICT (scope, ref_id, bucket) DO UPDATE SET count = count + excluded.count;"
+            )
+    if delta < 0:
+        statements.append(
+            f"DELETE FROM todo_counters WHERE count = 0 AND ("
+            f"(scope = 'user' AND ref_id = {row}.user_id) OR (scope = 'team' AND ref_id = {row}.team_id));"
+        )
+    return ' '.join(statements)
+
+TODO_COUNTER_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS todo_counters_insert AFTER INSERT ON todo_items BEGIN "
+    + _todo_counter_statements('new', 1) + " END",
+    "CREATE TRIGGER IF NOT EXISTS todo_counters_delete AFTER DELETE ON todo_items BEGIN "
+    + _todo_counter_statements('old', -1) + " END",
+    "CREATE TRIGGER IF NOT EXISTS todo_counters_update "
+    "AFTER UPDATE OF user_id, team_id, completed, priority, due_date ON todo_items BEGIN "
+    + _todo_counter_statements('old', -1) + " " + _todo_counter_statements('new', 1) + " END"
+]
+# The triggers belong to todo_items, SQLite only resolves todo_counters when they fire
+for statement in TODO_COUNTER_DDL:
+    event.listen(TodoItem.__table__, 'after_create', DDL(statement))
+
+class SyncState(db.Model):
+    """Named counter of the change feed: 'change_seq' is the head of the sequence, 'compacted_seq' the newest compacted tombstone."""
+    
+    __tablename__ = 'sync_state'
+    
+    name = Column(String(20), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<SyncState {self.name}={self.value}>'
+
+class SyncTombstone(db.Model):
+    """A todo that was deleted or left a team, or a membership that ended, at a point of the change sequence."""
+    
+    __tablename__ = 'sync_tombstones'
+    
+    seq = Column(Integer, primary_key=True)
+    kind = Column(String(20), nullable=False)  # 'todo', 'membership'
+    public_id = Column(String(120), nullable=True)  # The todo, None for a membership
+    user_id = Column(Integer, nullable=True)  # The owner of the todo, or the former member
+    team_id = Column(Integer, nullable=True)  # The team the todo was assigned to, or the team of the membership
+    deleted_on = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SyncTombstone {self.kind} {self.public_id} at {self.seq}>'
+
+# Change sequence shared by todos and memberships. Every insert, update and
+# delete takes the next value inside its own write transaction, and SQLite runs
+# one write transaction at a time, so values become visible in increasing order.
+NEXT_CHANGE_SEQ = (
+    "INSERT INTO sync_state (name, value) VALUES ('change_seq', 1) "
+    "ON CONFLICT (name) DO UPDATE SET value = value + 1;"
+)
+CURRENT_CHANGE_SEQ = "(SELECT value FROM sync_state WHERE name = 'change_seq')"
+
+# Tombstone of the old todo_items row when it is deleted or moves away from its owner or team
+def _todo_tombstone_statement(condition: str = '1') -> str:
+    return (
+        f"INSERT INTO sync_tombstones (seq, kind, public_id, user_id, team_id, deleted_on) "
+        f"SELECT {CURRENT_CHANGE_SEQ}, 'todo', old.public_id, old.user_id, old.team_id, datetime('now') "
+        f"WHERE {condition};"
+    )
+
+# The update trigger sets change_seq itself, recursive triggers are off so it does not fire again
+TODO_SYNC_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS todo_items_sync_insert AFTER INSERT ON todo_items BEGIN "
+    f"{NEXT_CHANGE_SEQ} UPDATE todo_items SET change_seq = {CURRENT_CHANGE_SEQ} WHERE id = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS todo_items_sync_update AFTER UPDATE ON todo_items "
+    "WHEN new.change_seq IS old.change_seq BEGIN "
+    f"{NEXT_CHANGE_SEQ} UPDATE todo_items SET change_seq = {CURRENT_CHANGE_SEQ} WHERE id = new.id; "
+    + _todo_tombstone_statement('old.team_id IS NOT new.team_id OR old.user_id IS NOT new.user_id')
+    + " END",
+    "CREATE TRIGGER IF NOT EXISTS todo_items_sync_delete AFTER DELETE ON todo_items BEGIN "
+    f"{NEXT_CHANGE_SEQ} " + _todo_tombstone_statement() + " END"
+]
+TEAM_MEMBER_SYNC_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS team_members_sync_insert AFTER INSERT ON team_members BEGIN "
+    f"{NEXT_CHANGE_SEQ} UPDATE team_members SET change_seq = {CURRENT_CHANGE_SEQ} "
+    "WHERE team_id = new.team_id AND user_id = new.user_id; END",
+    "CREATE TRIGGER IF NOT EXISTS team_members_sync_delete AFTER DELETE ON team_members BEGIN "
+    f"{NEXT_CHANGE_SEQ} INSERT INTO sync_tombstones (seq, kind, public_id, user_id, team_id, deleted_on) "
+    f"VALUES ({CURRENT_CHANGE_SEQ}, 'membership', NULL, old.user_id, old.team_id, datetime('now')); END"
+]
+for statement in TODO_SYNC_DDL:
+    event.listen(TodoItem.__table__, 'after_create', DDL(statement))
+for statement in TEAM_MEMBER_SYNC_DDL:
+    event.listen(TeamMember.__table__, 'after_create', DDL(statement))
+
+# Apply the pragmas of the storage engine profile to every new SQLite connection of an engine.
+# This also enforces foreign key constraints, which SQLite does not do by default.
+# The engine may use sqlite3 or the aiosqlite adapter, both expose a DB-API cursor here.
+def register_sqlite_pragmas(engine, pragmas: dict) -> None:
+    """Register a connect listener applying the given pragmas to the SQLite engine."""
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
         cursor = dbapi_connection.cursor()
-        cursor.execute("PRAGMA foreign_keys=ON;")
-        cursor.close()
\ No newline at end of file
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value};")
+        cursor.close()
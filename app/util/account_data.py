@@ -0,0 +1,235 @@
+# Account export and import for the api
+#
+# An export is NDJSON, one {"type": ..., "data": ...} record per line: a header,
+# the user, its settings, the teams it belongs to and the todos it owns. Rows
+# are read through yield_per cursors and written as they arrive, so memory does
+# not grow with the account, and every date is written in ISO 8601. An import
+# reads the same format line by line and writes the todos in batches,
+# reporting every rejected line by its number.
+
+import datetime
+from uuid import uuid4
+from flask import current_app
+from sqlalchemy import select, insert, update
+from werkzeug.http import parse_date
+from app.extensions import db
+from app.models import User, Team, TodoItem, Settings
+from app.util.lookups import SETTINGS_COLUMNS, invalidate_settings, user_id_for
+from app.util.memberships import user_team_ids_query
+from app.util.serializers import TEAM_SERIALIZER, TODO_SERIALIZER, dumps, loads
+from app.util.versions import bump_versions
+from app.util.write_queue import run_write, commit_write, after_commit
+
+EXPORT_FORMAT_VERSION = 1
+
+# Fields an import may set on a todo, the owner and creator are always the importing user
+IMPORT_TODO_FIELDS = ['title', 'summary', 'due_date', 'completed', 'priority', 'assigned_to', 'shared_with', 'visibility']
+IMPORT_SETTINGS_FIELDS = ['theme', 'separate_teams_todos', 'hide_completed_todos', 'language', 'timezone']
+
+# Encode one line of an export
+def _record(kind: str, data: dict) -> bytes:
+    return dumps({'type': kind, 'data': data}) + b'\n'
+
+# Export a row with its dates in ISO 8601, the api's HTTP dates stay out of the format
+def _iso_data(names: tuple, row) -> dict:
+    return {
+        name: value.isoformat() if isinstance(value, datetime.datetime) else value
+        for name, value in zip(names, row)
+    }
+
+# Generate the NDJSON export of a user
+def export_lines(user_public_id: str):
+    """Yield the export of the user as NDJSON lines, reading rows in STREAM_YIELD_PER chunks."""
+    yield_per = current_app.config['STREAM_YIELD_PER']
+    yield _record('export', {
+        'version': EXPORT_FORMAT_VERSION,
+        'user_public_id': user_public_id,
+        'exported_on': datetime.datetime.utcnow().isoformat()
+    })
+    user = db.session.execute(
+        select(User.id, User.public_id, User.profile_name, User.email, User.profile_picture_hash, User.joined_on)
+        .where(User.public_id == user_public_id)
+    ).first()
+    if user is None:
+        return
+    yield _record('user', {
+        'public_id': user.public_id,
+        'profile_name': user.profile_name,
+        'email': user.email,
+        'profile_picture': user.profile_picture_hash,
+        'joined_on': user.joined_on.isoformat() if user.joined_on else None
+    })
+    settings = db.session.execute(select(*SETTINGS_COLUMNS).where(User.id == user.id, Settings.user_id == User.id)).first()
+    if settings is not None:
+        yield _record('settings', dict(settings._mapping))
+
+    for kind, serializer, criterion in (
+        ('team', TEAM_SERIALIZER, Team.id.in_(user_team_ids_query(user.id))),
+        ('todo', TODO_SERIALIZER, TodoItem.user_id == user.id)
+    ):
+        names = serializer.field_names
+        result = db.session.execute(
+            serializer.select(names).where(criterion).order_by(serializer.key_column)
+            .execution_options(yield_per=yield_per)
+        )
+        for row in result:
+            yield _record(kind, _iso_data(names, row))
+        result.close()
+
+class ImportReport:
+    """Counts and per-line errors of an import."""
+
+    def __init__(self, max_errors: int):
+        self.max_errors = max_errors
+        self.todos = 0
+        self.settings = False
+        self.skipped = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line: int, message: str) -> None:
+        """Record a rejected line, keeping the first max_errors messages."""
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'error': message})
+
+    def as_dict(self) -> dict:
+        """Return the report as the JSON body of the response."""
+        return {
+            'imported': {'todos': self.todos, 'settings': self.settings},
+            'skipped': self.skipped,
+            'error_count': self.error_count,
+            'errors': self.errors
+        }
+
+# Read the lines of an upload without holding more than one in memory
+def _read_lines(stream, max_bytes: int):
+    number = 0
+    while True:
+        line = stream.readline(max_bytes + 1)
+        if not line:
+            return
+        number += 1
+        if len(line) > max_bytes and not line.endswith(b'\n'):
+            # Drop the rest of the line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_bytes)
+            yield number, None
+            continue
+        yield number, line
+
+# Parse a date written as ISO 8601 or as an HTTP date, the format of the export
+def _parse_date(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if not isinstance(value, str):
+        raise ValueError('Invalid due_date format. Use ISO 8601 format.')
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        parsed = parse_date(value)
+        if parsed is None:
+            raise ValueError('Invalid due_date format. Use ISO 8601 format.')
+        return parsed.replace(tzinfo=None)
+
+# Validate an imported todo, teams maps the public IDs of the user's teams to their ids
+def _todo_values(data: dict, teams: dict) -> dict:
+    values = {field: data[field] for field in IMPORT_TODO_FIELDS if field in data}
+    if not isinstance(values.get('title'), str) or not values['title']:
+        raise ValueError('Title is required')
+    values['due_date'] = _parse_date(values.get('due_date'))
+    if 'completed' in values and not isinstance(values['completed'], bool):
+        raise ValueError('completed must be a boolean')
+    assigned_to = values.pop('assigned_to', None)
+    if assigned_to and (not isinstance(assigned_to, str) or assigned_to not in teams):
+        raise ValueError('Not a member of the assigned team')
+    values['team_id'] = teams[assigned_to] if assigned_to else None
+    public_id = data.get('public_id')
+    if public_id is not None and (not isinstance(public_id, str) or not public_id or len(public_id) > 120):
+        raise ValueError('Invalid public_id')
+    values['public_id'] = public_id or str(uuid4())
+    values.setdefault('completed', False)
+    values.setdefault('priority', 'normal')
+    values.setdefault('visibility', 'public')
+    return values
+
+# Write one batch of imported todos, skipping those whose public_id already exists
+def _write_batch(user_public_id: str, user_id: int, todos: list, settings: dict, report: ImportReport) -> None:
+    taken = set()
+    if todos:
+        taken = set(db.session.scalars(
+            select(TodoItem.public_id).where(TodoItem.public_id.in_([values['public_id'] for _, values in todos]))
+        ))
+    now = datetime.datetime.utcnow()
+    rows = []
+    for line, values in todos:
+        if values['public_id'] in taken:
+            report.error(line, 'Todo already exists')
+            continue
+        taken.add(values['public_id'])
+        values.update(user_id=user_id, created_by=user_public_id, created_on=now)
+        rows.append(values)
+    if rows:
+        db.session.execute(insert(TodoItem), rows)
+    if settings:
+        db.session.execute(update(Settings).where(Settings.user_id == user_id).values(**settings))
+        after_commit(lambda: invalidate_settings(user_public_id))
+    bump_versions(users=[user_id], teams=[values['team_id'] for values in rows])
+    commit_write()
+    report.todos += len(rows)
+    report.settings = report.settings or bool(settings)
+
+# Import an NDJSON upload into a user's account
+def import_lines(user_public_id: str, stream) -> ImportReport:
+    """Import the records of an NDJSON stream, committing every IMPORT_BATCH_SIZE todos.
+
+    Todos and settings are imported; the export header, the user and teams
+    are skipped since they are not the user's to restore. Rejected lines are
+    reported and the rest of the upload still goes in.
+    """
+    config = current_app.config
+    report = ImportReport(config['IMPORT_MAX_ERRORS'])
+    user_id = user_id_for(user_public_id)
+    teams = dict(db.session.execute(
+        select(Team.public_id, Team.id).where(Team.id.in_(user_team_ids_query(user_id)))
+    ).all())
+    todos, settings = [], {}
+    for line, raw in _read_lines(stream, config['IMPORT_MAX_LINE_BYTES']):
+        if raw is None:
+            report.error(line, f"Line longer than {config['IMPORT_MAX_LINE_BYTES']} bytes")
+            continue
+        if not raw.strip():
+            continue
+        try:
+            record = loads(raw)
+        except ValueError:
+            report.error(line, 'Invalid JSON')
+            continue
+        kind = record.get('type') if isinstance(record, dict) else None
+        data = record.get('data') if isinstance(record, dict) else None
+        if not isinstance(data, dict):
+            report.error(line, 'A record needs a type and a data object')
+            continue
+        if kind == 'export':
+            if data.get('version', EXPORT_FORMAT_VERSION) != EXPORT_FORMAT_VERSION:
+                report.error(line, f'Unsupported export version, expected {EXPORT_FORMAT_VERSION}')
+                break
+            report.skipped += 1
+        elif kind in ('user', 'team'):
+            report.skipped += 1
+        elif kind == 'settings':
+            settings.update({field: data[field] for field in IMPORT_SETTINGS_FIELDS if field in data})
+        elif kind == 'todo':
+            try:
+                todos.append((line, _todo_values(data, teams)))
+            except ValueError as e:
+                report.error(line, str(e))
+                continue
+            if len(todos) >= config['IMPORT_BATCH_SIZE']:
+                run_write(_write_batch, user_public_id, user_id, todos, settings, report)
+                todos, settings = [], {}
+        else:
+            report.error(line, f'Unknown record type: {kind}')
+    if todos or settings:
+        run_write(_write_batch, user_public_id, user_id, todos, settings, report)
+    return report
@@ -0,0 +1,63 @@
+# Async database support for the api
+#
+# Used by the ASGI entry point: coroutine views registered with async_view run
+# on the server's event loop with an AsyncSession backed by aiosqlite. They
+# share the models, the select statements and the decorators of the sync views.
+
+from flask import current_app, g
+from sqlalchemy.engine import make_url
+from app.models import register_sqlite_pragmas
+from app.util.metrics import instrument_engine
+
+ASYNC_VIEWS = {}
+
+class UseSyncView(Exception):
+    """Raised by a coroutine view to have the request served by its sync view instead."""
+
+# Register the coroutine version of a view
+def async_view(blueprint, endpoint: str):
+    """Register f as the coroutine served by the ASGI entry point for blueprint.endpoint."""
+    def decorator(f):
+        ASYNC_VIEWS[f'{blueprint.name}.{endpoint}'] = f
+        return f
+    return decorator
+
+# Create the async engine of an app
+def init_async_db(app) -> None:
+    """Create the aiosqlite engine and session factory, sharing the pragmas of the sync engines."""
+    # Imported here so the WSGI app does not require sqlalchemy[asyncio]
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    # Async views only read, so they use the read-only URI when the profile provides one
+    read_only = 'readonly' in app.config['SQLALCHEMY_BINDS']
+    url = make_url(app.config['SQLALCHEMY_BINDS']['readonly'] if read_only else app.config['SQLALCHEMY_DATABASE_URI'])
+    options = {key: value for key, value in app.config['SQLALCHEMY_ENGINE_OPTIONS'].items() if key != 'connect_args'}
+    engine = create_async_engine(url.set(drivername='sqlite+aiosqlite'), **options)
+    register_sqlite_pragmas(
+        engine.sync_engine,
+        app.config['SQLITE_READ_ONLY_PRAGMAS'] if read_only else app.config['SQLITE_PRAGMAS']
+    )
+    instrument_engine(engine.sync_engine)
+    app.extensions['async_db'] = {
+        'engine': engine,
+        'sessionmaker': async_sessionmaker(engine, expire_on_commit=False)
+    }
+
+# The AsyncSession of the current request
+def async_session():
+    """Return the AsyncSession of the current request, opening it on first use."""
+    if '_async_session' not in g:
+        g._async_session = current_app.extensions['async_db']['sessionmaker']()
+    return g._async_session
+
+# Close the AsyncSession of the current request
+async def close_async_session() -> None:
+    """Close the AsyncSession of the current request if one was opened."""
+    session = g.pop('_async_session', None)
+    if session is not None:
+        await session.close()
+
+# Dispose of the async engine
+async def dispose_async_db(app) -> None:
+    """Close every pooled aiosqlite connection of the app."""
+    if 'async_db' in app.extensions:
+        await app.extensions['async_db']['engine'].dispose()
@@ -1 +1,95 @@
-# Authentication utilities for the api
\ No newline at end of file
+# Authentication utilities for the api
+#
+# Password hashing is CPU bound, so it runs in a small process pool instead of
+# the request thread. The number of hashes queued or running is bounded; past
+# that, callers get HashingBusy instead of piling up behind the pool.
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+class HashingBusy(RuntimeError):
+    """Raised when the password hashing queue is full."""
+
+_settings = {
+    'method': 'scrypt:32768:8:1',
+    'workers': 0,
+    'timeout': 10
+}
+_slots = threading.BoundedSemaphore(1)
+_executor = None
+_executor_lock = threading.Lock()
+
+# Build the werkzeug method string from the configured method and cost
+def hash_method_string(method: str, iterations: int) -> str:
+    """Return the werkzeug method string, e.g. 'pbkdf2:sha256:600000' or 'scrypt:32768:8:1'."""
+    if method == 'scrypt':
+        return f'scrypt:{iterations}:8:1'
+    return f'{method}:{iterations}'
+
+# Apply the hashing configuration of an app
+def configure_hashing(config) -> None:
+    """Set the hash method, pool size and queue depth from the application config."""
+    global _slots
+    shutdown_hashing()
+    _settings['method'] = hash_method_string(config['PASSWORD_HASH_METHOD'], config['PASSWORD_HASH_ITERATIONS'])
+    _settings['workers'] = config['PASSWORD_HASH_WORKERS']
+    _settings['timeout'] = config['PASSWORD_HASH_TIMEOUT']
+    _slots = threading.BoundedSemaphore(max(config['PASSWORD_HASH_QUEUE_DEPTH'], 1))
+
+# Stop the hashing pool
+def shutdown_hashing() -> None:
+    """Shut down the process pool, it is recreated on next use."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+# The pool is created on first use so every forked worker gets its own
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawn rather than fork so children do not inherit threads or database handles
+            _executor = ProcessPoolExecutor(
+                max_workers=_settings['workers'],
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+# A forked worker starts without the pool of its parent, whose processes belong to the parent
+def _forget_executor() -> None:
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_executor)
+
+# Run a hashing function in the pool
+def _run(f, *args):
+    if not _settings['workers']:
+        return f(*args)
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy('Password hashing queue is full')
+    try:
+        return _get_executor().submit(f, *args).result(timeout=_settings['timeout'])
+    finally:
+        _slots.release()
+
+# Hash a password with the configured method
+def hash_password(password: str) -> str:
+    """Hash the password with the configured method, off the request thread."""
+    return _run(generate_password_hash, password, _settings['method'])
+
+# Verify a password against a stored hash
+def verify_password(password: str, hashed_password: str) -> bool:
+    """Verify the password against the stored hash, off the request thread."""
+    return _run(check_password_hash, hashed_password, password)
+
+# Check whether a stored hash uses outdated parameters
+def needs_rehash(hashed_password: str) -> bool:
+    """Check whether the stored hash was made with a method other than the configured one."""
+    return hashed_password.split('$', 1)[0] != _settings['method']
@@ -0,0 +1,79 @@
+# Content-addressed blob store for the api
+#
+# Images are stored once on local disk under the SHA-256 of their content,
+# rows only keep the hex digest as a reference.
+
+import hashlib
+import os
+import re
+import tempfile
+from flask import current_app
+from app.util.utility_functions import decode_image_from_base64
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Image signatures used to pick a content type
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'RIFF', 'image/webp')
+]
+
+# Location of a blob on disk
+def blob_path(digest: str, root: str = None) -> str:
+    """Return the file path of the blob with the given digest."""
+    root = root or current_app.config['BLOB_STORE_PATH']
+    return os.path.join(root, digest[:2], digest[2:4], digest)
+
+# Check a digest is well formed
+def is_valid_digest(digest: str) -> bool:
+    """Check that the digest is a lowercase hex SHA-256."""
+    return bool(DIGEST_PATTERN.match(digest or ''))
+
+# Store a blob, deduplicated by content
+def store_blob(data: bytes, root: str = None) -> str:
+    """Write the data to the store unless it is already there, returning its digest."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest, root)
+    if os.path.exists(path):
+        return digest
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file and rename so readers never see a partial blob
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return digest
+
+# Store an image sent as base64 in a JSON payload
+def store_base64_image(image_data) -> str:
+    """Decode and store a base64 image, returning its digest or None when no image is given.
+
+    Raises ValueError when the data is not valid base64 or is too large.
+    """
+    if not image_data:
+        return None
+    data = decode_image_from_base64(image_data)
+    if data is None:
+        raise ValueError('Image must be base64 encoded')
+    if len(data) > current_app.config['MAX_IMAGE_BYTES']:
+        raise ValueError(f"Image must be at most {current_app.config['MAX_IMAGE_BYTES']} bytes")
+    return store_blob(data)
+
+# Guess the content type of a stored blob
+def blob_mimetype(path: str) -> str:
+    """Return the image content type of the blob from its signature."""
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            if mimetype == 'image/webp' and head[8:12] != b'WEBP':
+                continue
+            return mimetype
+    return 'application/octet-stream'
@@ -0,0 +1,120 @@
+# In-process caches for the api
+#
+# Settings and user rows rarely change, so each worker keeps a bounded LRU of
+# them with a TTL. Writers invalidate entries explicitly; the TTL bounds how
+# long another worker can serve a stale entry. The public_id -> id mappings
+# used at the edge of the api never change and are never invalidated.
+
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """Thread-safe bounded LRU cache with a per-entry TTL and hit/miss counters."""
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 60.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize: int, ttl: float) -> None:
+        """Resize the cache and change its TTL, dropping every entry."""
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._entries.clear()
+
+    def get(self, key, default=None):
+        """Return the cached value for the key, or default when it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value) -> None:
+        """Store the value for the key, evicting the least recently used entry when full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for the key, calling loader() and caching its result on a miss.
+
+        A loader result of None is returned but not cached.
+        """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, *keys) -> None:
+        """Drop the given keys from the cache."""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Return the counters of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+# Settings rows keyed by user public_id
+settings_cache = LRUCache('settings')
+# User rows keyed by public_id
+user_cache = LRUCache('users')
+# User public_id keyed by email
+user_email_cache = LRUCache('user_emails')
+# Compressed response bodies keyed by (path, query string, ETag, encoding)
+compressed_cache = LRUCache('compressed_bodies')
+# Internal user and team ids keyed by public_id
+user_key_cache = LRUCache('user_keys')
+team_key_cache = LRUCache('team_keys')
+
+CACHES = [settings_cache, user_cache, user_email_cache, compressed_cache, user_key_cache, team_key_cache]
+
+# Apply the cache configuration of an app
+def configure_caches(config) -> None:
+    """Size the caches from the application config."""
+    settings_cache.configure(config['SETTINGS_CACHE_SIZE'], config['CACHE_TTL'])
+    user_cache.configure(config['USER_CACHE_SIZE'], config['CACHE_TTL'])
+    user_email_cache.configure(config['USER_CACHE_SIZE'], config['CACHE_TTL'])
+    compressed_cache.configure(config['COMPRESSION_CACHE_SIZE'], config['COMPRESSION_CACHE_TTL'])
+    user_key_cache.configure(config['KEY_CACHE_SIZE'], config['KEY_CACHE_TTL'])
+    team_key_cache.configure(config['KEY_CACHE_SIZE'], config['KEY_CACHE_TTL'])
+
+# Counters of every cache
+def cache_stats() -> dict:
+    """Return the stats of every cache keyed by name."""
+    return {cache.name: cache.stats() for cache in CACHES}
@@ -0,0 +1,141 @@
+# Response compression for the api
+#
+# JSON and text bodies of at least COMPRESSION_MIN_SIZE bytes are compressed
+# with the best encoding the client accepts: zstd when the zstandard package is
+# installed, otherwise gzip. Streamed bodies are compressed chunk by chunk. A
+# response carrying an ETag is a fixed representation, so its compressed body is
+# cached under its URL and ETag and each payload is compressed once per worker.
+
+import zlib
+from flask import request
+from app.util.cache import compressed_cache
+from app.util.metrics import COMPRESSION_INPUT, COMPRESSION_OUTPUT
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+
+_settings = {'min_size': 1024, 'gzip_level': 5, 'zstd_level': 3, 'max_entry_bytes': 256 * 1024}
+
+# Encodings in order of preference when the client accepts several equally
+def available_encodings() -> tuple:
+    """Return the content codings this worker can produce."""
+    return ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+# Pick the content coding of a response
+def negotiate_encoding(accept_encodings) -> str:
+    """Return the available encoding with the highest quality in Accept-Encoding, None for identity."""
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+# Start an incremental compressor
+def compressor(encoding: str):
+    """Return an object whose compress(data) and flush() produce the encoded stream."""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=_settings['zstd_level']).compressobj()
+    # wbits=31 writes the gzip container, with a zero mtime so equal bodies compress equally
+    return zlib.compressobj(_settings['gzip_level'], zlib.DEFLATED, 31)
+
+# Compress a whole body
+def compress(data: bytes, encoding: str) -> bytes:
+    """Return data encoded with the given content coding."""
+    c = compressor(encoding)
+    return c.compress(data) + c.flush()
+
+# Register compression on an app
+def init_compression(app) -> None:
+    """Compress the responses of the app according to its COMPRESSION_* settings."""
+    _settings['min_size'] = app.config['COMPRESSION_MIN_SIZE']
+    _settings['gzip_level'] = app.config['COMPRESSION_GZIP_LEVEL']
+    _settings['zstd_level'] = app.config['COMPRESSION_ZSTD_LEVEL']
+    _settings['max_entry_bytes'] = app.config['COMPRESSION_CACHE_MAX_ENTRY_BYTES']
+    app.after_request(compress_response)
+
+# Compress a response when the client accepts it
+def compress_response(response):
+    """after_request handler encoding the body of the response with the negotiated coding."""
+    if not _compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    etag, weak = response.get_etag()
+    # An ETag only identifies a representation together with its URL
+    key = (request.path, request.query_string, etag, encoding) if etag else None
+    body = compressed_cache.get(key) if key else None
+
+    if body is None and response.is_streamed:
+        response.response = _compress_chunks(response.response, encoding, key)
+        response.headers.pop('Content-Length', None)
+    else:
+        if body is None:
+            data = response.get_data()
+            if len(data) < _settings['min_size']:
+                return response
+            body = compress(data, encoding)
+            COMPRESSION_INPUT.inc(encoding, amount=len(data))
+            COMPRESSION_OUTPUT.inc(encoding, amount=len(body))
+            if key and len(body) <= _settings['max_entry_bytes']:
+                compressed_cache.set(key, body)
+        elif response.is_streamed:
+            # The cached body replaces the stream, which is closed unread
+            _close(response.response)
+        response.set_data(body)
+
+    response.headers['Content-Encoding'] = encoding
+    # The encoded body is no longer byte-identical to the identity one
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Only successful text bodies that nothing else has encoded are compressed
+def _compressible(response) -> bool:
+    mimetype = response.mimetype or ''
+    return (
+        200 <= response.status_code < 300 and response.status_code != 204
+        and request.method != 'HEAD'
+        and not response.direct_passthrough
+        and 'Content-Encoding' not in response.headers
+        and not response.cache_control.no_transform
+        and (mimetype in COMPRESSIBLE_MIMETYPES or mimetype.startswith('text/'))
+    )
+
+# Encode a streamed body, caching it under its key once fully sent
+def _compress_chunks(chunks, encoding: str, key):
+    c = compressor(encoding)
+    kept = [] if key else None
+    received = sent = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            received += len(chunk)
+            out = c.compress(chunk)
+            if out:
+                sent += len(out)
+                if kept is not None:
+                    kept.append(out)
+                    kept = kept if sent <= _settings['max_entry_bytes'] else None
+                yield out
+        out = c.flush()
+        sent += len(out)
+        if kept is not None and sent <= _settings['max_entry_bytes']:
+            compressed_cache.set(key, b''.join(kept) + out)
+        yield out
+    finally:
+        _close(chunks)
+        COMPRESSION_INPUT.inc(encoding, amount=received)
+        COMPRESSION_OUTPUT.inc(encoding, amount=sent)
+
+# Release a body iterable that will not be read to the end
+def _close(chunks) -> None:
+    if hasattr(chunks, 'close'):
+        chunks.close()
@@ -0,0 +1,77 @@
+# Todo counters for the api
+#
+# todo_counters holds per user and per team counts of todos by status,
+# priority and due day. Triggers on todo_items keep it current in the
+# transaction of every write, so dashboards read a few rows instead of
+# counting todo_items.
+
+import datetime
+from sqlalchemy import select, or_, and_
+from app.extensions import db
+from app.models import Team, TodoCounter, TODO_COUNTER_SCOPES, TODO_COUNTER_BUCKETS
+from app.util.filters import PRIORITIES
+from app.util.memberships import user_team_ids_query
+
+# Recount every counter from todo_items
+def rebuild_todo_counters(connection) -> int:
+    """Replace the contents of todo_counters with fresh counts, returning the number of counter rows."""
+    connection.exec_driver_sql('DELETE FROM todo_counters')
+    for scope, column in TODO_COUNTER_SCOPES:
+        for bucket, condition in TODO_COUNTER_BUCKETS:
+            bucket = bucket.format(row='todo_items')
+            condition = condition.format(row='todo_items')
+            connection.exec_driver_sql(
+                f"INSERT INTO todo_counters (scope, ref_id, bucket, count) "
+                f"SELECT '{scope}', {column}, {bucket}, count(*) FROM todo_items "
+                f"WHERE {column} IS NOT NULL AND {condition} GROUP BY {column}, {bucket}"
+            )
+    return connection.exec_driver_sql('SELECT count(*) FROM todo_counters').scalar()
+
+# Fold counter rows into the stats of one user or team
+def _stats(counts: dict, today: str) -> dict:
+    overdue = 0
+    due_today = 0
+    for bucket, count in counts.items():
+        if bucket.startswith('due:'):
+            day = bucket[4:]
+            if day < today:
+                overdue += count
+            elif day == today:
+                due_today += count
+    return {
+        'total': counts.get('total', 0),
+        'open': counts.get('open', 0),
+        'completed': counts.get('completed', 0),
+        'overdue': overdue,
+        'due_today': due_today,
+        'open_by_priority': {priority: counts.get(f'open:{priority}', 0) for priority in PRIORITIES}
+    }
+
+# Read the dashboard counters of a user
+def todo_stats(user_id: int) -> dict:
+    """Return the counts of the user's own todos and of the todos of each of their teams.
+
+    Overdue counts open todos due before today (UTC), due_today those due today.
+    Teams without any todos are left out, the others are keyed by public ID.
+    """
+    team_public_id = (
+        select(Team.public_id).where(TodoCounter.scope == 'team', Team.id == TodoCounter.ref_id).scalar_subquery()
+    )
+    rows = db.session.execute(
+        select(TodoCounter.scope, TodoCounter.ref_id, team_public_id, TodoCounter.bucket, TodoCounter.count)
+        .where(or_(
+            and_(TodoCounter.scope == 'user', TodoCounter.ref_id == user_id),
+            and_(TodoCounter.scope == 'team', TodoCounter.ref_id.in_(user_team_ids_query(user_id)))
+        ))
+    ).all()
+    counts = {}
+    for scope, ref_id, public_id, bucket, count in rows:
+        counts.setdefault((scope, public_id or ref_id), {})[bucket] = count
+    today = datetime.datetime.utcnow().date().isoformat()
+    return {
+        'own': _stats(counts.get(('user', user_id), {}), today),
+        'teams': {
+            public_id: _stats(team_counts, today)
+            for (scope, public_id), team_counts in counts.items() if scope == 'team'
+        }
+    }
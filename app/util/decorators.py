@@ -1,11 +1,113 @@
+import datetime
+import hmac
+import inspect
 from functools import wraps
-from flask import session, jsonify
+from flask import session, jsonify, request, make_response, Response, g, current_app
+from app.extensions import db
+from app.util.async_db import async_session
+from app.util.lookups import session_user_active, session_user_active_cached
+from app.util.versions import version_etag
+
+# Requests whose session belongs to no live account
+def _logged_out(active) -> bool:
+    public_id = session.get('user_public_id')
+    if public_id is None:
+        return True
+    # Writes check the database, a deleted account must not add rows the purger would miss
+    if not active(public_id, request.method not in ('GET', 'HEAD')):
+        session.pop('user_public_id', None)
+        return True
+    return False
 
 # Decorators for the api
 def login_required(f):
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def decorated_coroutine(*args, **kwargs):
+            if _logged_out(lambda public_id, fresh: session_user_active_cached(public_id)):
+                return jsonify({'error': 'You must be logged in to access this page.'}), 401
+            return await f(*args, **kwargs)
+        return decorated_coroutine
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_public_id' not in session:
+        if _logged_out(session_user_active):
             return jsonify({'error': 'You must be logged in to access this page.'}), 401
         return f(*args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
+
+# Restrict operational endpoints to internal callers holding the system token
+def system_token_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = current_app.config['SYSTEM_TOKEN']
+        if not token:
+            return jsonify({'error': 'Not found'}), 404
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8')):
+            return jsonify({'error': 'A valid system token is required.'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Answer conditional GETs from resource versions without running the handler
+def etag_conditional(versions_for, unless=None):
+    """Set ETag/Last-Modified from the versions selected by versions_for(**kwargs) and return 304 when they match.
+
+    Requests for which unless() is true are served without validators, for
+    responses that change with more than the versions, such as the clock.
+    """
+    def decorator(f):
+        if inspect.iscoroutinefunction(f):
+            @wraps(f)
+            async def decorated_coroutine(*args, **kwargs):
+                if unless is not None and unless():
+                    return await f(*args, **kwargs)
+                result = await async_session().execute(versions_for(**kwargs))
+                etag, last_modified, not_modified = _check_versions(result.all())
+                response = None if not_modified else make_response(await f(*args, **kwargs))
+                return _conditional_response(response, etag, last_modified)
+            return decorated_coroutine
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if unless is not None and unless():
+                return f(*args, **kwargs)
+            versions = db.session.execute(versions_for(**kwargs)).all()
+            etag, last_modified, not_modified = _check_versions(versions)
+            response = None if not_modified else make_response(f(*args, **kwargs))
+            return _conditional_response(response, etag, last_modified)
+        return decorated_function
+    return decorator
+
+# Compare the request validators with the current versions
+def _check_versions(versions: list) -> tuple:
+    # Views reading cached rows check them against these versions, see request_version
+    g.resource_versions = versions
+    # The path tells apart the representations of one endpoint, such as two todos of the same user
+    etag, last_modified = version_etag(
+        request.endpoint,
+        session.get('user_public_id'),
+        request.path,
+        request.query_string.decode('utf-8'),
+        versions=versions
+    )
+    if request.if_none_match:
+        # Weak comparison, compressed responses carry the weak form of the ETag
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = (last_modified is not None and request.if_modified_since is not None
+                        and last_modified.replace(microsecond=0, tzinfo=datetime.timezone.utc) <= request.if_modified_since)
+    return etag, last_modified, not_modified
+
+# Attach the validators, or answer 304 when there is no response
+def _conditional_response(response, etag: str, last_modified):
+    if response is None:
+        response = Response(status=304)
+    elif response.status_code != 200:
+        return response
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
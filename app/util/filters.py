@@ -0,0 +1,136 @@
+# Todo list filters for the api
+#
+# GET /todos/ query parameters become SQL criteria and a keyset order, so the
+# filtering happens on the owner and assignee indexes instead of in clients.
+# The user's settings provide the defaults: hide_completed_todos lists open
+# items only and separate_teams_todos leaves team todos to /todos/team/<id>.
+
+import datetime
+from sqlalchemy import case, false, func
+from app.models import TodoItem
+from app.util.lookups import team_id_for
+from app.util.memberships import user_team_ids_query
+from app.util.pagination import SortOrder
+
+PRIORITIES = ['high', 'normal', 'low']
+VISIBILITIES = ['public', 'private', 'team']
+SCOPES = ['all', 'own', 'teams']
+
+# Undated todos sort after every dated one in both directions
+LATEST = datetime.datetime(9999, 12, 31)
+EARLIEST = datetime.datetime(1, 1, 1)
+
+class InvalidFilter(ValueError):
+    """Raised when a filter or sort parameter is malformed."""
+
+# Sort keys a client may order by
+def _sort_expression(key: str, descending: bool):
+    if key == 'due_date':
+        return func.coalesce(TodoItem.due_date, EARLIEST if descending else LATEST), _dump_datetime, _load_datetime
+    if key == 'created_on':
+        return func.coalesce(TodoItem.created_on, EARLIEST if descending else LATEST), _dump_datetime, _load_datetime
+    if key == 'priority':
+        # Sort by urgency rather than alphabetically
+        rank = case(*[(TodoItem.priority == name, index) for index, name in enumerate(PRIORITIES)], else_=len(PRIORITIES))
+        return rank, None, None
+    if key == 'title':
+        return TodoItem.title, None, None
+    raise InvalidFilter(f"Unknown sort key '{key}', use id, due_date, created_on, priority or title")
+
+def _dump_datetime(value) -> str:
+    return value.isoformat()
+
+def _load_datetime(value) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value)
+
+def _parse_bool(name: str, value: str) -> bool:
+    lowered = value.lower()
+    if lowered in ('1', 'true', 'yes'):
+        return True
+    if lowered in ('0', 'false', 'no'):
+        return False
+    raise InvalidFilter(f'{name} must be true or false')
+
+def _parse_choices(name: str, value: str, choices: list) -> list:
+    values = [item.strip() for item in value.split(',') if item.strip()]
+    unknown = [item for item in values if item not in choices]
+    if unknown or not values:
+        raise InvalidFilter(f"{name} must be a comma separated list of {', '.join(choices)}")
+    return values
+
+def _parse_datetime(name: str, value: str) -> datetime.datetime:
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise InvalidFilter(f'{name} must be an ISO 8601 date')
+
+# Filters whose result changes with the clock rather than with the data
+def time_dependent(args) -> bool:
+    """Check whether the filter parameters compare against the current time."""
+    return bool(args.get('overdue'))
+
+# Build the criteria and order of a todo listing
+def todo_filters(args, user_id: int, settings: dict = None) -> tuple:
+    """Return (criteria, order) for the filter parameters in args, defaulting to the user's settings.
+
+    completed=true|false|all      hide_completed_todos defaults it to false
+    priority=high,normal,low      visibility=public,private,team
+    due_after=, due_before=       ISO 8601, due_after inclusive, due_before exclusive
+    overdue=true|false            due before now and not completed
+    assigned_to=<team>|none|any   team todos, unassigned todos or any team
+    scope=all|own|teams           separate_teams_todos defaults it to own
+    sort=id|due_date|created_on|priority|title, prefixed with - to reverse
+    """
+    settings = settings or {}
+    criteria = []
+
+    completed = args.get('completed')
+    if completed is None and settings.get('hide_completed_todos'):
+        completed = 'false'
+    if completed is not None and completed.lower() != 'all':
+        criteria.append(TodoItem.completed == _parse_bool('completed', completed))
+
+    scope = args.get('scope') or ('own' if settings.get('separate_teams_todos') else 'all')
+    if scope not in SCOPES:
+        raise InvalidFilter(f"scope must be one of {', '.join(SCOPES)}")
+    team_ids = user_team_ids_query(user_id)
+    if scope == 'own':
+        criteria.append(TodoItem.user_id == user_id)
+    elif scope == 'teams':
+        criteria.append(TodoItem.team_id.in_(team_ids))
+    else:
+        criteria.append((TodoItem.user_id == user_id) | (TodoItem.team_id.in_(team_ids)))
+
+    if args.get('priority'):
+        criteria.append(TodoItem.priority.in_(_parse_choices('priority', args['priority'], PRIORITIES)))
+    if args.get('visibility'):
+        criteria.append(TodoItem.visibility.in_(_parse_choices('visibility', args['visibility'], VISIBILITIES)))
+    if args.get('due_after'):
+        criteria.append(TodoItem.due_date >= _parse_datetime('due_after', args['due_after']))
+    if args.get('due_before'):
+        criteria.append(TodoItem.due_date < _parse_datetime('due_before', args['due_before']))
+    if args.get('overdue'):
+        overdue = (TodoItem.due_date < datetime.datetime.utcnow()) & (TodoItem.completed == False)
+        criteria.append(overdue if _parse_bool('overdue', args['overdue']) else ~overdue | (TodoItem.due_date == None))
+
+    assigned_to = args.get('assigned_to')
+    if assigned_to == 'none':
+        criteria.append(TodoItem.team_id == None)
+    elif assigned_to == 'any':
+        criteria.append(TodoItem.team_id != None)
+    elif assigned_to:
+        team_id = team_id_for(assigned_to)
+        # An unknown team matches nothing rather than the unassigned todos
+        criteria.append(TodoItem.team_id == team_id if team_id is not None else false())
+
+    order = None
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    key = sort.lstrip('-')
+    if key != 'id' or descending:
+        if key == 'id':
+            order = SortOrder(TodoItem.id, descending=True)
+        else:
+            expression, dump, load = _sort_expression(key, descending)
+            order = SortOrder(expression, descending, dump, load)
+    return criteria, order
@@ -0,0 +1,193 @@
+# Cached lookups for the api
+#
+# Rows reference users and teams by their integer ids, the api by their
+# public_id. The translation happens here, at the edge, through caches of the
+# public_id -> id mapping, which never changes since ids are never reused.
+
+from flask import session
+from sqlalchemy import select, func
+from app.extensions import db
+from app.models import User, Team, Settings, ResourceVersion, name_key
+from app.util.async_db import async_session, UseSyncView
+from app.util.cache import settings_cache, user_cache, user_email_cache, user_key_cache, team_key_cache
+
+USER_COLUMNS = (User.id, User.public_id, User.profile_name, User.email, User.password, User.profile_picture_hash)
+USER_LOOKUP_COLUMNS = (User.public_id, User.profile_name, User.profile_picture_hash)
+# Selected joined to the user, see _settings_query
+SETTINGS_COLUMNS = (
+    Settings.public_id,
+    User.public_id.label('user_public_id'),
+    Settings.theme,
+    Settings.separate_teams_todos,
+    Settings.hide_completed_todos,
+    Settings.language,
+    Settings.timezone
+)
+
+# Accounts waiting for the purger are gone for every lookup
+ACTIVE_USER = User.deleted_on.is_(None)
+
+# Load a single row as a dict
+def _load_row(columns: tuple, *criteria) -> dict:
+    row = db.session.execute(select(*columns).where(*criteria).limit(1)).first()
+    return dict(row._mapping) if row is not None else None
+
+# Translate a user public id to its internal id
+def user_id_for(public_id: str) -> int:
+    """Return the cached users.id of the public id, or None when there is no such user."""
+    if not public_id:
+        return None
+    return user_key_cache.get_or_load(
+        public_id,
+        lambda: db.session.scalar(select(User.id).where(User.public_id == public_id))
+    )
+
+# Translate a team public id to its internal id
+def team_id_for(public_id: str) -> int:
+    """Return the cached teams.id of the public id, or None when there is no such team."""
+    if not public_id or not isinstance(public_id, str):
+        return None
+    return team_key_cache.get_or_load(
+        public_id,
+        lambda: db.session.scalar(select(Team.id).where(Team.public_id == public_id))
+    )
+
+# The internal id of the logged in user
+def current_user_id() -> int:
+    """Return the users.id of the session user, or None."""
+    return user_id_for(session.get('user_public_id'))
+
+# The internal id of the logged in user for a coroutine view
+def current_user_id_cached() -> int:
+    """Return the users.id of the session user from the cache, raising UseSyncView on a miss.
+
+    Coroutine views do not read through the sync session, the sync view loads
+    the mapping instead and later requests find it cached.
+    """
+    public_id = session.get('user_public_id')
+    user_id = user_key_cache.get(public_id) if public_id else None
+    if user_id is None:
+        raise UseSyncView()
+    return user_id
+
+# Look up a user by public id
+def get_user_row(public_id: str) -> dict:
+    """Return the cached user row for the public id, or None."""
+    user = user_cache.get(public_id)
+    if user is None:
+        user = _load_row(USER_COLUMNS, User.public_id == public_id, ACTIVE_USER)
+        if user is not None:
+            user_cache.set(public_id, user)
+            user_key_cache.set(public_id, user['id'])
+    return user
+
+# Check that the account of a session has not been deleted
+def session_user_active(public_id: str, fresh: bool = False) -> bool:
+    """Return whether the account is live, reading the row again when fresh.
+
+    Writes ask for a fresh row, a worker whose cache still holds a deleted
+    account must not insert rows referencing it once it is purged.
+    """
+    if fresh:
+        user_cache.invalidate(public_id)
+    return get_user_row(public_id) is not None
+
+# Check the account of a session for a coroutine view
+def session_user_active_cached(public_id: str) -> bool:
+    """Return whether the cached account is live, raising UseSyncView on a miss."""
+    if user_cache.get(public_id) is None:
+        raise UseSyncView()
+    return True
+
+# Look up a user by email
+def get_user_row_by_email(email: str) -> dict:
+    """Return the cached user row for the email, or None."""
+    public_id = user_email_cache.get(email)
+    if public_id is not None:
+        user = get_user_row(public_id)
+        if user is not None and user['email'] == email:
+            return user
+    user = _load_row(USER_COLUMNS, User.email == email, ACTIVE_USER)
+    if user is not None:
+        user_cache.set(user['public_id'], user)
+        user_email_cache.set(email, user['public_id'])
+        # Logging in primes the mapping the following requests translate the session with
+        user_key_cache.set(user['public_id'], user['id'])
+    return user
+
+# Settings row of a user with the version of the user it was read at
+def _settings_query(user_public_id: str):
+    version = func.coalesce(ResourceVersion.version, 0).label('version')
+    return (
+        select(*SETTINGS_COLUMNS, version)
+        .join(User, User.id == Settings.user_id)
+        .outerjoin(ResourceVersion, (ResourceVersion.scope == 'user') & (ResourceVersion.ref_id == User.id))
+        .where(User.public_id == user_public_id)
+        .limit(1)
+    )
+
+# Split a loaded row into the (version, settings) cache entry
+def _settings_entry(row) -> tuple:
+    if row is None:
+        return None
+    settings = dict(row._mapping)
+    return settings.pop('version'), settings
+
+# Look up the settings of a user
+def get_settings_row(user_public_id: str, version: int = None) -> dict:
+    """Return the cached settings row of the user, or None.
+
+    With the version of the user the request's ETag was built from, an entry
+    cached at another version is reloaded, so a write served by another worker
+    never leaves a stale body behind a fresh ETag.
+    """
+    entry = settings_cache.get(user_public_id)
+    if entry is None or (version is not None and entry[0] != version):
+        entry = _settings_entry(db.session.execute(_settings_query(user_public_id)).first())
+        if entry is not None:
+            settings_cache.set(user_public_id, entry)
+    return entry[1] if entry is not None else None
+
+# Look up the settings of a user from an async view
+async def get_settings_row_async(user_public_id: str, version: int = None) -> dict:
+    """Return the cached settings row of the user, loading it through the AsyncSession on a miss or a version change."""
+    entry = settings_cache.get(user_public_id)
+    if entry is None or (version is not None and entry[0] != version):
+        result = await async_session().execute(_settings_query(user_public_id))
+        entry = _settings_entry(result.first())
+        if entry is not None:
+            settings_cache.set(user_public_id, entry)
+    return entry[1] if entry is not None else None
+
+# Drop a user from the caches
+def invalidate_user(public_id: str, *emails) -> None:
+    """Invalidate the cached user row, its email mappings and its settings."""
+    user_cache.invalidate(public_id)
+    user_email_cache.invalidate(*emails)
+    settings_cache.invalidate(public_id)
+
+# Drop the settings of a user from the cache
+def invalidate_settings(user_public_id: str) -> None:
+    """Invalidate the cached settings row of the user."""
+    settings_cache.invalidate(user_public_id)
+
+# Find users whose profile name starts with a prefix
+def lookup_users_by_prefix(prefix: str, limit: int) -> list:
+    """Return up to limit users whose case-folded profile name starts with the case-folded prefix.
+
+    The prefix becomes a range on the indexed profile_name_key, so the cost
+    depends on limit rather than on the number of users.
+    """
+    low = name_key(prefix)
+    # Every key starting with the prefix sorts between it and the prefix followed by the last code point
+    high = low + '\U0010ffff'
+    rows = db.session.execute(
+        select(*USER_LOOKUP_COLUMNS)
+        .where(User.profile_name_key >= low, User.profile_name_key <= high, ACTIVE_USER)
+        .order_by(User.profile_name_key, User.id)
+        .limit(limit)
+    ).all()
+    return [
+        {'public_id': row.public_id, 'profile_name': row.profile_name, 'profile_picture': row.profile_picture_hash}
+        for row in rows
+    ]
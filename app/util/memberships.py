@@ -0,0 +1,112 @@
+# Team membership utilities for the api
+
+import datetime
+from sqlalchemy import select, case, func, true
+from app.extensions import db
+from app.models import Team, TeamMember, User
+
+# Subquery of the teams a user belongs to
+def user_team_ids_query(user_id: int):
+    """Return a select of the ids of the teams the user is a member of."""
+    return select(TeamMember.team_id).where(TeamMember.user_id == user_id)
+
+# List the teams a user belongs to
+def user_team_ids(user_id: int) -> list:
+    """Return the ids of every team the user is a member of."""
+    return list(db.session.scalars(user_team_ids_query(user_id)))
+
+# Check team membership
+def is_team_member(team_id: int, user_id: int) -> bool:
+    """Check whether the user is a member of the team."""
+    if team_id is None or user_id is None:
+        return False
+    return db.session.get(TeamMember, (team_id, user_id)) is not None
+
+# List the members of a team
+def team_members(team_id: int) -> dict:
+    """Return the members of the team as {user public ID: user id}."""
+    return dict(db.session.execute(
+        select(User.public_id, TeamMember.user_id)
+        .join(User, User.id == TeamMember.user_id)
+        .where(TeamMember.team_id == team_id)
+    ).all())
+
+# Translate the member list of a request
+def resolve_members(member_ids: list) -> tuple:
+    """Return ({public ID: user id}, unknown) for the member public IDs, deleted accounts count as unknown."""
+    member_ids = list(dict.fromkeys(member_ids))
+    if not member_ids:
+        return {}, []
+    known = dict(db.session.execute(
+        select(User.public_id, User.id).where(User.public_id.in_(member_ids), User.deleted_on.is_(None))
+    ).all())
+    members = {member_id: known[member_id] for member_id in member_ids if member_id in known}
+    return members, [member_id for member_id in member_ids if member_id not in known]
+
+# Add a single member to a team
+def add_team_member(team: Team, user: User, role: str = 'member') -> None:
+    """Add a member to the team and keep the members column in sync."""
+    db.session.add(TeamMember(
+        team_id=team.id,
+        user_id=user.id,
+        role=role,
+        joined_on=datetime.datetime.utcnow()
+    ))
+    # Assign a new list so the JSON column change is detected
+    team.members = (team.members or []) + [user.public_id]
+
+# Replace the full member list of a team
+def set_team_members(team: Team, members: dict) -> None:
+    """Sync the membership rows of the team with the given {public ID: user id} members.
+
+    The team must have been flushed so it has its id.
+    """
+    current = set(db.session.scalars(
+        select(TeamMember.user_id).where(TeamMember.team_id == team.id)
+    ))
+    removed = current.difference(members.values())
+    if removed:
+        db.session.execute(
+            TeamMember.__table__.delete().where(
+                TeamMember.team_id == team.id,
+                TeamMember.user_id.in_(removed)
+            )
+        )
+    now = datetime.datetime.utcnow()
+    db.session.add_all([
+        TeamMember(
+            team_id=team.id,
+            user_id=user_id,
+            role='owner' if user_id == team.owner_id else 'member',
+            joined_on=now
+        ) for user_id in members.values() if user_id not in current
+    ])
+    # The legacy column keeps the public IDs the api returns
+    team.members = list(members)
+
+# Backfill the membership table from the legacy members column
+def backfill_team_members(connection=None) -> int:
+    """Create membership rows for every entry of Team.members, returning the number inserted.
+
+    Runs on the given connection when called from a migration, otherwise on the session and commits.
+    """
+    executor = connection if connection is not None else db.session
+    members = func.json_each(Team.members).table_valued('value')
+    rows = (
+        select(
+            Team.id,
+            User.id,
+            case((User.id == Team.owner_id, 'owner'), else_='member'),
+            func.coalesce(Team.created_on, datetime.datetime.utcnow())
+        )
+        .select_from(Team)
+        .join(members, true())
+        .join(User, User.public_id == members.c.value)
+    )
+    result = executor.execute(
+        TeamMember.__table__.insert().prefix_with('OR IGNORE')
+        .from_select(['team_id', 'user_id', 'role', 'joined_on'], rows)
+    )
+    if connection is None:
+        db.session.commit()
+    return result.rowcount
@@ -0,0 +1,290 @@
+# Request and database instrumentation for the api
+#
+# Every request records its latency, the SQL statements it issued and the time
+# they spent waiting for the SQLite write lock. Recording is a few counter
+# updates under a lock; the Prometheus text is only rendered when /metrics is
+# scraped. Metrics are kept per worker process, like the caches.
+
+import bisect
+import datetime
+import logging
+import threading
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from app.util.cache import cache_stats
+
+logger = logging.getLogger('app.metrics')
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+OPERATIONS = ('select', 'insert', 'update', 'delete', 'replace')
+WRITE_STATEMENTS = ('insert', 'update', 'delete', 'replace')
+MAX_RECORDED_STATEMENTS = 50
+
+class Counter:
+    """Thread-safe labelled counter."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        """Add amount to the counter of the label values."""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        """Yield (suffix, labels, value) for the exposition format."""
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield '', dict(zip(self.labels, label_values)), value
+
+class Collected:
+    """Metric whose samples are read from elsewhere when scraped."""
+
+    def __init__(self, name: str, help: str, type: str, samples):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.samples = samples
+
+class Histogram:
+    """Thread-safe labelled histogram with fixed buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        """Record one observation for the label values."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        """Yield (suffix, labels, value) for the exposition format, with cumulative buckets."""
+        with self._lock:
+            values = [(label_values, list(counts), total) for label_values, (counts, total) in self._values.items()]
+        for label_values, counts, total in values:
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', {**labels, 'le': _format_value(bound)}, cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+REQUEST_DURATION = Histogram(
+    'todone_http_request_duration_seconds', 'Time spent handling a request, streaming included.',
+    ('endpoint', 'method', 'status')
+)
+REQUEST_STATEMENTS = Histogram(
+    'todone_http_request_sql_statements', 'SQL statements issued per request.',
+    ('endpoint',), COUNT_BUCKETS
+)
+STATEMENT_DURATION = Histogram(
+    'todone_db_statement_duration_seconds', 'Time spent executing SQL statements.',
+    ('endpoint', 'operation')
+)
+LOCK_WAIT = Histogram(
+    'todone_db_write_lock_seconds',
+    'Time spent in the statements that took the SQLite write lock of their transaction, busy waits included.',
+    ('endpoint',)
+)
+LOCK_ERRORS = Counter('todone_db_lock_errors_total', 'Statements that failed because the database was locked.', ('endpoint',))
+SLOW_REQUESTS = Counter('todone_slow_requests_total', 'Requests slower than SLOW_REQUEST_SECONDS.', ('endpoint',))
+SLOW_STATEMENTS = Counter('todone_slow_sql_statements_total', 'SQL statements slower than SLOW_QUERY_SECONDS.', ('endpoint',))
+
+WRITE_BATCH_SIZE = Histogram('todone_write_batch_size', 'Units of work committed together by the write queue.', (), COUNT_BUCKETS)
+WRITE_QUEUE_WAIT = Histogram(
+    'todone_write_queue_wait_seconds', 'Time a unit of work waited in the write queue before it ran.', ('endpoint',)
+)
+WRITE_BATCH_COMMIT = Histogram('todone_write_batch_commit_seconds', 'Time spent committing a batch of the write queue.')
+
+COMPRESSION_INPUT = Counter('todone_compression_input_bytes_total', 'Response bytes before compression.', ('encoding',))
+COMPRESSION_OUTPUT = Counter('todone_compression_output_bytes_total', 'Response bytes sent after compression.', ('encoding',))
+
+PURGE_ROWS = Counter('todone_purge_rows_total', 'Rows removed by the background purger.', ('table',))
+
+# Per-cache counters, read from the caches on scrape
+def _cache_samples(key: str):
+    def samples():
+        for name, stats in cache_stats().items():
+            yield '', {'cache': name}, stats[key]
+    return samples
+
+CACHE_HITS = Collected('todone_cache_hits_total', 'Cache lookups answered from the cache.', 'counter', _cache_samples('hits'))
+CACHE_MISSES = Collected('todone_cache_misses_total', 'Cache lookups that went to the database.', 'counter', _cache_samples('misses'))
+CACHE_EVICTIONS = Collected('todone_cache_evictions_total', 'Entries evicted to stay within the cache size.', 'counter', _cache_samples('evictions'))
+CACHE_ENTRIES = Collected('todone_cache_entries', 'Entries currently cached.', 'gauge', _cache_samples('size'))
+
+# Import and boot durations of the worker, recorded once by the app factory
+_startup = {}
+
+def _startup_samples():
+    for phase, seconds in list(_startup.items()):
+        yield '', {'phase': phase}, seconds
+
+STARTUP_DURATION = Collected('todone_startup_seconds', 'Time spent importing the app and creating it.', 'gauge', _startup_samples)
+
+# Purge queue as seen by the last pass of this worker's purger
+_purge_queue = {'pending': 0, 'oldest_requested': None}
+
+def _purge_pending_samples():
+    yield '', {}, _purge_queue['pending']
+
+def _purge_lag_samples():
+    oldest = _purge_queue['oldest_requested']
+    yield '', {}, (datetime.datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+
+PURGE_PENDING = Collected('todone_purge_pending_jobs', 'Deleted accounts and teams not purged yet.', 'gauge', _purge_pending_samples)
+PURGE_LAG = Collected('todone_purge_lag_seconds', 'Age of the oldest purge job not finished yet.', 'gauge', _purge_lag_samples)
+
+METRICS = [
+    REQUEST_DURATION, REQUEST_STATEMENTS, STATEMENT_DURATION, LOCK_WAIT, LOCK_ERRORS, SLOW_REQUESTS, SLOW_STATEMENTS,
+    WRITE_BATCH_SIZE, WRITE_QUEUE_WAIT, WRITE_BATCH_COMMIT, COMPRESSION_INPUT, COMPRESSION_OUTPUT,
+    PURGE_ROWS, PURGE_PENDING, PURGE_LAG,
+    CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS, CACHE_ENTRIES, STARTUP_DURATION
+]
+
+_settings = {'slow_request': 0.5, 'slow_query': 0.1}
+
+# The endpoint label of the current request, bounded to the routes of the app
+def _endpoint() -> str:
+    if not has_request_context():
+        return 'none'
+    return request.endpoint or 'unmatched'
+
+# Start timing a request
+def _start_request() -> None:
+    g._metrics = {'start': time.perf_counter(), 'statements': [], 'count': 0}
+
+# Remember the status of the response for the teardown handler
+def _record_status(response):
+    if '_metrics' in g:
+        g._metrics['status'] = response.status_code
+    return response
+
+# Record a finished request, logging it with its statements when it was slow
+def _finish_request(error=None) -> None:
+    state = g.pop('_metrics', None)
+    if state is None:
+        return
+    elapsed = time.perf_counter() - state['start']
+    endpoint = _endpoint()
+    REQUEST_DURATION.observe(elapsed, endpoint, request.method, str(state.get('status', 500)))
+    REQUEST_STATEMENTS.observe(state['count'], endpoint)
+    if elapsed >= _settings['slow_request']:
+        SLOW_REQUESTS.inc(endpoint)
+        statements = ''.join(f'\n  {duration * 1000:.1f} ms  {statement}' for duration, statement in state['statements'])
+        logger.warning('Slow request %s %s (%s) took %.1f ms with %d SQL statements%s',
+                       request.method, request.path, endpoint, elapsed * 1000, state['count'], statements)
+
+# Time a statement
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_metrics_start', []).append(time.perf_counter())
+
+# Record a statement against the current request
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['_metrics_start'].pop()
+    endpoint = _endpoint()
+    operation = statement.lstrip()[:7].lower().rstrip()
+    if operation not in OPERATIONS:
+        operation = 'other'
+    STATEMENT_DURATION.observe(elapsed, endpoint, operation)
+    # SQLite takes the write lock on the first write of a transaction, after any busy waits
+    if operation in WRITE_STATEMENTS and not conn.info.get('_metrics_write_locked'):
+        conn.info['_metrics_write_locked'] = True
+        LOCK_WAIT.observe(elapsed, endpoint)
+    state = g.get('_metrics') if has_request_context() else None
+    if state is not None:
+        state['count'] += 1
+        if len(state['statements']) < MAX_RECORDED_STATEMENTS:
+            state['statements'].append((elapsed, statement))
+    if elapsed >= _settings['slow_query']:
+        SLOW_STATEMENTS.inc(endpoint)
+        logger.warning('Slow SQL statement (%s) took %.1f ms: %s', endpoint, elapsed * 1000, statement)
+
+# Drop the timer of a failed statement and count lock failures
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get('_metrics_start'):
+        context.connection.info['_metrics_start'].pop()
+    if isinstance(context.sqlalchemy_exception, OperationalError) and 'locked' in str(context.original_exception):
+        LOCK_ERRORS.inc(_endpoint())
+
+# A new transaction has not taken the write lock yet
+def _end_transaction(conn):
+    conn.info.pop('_metrics_write_locked', None)
+
+# Attach the statement listeners to an engine
+def instrument_engine(engine) -> None:
+    """Record the statements executed by the engine in the metrics of the current request."""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    event.listen(engine, 'commit', _end_transaction)
+    event.listen(engine, 'rollback', _end_transaction)
+
+# Attach the request hooks to an app
+def init_metrics(app, engines) -> None:
+    """Instrument the requests of the app and the statements of the given engines."""
+    _settings['slow_request'] = app.config['SLOW_REQUEST_SECONDS']
+    _settings['slow_query'] = app.config['SLOW_QUERY_SECONDS']
+    app.before_request(_start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_finish_request)
+    for engine in engines:
+        instrument_engine(engine)
+
+# Record how long a startup phase took
+def record_startup(phase: str, seconds: float) -> None:
+    """Store the duration of a startup phase ('import', 'boot') for /metrics."""
+    _startup[phase] = seconds
+
+# Record the state of the purge queue
+def record_purge_queue(pending: int, oldest_requested) -> None:
+    """Store the number of unfinished purge jobs and when the oldest was requested, for /metrics."""
+    _purge_queue['pending'] = pending
+    _purge_queue['oldest_requested'] = oldest_requested
+
+# Render the metrics in the Prometheus text exposition format
+def render_metrics() -> str:
+    """Return every metric as Prometheus text."""
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for suffix, labels, value in metric.samples():
+            lines.append(f'{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,190 @@
+# Pagination utilities for the api
+
+import base64
+import binascii
+import json
+from flask import request, jsonify, current_app, Response, stream_with_context
+from sqlalchemy import tuple_
+from app.extensions import db
+from app.util.async_db import async_session, UseSyncView
+from app.util.serializers import InvalidFields, dumps, json_response
+
+class InvalidPageRequest(ValueError):
+    """Raised when the pagination query parameters are malformed."""
+
+class SortOrder:
+    """Keyset order on an expression, with the primary key breaking ties.
+
+    The expression must not be NULL, coalesce nullable columns. dump and load
+    convert its values to and from JSON for the cursor.
+    """
+
+    def __init__(self, expression, descending: bool = False, dump=None, load=None):
+        self.expression = expression
+        self.descending = descending
+        self.dump = dump or (lambda value: value)
+        self.load = load or (lambda value: value)
+
+    def order_by(self, key_column) -> tuple:
+        """Return the ORDER BY clauses of the order."""
+        if self.descending:
+            return self.expression.desc(), key_column.desc()
+        return self.expression, key_column
+
+    def after(self, cursor, key_column):
+        """Return the criterion selecting the rows after a decoded cursor."""
+        if not isinstance(cursor, list) or len(cursor) != 2:
+            raise InvalidPageRequest('Invalid cursor')
+        try:
+            last = tuple_(self.load(cursor[0]), int(cursor[1]))
+        except (TypeError, ValueError):
+            raise InvalidPageRequest('Invalid cursor')
+        if self.descending:
+            return tuple_(self.expression, key_column) < last
+        return tuple_(self.expression, key_column) > last
+
+# Encode a keyset cursor
+def encode_cursor(key) -> str:
+    """Encode the last seen key, an integer or a list of sort values, as an opaque cursor."""
+    text = str(key) if isinstance(key, int) else json.dumps(key, separators=(',', ':'))
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+# Decode a keyset cursor
+def decode_cursor(cursor: str):
+    """Decode an opaque cursor back into the last seen key."""
+    try:
+        text = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        return json.loads(text) if text.startswith('[') else int(text)
+    except (ValueError, UnicodeError, binascii.Error):
+        raise InvalidPageRequest('Invalid cursor')
+
+# Read the pagination parameters from the request
+def page_args() -> tuple:
+    """Return (limit, after, stream) from the query string."""
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    stream = request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise InvalidPageRequest('Limit must be an integer')
+        if limit < 1:
+            raise InvalidPageRequest('Limit must be positive')
+        limit = min(limit, current_app.config['PAGINATION_MAX_LIMIT'])
+    elif after is not None:
+        limit = current_app.config['PAGINATION_DEFAULT_LIMIT']
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after, stream
+
+# Build a list response with optional keyset pagination and streaming
+def list_response(serializer, *criteria, order: SortOrder = None):
+    """Return the rows matching the criteria as JSON, paginated on the primary key when ?limit= or ?after= is given.
+
+    Without pagination parameters the response is the plain JSON array.
+    With them it is {"items": [...], "next_cursor": ...}. Adding ?stream=true
+    writes either shape incrementally from a yield_per cursor. Rows are in
+    primary key order unless an order is given.
+    """
+    try:
+        statement, convert, cursor, limit, stream = _list_statement(serializer, criteria, order)
+    except (InvalidPageRequest, InvalidFields) as e:
+        return jsonify({'error': str(e)}), 400
+
+    if stream:
+        return Response(
+            stream_with_context(_stream_rows(statement, convert, cursor, limit)),
+            mimetype='application/json'
+        )
+    return _render_rows(db.session.execute(statement).all(), convert, cursor, limit)
+
+# Coroutine version of list_response for async views
+async def async_list_response(serializer, *criteria, order: SortOrder = None):
+    """Return the same response as list_response, reading through the request's AsyncSession."""
+    try:
+        statement, convert, cursor, limit, stream = _list_statement(serializer, criteria, order)
+    except (InvalidPageRequest, InvalidFields) as e:
+        return jsonify({'error': str(e)}), 400
+
+    if stream:
+        # Streamed bodies are generated by the sync view on a worker thread
+        raise UseSyncView()
+    result = await async_session().execute(statement)
+    return _render_rows(result.all(), convert, cursor, limit)
+
+# Build a paginated response for a select in relevance order
+def ranked_list_response(serializer, build):
+    """Return the rows of build(select) as {"items": [...], "next_cursor": ...}, one page at a time.
+
+    Ranked orders have no stable key to seek from, so the cursor holds the
+    offset of the next page. Responses are always paginated.
+    """
+    try:
+        limit, offset, _ = page_args()
+        if offset is not None and not isinstance(offset, int):
+            raise InvalidPageRequest('Invalid cursor')
+        names = serializer.request_fields()
+        statement = build(serializer.select(names))
+    except (InvalidPageRequest, InvalidFields) as e:
+        return jsonify({'error': str(e)}), 400
+    limit = limit or current_app.config['PAGINATION_DEFAULT_LIMIT']
+    offset = offset or 0
+    rows = db.session.execute(statement.offset(offset).limit(limit + 1)).all()
+    convert = serializer.converter(names)
+    next_cursor = encode_cursor(offset + limit) if len(rows) > limit else None
+    return json_response({'items': [convert(row) for row in rows[:limit]], 'next_cursor': next_cursor})
+
+# Build the keyset paginated select of a list request
+def _list_statement(serializer, criteria, order) -> tuple:
+    limit, after, stream = page_args()
+    names = serializer.request_fields()
+    # The keys are selected last so the cursor works whatever fields are projected
+    key_column = serializer.key_column
+    if order is None:
+        statement = serializer.select(names, key_column).where(*criteria).order_by(key_column)
+        if after is not None:
+            if not isinstance(after, int):
+                raise InvalidPageRequest('Invalid cursor')
+            statement = statement.where(key_column > after)
+        cursor = lambda row: encode_cursor(row[-1])
+    else:
+        statement = serializer.select(names, order.expression, key_column).where(*criteria).order_by(*order.order_by(key_column))
+        if after is not None:
+            statement = statement.where(order.after(after, key_column))
+        cursor = lambda row: encode_cursor([order.dump(row[-2]), row[-1]])
+    if limit is not None:
+        # Fetch one extra row to find out whether there is a next page
+        statement = statement.limit(limit + 1)
+    return statement, serializer.converter(names), cursor, limit, stream
+
+# Render fetched rows as a plain array or a page
+def _render_rows(rows: list, convert, cursor, limit):
+    if limit is None:
+        return json_response([convert(row) for row in rows])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = cursor(rows[-1])
+    return json_response({'items': [convert(row) for row in rows], 'next_cursor': next_cursor})
+
+# Generate a JSON document row by row
+def _stream_rows(statement, convert, cursor, limit):
+    yield b'[' if limit is None else b'{"items":['
+    count = 0
+    last_row = None
+    has_more = False
+    result = db.session.execute(statement.execution_options(yield_per=current_app.config['STREAM_YIELD_PER']))
+    for row in result:
+        if limit is not None and count == limit:
+            has_more = True
+            break
+        yield (b',' if count else b'') + dumps(convert(row))
+        last_row = row
+        count += 1
+    result.close()
+    if limit is None:
+        yield b']'
+    else:
+        next_cursor = cursor(last_row) if has_more else None
+        yield b'],"next_cursor":' + dumps(next_cursor) + b'}'
@@ -0,0 +1,253 @@
+# Deletion of accounts and teams for the api
+#
+# Deleting an account or a team only marks it, drops its memberships and queues
+# a purge job, so the request commits one short transaction whatever the amount
+# of data behind it. A purger thread in each worker then removes the dependent
+# rows PURGE_CHUNK_SIZE at a time, each chunk in its own transaction, so other
+# writers get the lock in between. Chunks are plain DELETE ... LIMIT statements,
+# which makes purgers of several workers safe to run on the same job.
+
+import datetime
+import logging
+import os
+import threading
+import time
+import weakref
+from sqlalchemy import select, update, func, literal_column
+from sqlalchemy.exc import IntegrityError
+from app.extensions import db
+from app.models import User, Team, TeamMember, TodoItem, TodoCounter, Settings, ResourceVersion, PurgeJob
+from app.util.cache import user_key_cache
+from app.util.memberships import set_team_members, team_members
+from app.util.metrics import PURGE_ROWS, record_purge_queue
+from app.util.versions import bump_versions
+from app.util.write_queue import after_commit
+
+logger = logging.getLogger('app.purge')
+
+# Tables a job empties, in foreign key order, with the criterion selecting the rows of the deleted id
+PURGE_STEPS = {
+    'user': [
+        (TodoItem.__table__, lambda user_id: TodoItem.user_id == user_id),
+        (TeamMember.__table__, lambda user_id: TeamMember.user_id == user_id),
+        (Settings.__table__, lambda user_id: Settings.user_id == user_id),
+        (TodoCounter.__table__, lambda user_id: (TodoCounter.scope == 'user') & (TodoCounter.ref_id == user_id)),
+        (ResourceVersion.__table__, lambda user_id: (ResourceVersion.scope == 'user') & (ResourceVersion.ref_id == user_id)),
+        (User.__table__, lambda user_id: User.id == user_id)
+    ],
+    'team': [
+        (TodoItem.__table__, lambda team_id: TodoItem.team_id == team_id),
+        (TeamMember.__table__, lambda team_id: TeamMember.team_id == team_id),
+        (TodoCounter.__table__, lambda team_id: (TodoCounter.scope == 'team') & (TodoCounter.ref_id == team_id)),
+        (ResourceVersion.__table__, lambda team_id: (ResourceVersion.scope == 'team') & (ResourceVersion.ref_id == team_id)),
+        (Team.__table__, lambda team_id: Team.id == team_id)
+    ]
+}
+# Columns translating the public_id of a job to the id of its rows
+PURGE_KEYS = {'user': (User.id, User.public_id), 'team': (Team.id, Team.public_id)}
+
+# Purgers whose thread a forked worker must not expect
+_purgers = weakref.WeakSet()
+
+# Mark a team deleted and queue its purge
+def mark_team_deleted(team: Team, now: datetime.datetime = None) -> list:
+    """Soft delete the team in the current transaction, returning the ids of its former members.
+
+    The memberships go right away so the team leaves every listing, its todos
+    and the team row are left to the purger.
+    """
+    now = now or datetime.datetime.utcnow()
+    members = list(db.session.scalars(
+        select(TeamMember.user_id).where(TeamMember.team_id == team.id)
+    ))
+    set_team_members(team, {})
+    team.deleted = True
+    team.deleted_on = now
+    db.session.add(PurgeJob(kind='team', public_id=team.public_id, requested_on=now))
+    return members
+
+# Mark an account deleted and queue its purge
+def mark_user_deleted(user: User) -> tuple:
+    """Soft delete the account in the current transaction, returning the (users, teams) ids whose listings changed.
+
+    The user leaves the teams it belongs to and the teams it owns are deleted
+    with it. Its todos, settings and the user row are left to the purger.
+    """
+    now = datetime.datetime.utcnow()
+    users, teams = {user.id}, set()
+    for team in Team.query.filter(
+        Team.id.in_(select(TeamMember.team_id).where(TeamMember.user_id == user.id))
+        | (Team.owner_id == user.id),
+        Team.deleted_on.is_(None)
+    ):
+        teams.add(team.id)
+        if team.owner_id == user.id:
+            users.update(mark_team_deleted(team, now))
+            continue
+        members = team_members(team.id)
+        set_team_members(team, {public_id: user_id for public_id, user_id in members.items() if user_id != user.id})
+        users.update(members.values())
+    user.deleted_on = now
+    db.session.add(PurgeJob(kind='user', public_id=user.public_id, requested_on=now))
+    # Requests translating the session must no longer find the id of the account
+    public_id = user.public_id
+    after_commit(lambda: user_key_cache.invalidate(public_id))
+    return list(users), list(teams)
+
+# Delete one chunk of the rows selected by a criterion
+def _delete_chunk(connection, table, criterion, chunk_size: int) -> int:
+    rowids = select(literal_column('rowid')).select_from(table).where(criterion).limit(chunk_size)
+    statement = table.delete().where(literal_column('rowid').in_(rowids))
+    if table is not TodoItem.__table__:
+        return connection.execute(statement).rowcount
+    # Listings that showed the todos must not be answered 304 any more
+    rows = connection.execute(statement.returning(table.c.user_id, table.c.team_id)).all()
+    bump_versions(users=[row.user_id for row in rows], teams=[row.team_id for row in rows], connection=connection)
+    return len(rows)
+
+# Remove every row of a job
+def purge_job(engine, job_id: int, kind: str, public_id: str, chunk_size: int, pause: float = 0.0) -> int:
+    """Delete the rows of a deleted account or team chunk by chunk, returning how many were removed.
+
+    Each chunk commits together with the progress of the job and the
+    versions of the users and teams whose todos it removed; the job is
+    finished once every table is empty of its id. The row of the account or
+    team goes last, so a job whose row is gone has nothing left to remove, and
+    rows added while the job ran make the job start over.
+    """
+    removed = 0
+    key, public_key = PURGE_KEYS[kind]
+    with engine.begin() as connection:
+        connection.execute(
+            update(PurgeJob).where(PurgeJob.id == job_id, PurgeJob.started_on.is_(None))
+            .values(started_on=datetime.datetime.utcnow())
+        )
+        ref_id = connection.execute(select(key).where(public_key == public_id)).scalar()
+    steps = PURGE_STEPS[kind] if ref_id is not None else []
+    step, restarted = 0, False
+    while step < len(steps):
+        table, criterion = steps[step]
+        try:
+            with engine.begin() as connection:
+                count = _delete_chunk(connection, table, criterion(ref_id), chunk_size)
+                connection.execute(
+                    update(PurgeJob).where(PurgeJob.id == job_id).values(rows_removed=PurgeJob.rows_removed + count)
+                )
+        except IntegrityError:
+            # A write that checked the account before it was marked added rows an earlier step already emptied,
+            # once per pass so a row that keeps failing is left to the next one
+            if restarted:
+                raise
+            logger.info('Rows were added to purge job %s while it ran, starting over', job_id)
+            step, restarted = 0, True
+            continue
+        removed += count
+        PURGE_ROWS.inc(table.name, amount=count)
+        if count < chunk_size:
+            step += 1
+        else:
+            time.sleep(pause)
+    with engine.begin() as connection:
+        connection.execute(
+            update(PurgeJob).where(PurgeJob.id == job_id).values(finished_on=datetime.datetime.utcnow())
+        )
+    return removed
+
+# Summarize the unfinished jobs
+def purge_status(connection) -> dict:
+    """Return the number of unfinished jobs, the age of the oldest in seconds and the rows they removed so far."""
+    pending, oldest, removed = connection.execute(
+        select(func.count(), func.min(PurgeJob.requested_on), func.coalesce(func.sum(PurgeJob.rows_removed), 0))
+        .where(PurgeJob.finished_on.is_(None))
+    ).one()
+    record_purge_queue(pending, oldest)
+    return {
+        'pending': pending,
+        'lag_seconds': (datetime.datetime.utcnow() - oldest).total_seconds() if oldest else 0.0,
+        'rows_removed': removed
+    }
+
+# Run every unfinished job
+def purge_pending(engine, chunk_size: int, pause: float = 0.0) -> int:
+    """Purge every job not finished yet, oldest first, returning how many rows were removed."""
+    removed = 0
+    with engine.connect() as connection:
+        jobs = connection.execute(
+            select(PurgeJob.id, PurgeJob.kind, PurgeJob.public_id)
+            .where(PurgeJob.finished_on.is_(None)).order_by(PurgeJob.id)
+        ).all()
+    for job_id, kind, public_id in jobs:
+        removed += purge_job(engine, job_id, kind, public_id, chunk_size, pause)
+    return removed
+
+class Purger:
+    """Background thread of a worker running the purge jobs."""
+
+    def __init__(self, app, chunk_size: int, pause: float, poll: float):
+        self.app = app
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.poll = poll
+        self.reset()
+        _purgers.add(self)
+
+    def reset(self) -> None:
+        """Forget the thread, for a forked child."""
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def start(self) -> None:
+        """Start the thread unless it is running."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='purger', daemon=True)
+                self._thread.start()
+
+    def wake(self) -> None:
+        """Make the thread look for jobs now."""
+        self.start()
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                with self.app.app_context():
+                    purge_pending(db.engine, self.chunk_size, self.pause)
+                    with db.engine.connect() as connection:
+                        purge_status(connection)
+            except Exception:
+                logger.exception('Purge pass failed')
+            self._wake.wait(self.poll)
+            self._wake.clear()
+
+# Create the purger of an app
+def init_purger(app) -> None:
+    """Run the purge jobs in the background of every worker when PURGE_ENABLED is set."""
+    if not app.config['PURGE_ENABLED']:
+        return
+    purger = Purger(
+        app,
+        chunk_size=app.config['PURGE_CHUNK_SIZE'],
+        pause=app.config['PURGE_PAUSE_MS'] / 1000,
+        poll=app.config['PURGE_POLL_SECONDS']
+    )
+    app.extensions['purger'] = purger
+    # Started by the first request so a preloading master does not fork a running thread
+    app.before_request(purger.start)
+
+# Hand the jobs queued by the current request to the purger
+def wake_purger(app) -> None:
+    """Wake the purger of the app, if it has one."""
+    purger = app.extensions.get('purger')
+    if purger is not None:
+        purger.wake()
+
+# A forked worker starts without the thread of its parent
+def _forget_purgers() -> None:
+    for purger in list(_purgers):
+        purger.reset()
+
+os.register_at_fork(after_in_child=_forget_purgers)
@@ -0,0 +1,93 @@
+# Query budgets for the api
+#
+# A budget caps the SQL statements issued inside a block, a view or a test, so
+# an N+1 pattern fails as soon as it appears instead of growing with the data.
+# Statements are counted by an engine event on every engine; budgets nest and
+# each active budget counts every statement issued in its context.
+
+import contextvars
+import inspect
+import logging
+from functools import wraps
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('app.query_budget')
+
+# List endpoints issue the version lookup of their ETag and one select of the rows, whatever the row count,
+# plus the translation of the session user or path team to its id when the key cache misses
+LIST_QUERY_BUDGET = 3
+
+_active_budgets = contextvars.ContextVar('query_budgets', default=())
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a block issues more SQL statements than its budget allows."""
+
+class QueryBudget:
+    """Context manager and decorator limiting the SQL statements issued inside it."""
+
+    def __init__(self, max_statements: int, name: str = None, strict: bool = None):
+        self.max_statements = max_statements
+        self.name = name
+        self.strict = strict
+        self.statements = []
+
+    def __enter__(self):
+        self.statements = []
+        self._token = _active_budgets.set(_active_budgets.get() + (self,))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _active_budgets.reset(self._token)
+        if exc_type is None:
+            self.check()
+        return False
+
+    def __call__(self, f):
+        name = self.name or f.__qualname__
+        # Every call gets its own budget so concurrent requests do not share a count
+        if inspect.iscoroutinefunction(f):
+            @wraps(f)
+            async def decorated_coroutine(*args, **kwargs):
+                with QueryBudget(self.max_statements, name, self.strict):
+                    return await f(*args, **kwargs)
+            return decorated_coroutine
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with QueryBudget(self.max_statements, name, self.strict):
+                return f(*args, **kwargs)
+        return decorated_function
+
+    @property
+    def count(self) -> int:
+        """Statements issued so far inside the budget."""
+        return len(self.statements)
+
+    def check(self) -> None:
+        """Raise or log when the budget was exceeded, depending on QUERY_BUDGET_STRICT."""
+        if self.count <= self.max_statements:
+            return
+        listing = ''.join(f'\n  {statement}' for statement in self.statements)
+        message = f'{self.name or "Block"} issued {self.count} SQL statements, its budget is {self.max_statements}:{listing}'
+        strict = self.strict
+        if strict is None:
+            strict = current_app.config['QUERY_BUDGET_STRICT'] if has_app_context() else True
+        if strict:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+def query_budget(max_statements: int, name: str = None, strict: bool = None) -> QueryBudget:
+    """Limit the SQL statements of a block or a view to max_statements.
+
+    Raises QueryBudgetExceeded when QUERY_BUDGET_STRICT is set (by the tests,
+    or outside an app) and logs a warning otherwise.
+    """
+    return QueryBudget(max_statements, name, strict)
+
+# Count every statement against the active budgets
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    for budget in _active_budgets.get():
+        budget.statements.append(statement)
@@ -0,0 +1,57 @@
+# Readers for the views served by both entry points
+#
+# A view with a coroutine twin (see app.util.async_db.async_view) has its body
+# written once, as a coroutine taking a reader. The async reader awaits the
+# request's AsyncSession. The sync reader runs the same lookups on the
+# Flask-SQLAlchemy session and never suspends, so run_sync completes the body
+# on the request thread without an event loop.
+
+from app.util.async_db import UseSyncView
+from app.util.cache import team_key_cache
+from app.util.lookups import get_settings_row, get_settings_row_async, current_user_id, current_user_id_cached
+from app.util.pagination import list_response, async_list_response
+
+class SyncReader:
+    """Reads of a shared view body through db.session."""
+
+    def user_id(self) -> int:
+        return current_user_id()
+
+    def require_team_key(self, public_id: str) -> None:
+        """Nothing to do, the filters load the id of the team when it is not cached."""
+
+    async def settings_row(self, user_public_id: str, version: int = None) -> dict:
+        return get_settings_row(user_public_id, version)
+
+    async def list_response(self, serializer, *criteria, order=None):
+        return list_response(serializer, *criteria, order=order)
+
+class AsyncReader:
+    """Reads of a shared view body through the AsyncSession of the request."""
+
+    def user_id(self) -> int:
+        return current_user_id_cached()
+
+    def require_team_key(self, public_id: str) -> None:
+        """Leave the request to the sync view unless the id of the team is cached."""
+        if team_key_cache.get(public_id) is None:
+            raise UseSyncView()
+
+    async def settings_row(self, user_public_id: str, version: int = None) -> dict:
+        return await get_settings_row_async(user_public_id, version)
+
+    async def list_response(self, serializer, *criteria, order=None):
+        return await async_list_response(serializer, *criteria, order=order)
+
+SYNC_READER = SyncReader()
+ASYNC_READER = AsyncReader()
+
+# Run a shared view body with the sync reader
+def run_sync(body):
+    """Drive the coroutine body to completion on the current thread, returning its response."""
+    try:
+        body.send(None)
+    except StopIteration as stop:
+        return stop.value
+    body.close()
+    raise RuntimeError('A view body awaited more than the sync reader')
@@ -0,0 +1,56 @@
+# Full-text search utilities for the api
+
+import re
+from sqlalchemy import Integer, column, func, literal_column, table
+from app.models import TodoItem
+
+# The FTS5 index of todo titles and summaries, created by TODO_SEARCH_DDL
+todo_items_fts = table('todo_items_fts', column('rowid', Integer), column('todo_items_fts'))
+
+# Matches in the title weigh more than matches in the summary
+TITLE_WEIGHT = 10.0
+SUMMARY_WEIGHT = 1.0
+MAX_TERMS = 16
+
+TERM_PATTERN = re.compile(r'"([^"]+)"|([\w]+\*?)', re.UNICODE)
+
+class InvalidSearch(ValueError):
+    """Raised when a search query has no searchable terms."""
+
+# Turn user input into an FTS5 match expression
+def match_expression(q: str) -> str:
+    """Return an FTS5 query matching every term of q.
+
+    Words are matched as tokens, "quoted text" as a phrase and a trailing *
+    matches the word as a prefix. Every other FTS5 operator is treated as text.
+    """
+    terms = []
+    for phrase, word in TERM_PATTERN.findall(q or ''):
+        if phrase:
+            tokens = re.findall(r'\w+', phrase)
+            if tokens:
+                terms.append('"' + ' '.join(tokens) + '"')
+        elif word.endswith('*'):
+            terms.append(f'"{word[:-1]}"*')
+        else:
+            terms.append(f'"{word}"')
+    if not terms:
+        raise InvalidSearch('Search query must contain at least one word')
+    if len(terms) > MAX_TERMS:
+        raise InvalidSearch(f'Search query can contain at most {MAX_TERMS} terms')
+    return ' AND '.join(terms)
+
+# Rank of a todo in the current search, lower is better
+def search_rank():
+    """Return the bm25 rank of the current match, weighting titles over summaries."""
+    return func.bm25(literal_column('todo_items_fts'), TITLE_WEIGHT, SUMMARY_WEIGHT)
+
+# Restrict a select of todo items to a full-text match
+def match_todos(statement, expression: str):
+    """Join the statement to the search index, keeping the todos matching the expression in rank order."""
+    return (
+        statement
+        .join(todo_items_fts, todo_items_fts.c.rowid == TodoItem.id)
+        .where(todo_items_fts.c.todo_items_fts.op('MATCH')(expression))
+        .order_by(search_rank(), TodoItem.id)
+    )
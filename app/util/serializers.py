@@ -1 +1,115 @@
-# Serializers for the api
\ No newline at end of file
+# Serializers for the api
+#
+# Endpoints select only the columns they return as Core rows, convert them with
+# converters compiled once per field set and encode them with orjson when it is
+# installed. Clients can project the payload with ?fields=title,due_date.
+
+import json
+from functools import lru_cache
+from flask import request, Response
+from sqlalchemy import select
+from werkzeug.http import http_date
+from app.extensions import db
+from app.models import TodoItem, Team
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class InvalidFields(ValueError):
+    """Raised when ?fields= names a field the serializer does not know."""
+
+# Encode an object as JSON bytes with the fastest available backend
+def dumps(obj) -> bytes:
+    """Encode the object as compact JSON."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+# Decode JSON text or bytes with the fastest available backend
+def loads(data):
+    """Decode a JSON document, raising ValueError when it is malformed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Build a JSON response from an already serialized object
+def json_response(obj, status: int = 200) -> Response:
+    """Return the object as an application/json response."""
+    return Response(dumps(obj), status=status, mimetype='application/json')
+
+class RowSerializer:
+    """Projects a model onto its JSON fields using Core rows instead of ORM objects."""
+
+    def __init__(self, model, fields: dict, converters: dict = None):
+        self.model = model
+        self.fields = fields
+        self.field_names = tuple(fields)
+        self.converters = converters or {}
+        self.key_column = model.id
+        self.converter = lru_cache(maxsize=64)(self._compile)
+
+    def parse_fields(self, fields: str = None) -> tuple:
+        """Return the field names requested by a comma separated list, all fields by default."""
+        if not fields:
+            return self.field_names
+        names = tuple(dict.fromkeys(name.strip() for name in fields.split(',') if name.strip()))
+        unknown = [name for name in names if name not in self.fields]
+        if unknown or not names:
+            raise InvalidFields(f"Unknown fields: {', '.join(unknown)}" if unknown else 'No fields requested')
+        return names
+
+    def request_fields(self) -> tuple:
+        """Return the field names requested with ?fields= on the current request."""
+        return self.parse_fields(request.args.get('fields'))
+
+    def select(self, names: tuple, *extra):
+        """Return a select of the columns backing the given fields, followed by any extra columns."""
+        return select(*[self.fields[name] for name in names], *extra)
+
+    def _compile(self, names: tuple):
+        # Resolve the converters once per field set instead of once per row
+        converters = [(name, self.converters[name]) for name in names if name in self.converters]
+        def convert(row) -> dict:
+            item = dict(zip(names, row))
+            for name, converter in converters:
+                value = item[name]
+                if value is not None:
+                    item[name] = converter(value)
+            return item
+        return convert
+
+    def first(self, *criteria, names: tuple = None) -> dict:
+        """Return the first row matching the criteria as a dict, or None."""
+        names = names or self.field_names
+        row = db.session.execute(self.select(names).where(*criteria).limit(1)).first()
+        return self.converter(names)(row) if row is not None else None
+
+# Dates keep the HTTP date format of Flask's default JSON provider, the
+# assigned team goes out as its public ID looked up by primary key per row
+TODO_SERIALIZER = RowSerializer(TodoItem, {
+    'public_id': TodoItem.public_id,
+    'title': TodoItem.title,
+    'summary': TodoItem.summary,
+    'due_date': TodoItem.due_date,
+    'completed': TodoItem.completed,
+    'priority': TodoItem.priority,
+    'assigned_to': select(Team.public_id).where(Team.id == TodoItem.team_id).scalar_subquery(),
+    'shared_with': TodoItem.shared_with,
+    'created_by': TodoItem.created_by,
+    'created_on': TodoItem.created_on,
+    'visibility': TodoItem.visibility
+}, converters={'due_date': http_date, 'created_on': http_date})
+
+TEAM_SERIALIZER = RowSerializer(Team, {
+    'public_id': Team.public_id,
+    'name': Team.name,
+    'description': Team.description,
+    'members': Team.members,
+    'team_image': Team.team_image_hash,
+    'is_active': Team.is_active,
+    'deleted': Team.deleted,
+    'last_activity': Team.last_activity,
+    'created_on': Team.created_on
+}, converters={'last_activity': http_date, 'created_on': http_date})
@@ -0,0 +1,123 @@
+# Delta sync utilities for the api
+#
+# Todos and team memberships carry their position in a global change sequence
+# and deletions leave tombstones, so a client holding the cursor of its last
+# sync downloads only what changed since. Tombstones older than the retention
+# are compacted; a cursor older than the compacted point must resync from 0.
+
+import datetime
+from sqlalchemy import select, union, and_, or_
+from app.extensions import db
+from app.models import TodoItem, TeamMember, SyncState, SyncTombstone
+
+class InvalidSyncCursor(ValueError):
+    """Raised when a since cursor is malformed."""
+
+class SyncCursorExpired(Exception):
+    """Raised when the tombstones a since cursor needs have been compacted."""
+
+# Read the head of the change sequence and the compacted point
+def sync_state(executor=None) -> tuple:
+    """Return (change_seq, compacted_seq), 0 for a sequence that has not started."""
+    executor = executor if executor is not None else db.session
+    values = dict(executor.execute(
+        select(SyncState.name, SyncState.value).where(SyncState.name.in_(['change_seq', 'compacted_seq']))
+    ).all())
+    return values.get('change_seq', 0), values.get('compacted_seq', 0)
+
+# Parse the since query parameter
+def parse_since(value: str) -> int:
+    """Return the change sequence a client has synced up to, 0 for a full sync."""
+    if value is None or value == '':
+        return 0
+    try:
+        since = int(value)
+    except ValueError:
+        raise InvalidSyncCursor('since must be a non-negative integer')
+    if since < 0:
+        raise InvalidSyncCursor('since must be a non-negative integer')
+    return since
+
+# Todos a user can see whose change, or whose team membership, falls in (since, head]
+def _changed_todo_ids(user_id: int, since: int, head: int):
+    membership = and_(TeamMember.team_id == TodoItem.team_id, TeamMember.user_id == user_id)
+    changed = TodoItem.change_seq.between(since + 1, head)
+    return union(
+        select(TodoItem.id).where(TodoItem.user_id == user_id, changed),
+        select(TodoItem.id).join(TeamMember, membership).where(changed),
+        # Joining a team brings in all of its todos, whatever their own position
+        select(TodoItem.id).join(TeamMember, membership).where(TeamMember.change_seq.between(since + 1, head))
+    )
+
+# Public IDs the client should drop: deleted todos, todos moved out of its view and todos of teams it left
+def _deleted_todo_ids(user_id: int, since: int, head: int):
+    in_range = SyncTombstone.seq.between(since + 1, head)
+    current_teams = select(TeamMember.team_id).where(TeamMember.user_id == user_id)
+    left_teams = select(SyncTombstone.team_id).where(
+        SyncTombstone.kind == 'membership',
+        SyncTombstone.user_id == user_id,
+        in_range,
+        SyncTombstone.team_id.not_in(current_teams)
+    )
+    visible = select(TodoItem.public_id).where(or_(
+        TodoItem.user_id == user_id,
+        TodoItem.team_id.in_(current_teams)
+    ))
+    return union(
+        select(SyncTombstone.public_id).where(
+            SyncTombstone.kind == 'todo',
+            in_range,
+            or_(
+                SyncTombstone.user_id == user_id,
+                SyncTombstone.team_id.in_(current_teams),
+                SyncTombstone.team_id.in_(left_teams)
+            ),
+            SyncTombstone.public_id.not_in(visible)
+        ),
+        # Left teams are not current teams, so only the user's own todos stay visible
+        select(TodoItem.public_id).where(
+            TodoItem.team_id.in_(left_teams),
+            TodoItem.user_id != user_id
+        )
+    )
+
+# Build the changes of a user's todos since a cursor
+def todo_changes(user_id: int, since: int, serializer, names: tuple) -> dict:
+    """Return {"cursor", "upserts", "deletes"} for the todos the user can see, changed after since.
+
+    since=0 returns every visible todo and no deletes. Upserts are in change
+    order; pass cursor back as since on the next sync. Raises
+    SyncCursorExpired when since predates the compacted tombstones.
+    """
+    head, compacted = sync_state()
+    if since and (since < compacted or since > head):
+        raise SyncCursorExpired()
+    # Bound every read by the head so a change committed meanwhile is left to the next sync
+    upserts = db.session.execute(
+        serializer.select(names)
+        .where(TodoItem.id.in_(_changed_todo_ids(user_id, since, head)))
+        .order_by(TodoItem.change_seq, TodoItem.id)
+    ).all()
+    deletes = db.session.scalars(_deleted_todo_ids(user_id, since, head)).all() if since else []
+    convert = serializer.converter(names)
+    return {'cursor': head, 'upserts': [convert(row) for row in upserts], 'deletes': deletes}
+
+# Drop old tombstones
+def compact_tombstones(connection, retention_days: int, now: datetime.datetime = None) -> int:
+    """Delete the tombstones older than the retention, returning how many were removed.
+
+    The newest removed position is recorded as compacted_seq, cursors before it expire.
+    """
+    cutoff = (now or datetime.datetime.utcnow()) - datetime.timedelta(days=retention_days)
+    newest = connection.execute(
+        select(SyncTombstone.seq).where(SyncTombstone.deleted_on < cutoff).order_by(SyncTombstone.seq.desc()).limit(1)
+    ).scalar()
+    if newest is None:
+        return 0
+    removed = connection.execute(SyncTombstone.__table__.delete().where(SyncTombstone.seq <= newest)).rowcount
+    connection.exec_driver_sql(
+        "INSERT INTO sync_state (name, value) VALUES ('compacted_seq', ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = max(value, excluded.value)",
+        (newest,)
+    )
+    return removed
@@ -1,6 +1,9 @@
 # Utility functions for the api
 
+import base64
+import binascii
 from flask import jsonify
+from app.util import auth
 
 # Validate username
 def validate_name(name: str) -> bool:
@@ -40,17 +43,19 @@ def validate_password(password: str) -> bool:
 # Hash password
 def hash_password(password: str) -> str:
     """Hash the password using a secure hashing algorithm."""
-    from werkzeug.security import generate_password_hash
-    return generate_password_hash(password)
+    return auth.hash_password(password)
 
 # Verify password
 def verify_password(password: str, hashed_password: str) -> bool:
     """Verify the password against the hashed password."""
-    from werkzeug.security import check_password_hash
-    return check_password_hash(hashed_password, password)
+    return auth.verify_password(password, hashed_password)
 
-# Encode image to base64
-def encode_image_to_base64(image_data: bytes) -> str:
-    """Encode image data to a base64 string."""
-    import base64
-    return base64.b64encode(image_data).decode('utf-8')
\ No newline at end of file
+# Decode image from base64
+def decode_image_from_base64(image_data: str) -> bytes:
+    """Decode a base64 string to image data, returning None if it is not valid base64."""
+    if not isinstance(image_data, str):
+        return None
+    try:
+        return base64.b64decode(image_data, validate=True)
+    except (binascii.Error, ValueError):
+        return None
\ No newline at end of file
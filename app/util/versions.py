@@ -0,0 +1,75 @@
+# Resource version utilities for the api
+#
+# Every write bumps the version of the users and teams whose listings it changes.
+# GET handlers derive their ETag from those versions, so a poll that has not
+# changed is answered with a single indexed lookup.
+
+import datetime
+import hashlib
+from flask import g
+from sqlalchemy import select, or_, and_
+from sqlalchemy.dialects.sqlite import insert
+from app.extensions import db
+from app.models import ResourceVersion, TeamMember
+
+# Bump the versions of users and teams
+def bump_versions(users=(), teams=(), connection=None) -> None:
+    """Increment the version of every given user and team id in the current transaction, or on connection when given."""
+    now = datetime.datetime.utcnow()
+    rows = [{'scope': 'user', 'ref_id': user_id, 'version': 1, 'updated_on': now}
+            for user_id in dict.fromkeys(users) if user_id is not None]
+    rows += [{'scope': 'team', 'ref_id': team_id, 'version': 1, 'updated_on': now}
+             for team_id in dict.fromkeys(teams) if team_id is not None]
+    if not rows:
+        return
+    statement = insert(ResourceVersion.__table__)
+    (connection or db.session).execute(statement.on_conflict_do_update(
+        index_elements=['scope', 'ref_id'],
+        set_={'version': ResourceVersion.__table__.c.version + 1, 'updated_on': statement.excluded.updated_on}
+    ), rows)
+
+VERSION_COLUMNS = (ResourceVersion.scope, ResourceVersion.ref_id, ResourceVersion.version, ResourceVersion.updated_on)
+
+# Versions covering everything a user can list
+def user_versions_query(user_id: int):
+    """Return a select of the (scope, ref_id, version, updated_on) rows of the user and all of their teams."""
+    team_ids = select(TeamMember.team_id).where(TeamMember.user_id == user_id)
+    return (
+        select(*VERSION_COLUMNS)
+        .where(or_(
+            and_(ResourceVersion.scope == 'user', ResourceVersion.ref_id == user_id),
+            and_(ResourceVersion.scope == 'team', ResourceVersion.ref_id.in_(team_ids))
+        ))
+        .order_by(ResourceVersion.scope, ResourceVersion.ref_id)
+    )
+
+# Versions of a single user or team
+def resource_versions_query(scope: str, ref_id: int):
+    """Return a select of the (scope, ref_id, version, updated_on) row of one user or team."""
+    return select(*VERSION_COLUMNS).where(ResourceVersion.scope == scope, ResourceVersion.ref_id == ref_id)
+
+# Version of a resource as read for the ETag of the current request
+def request_version(scope: str, ref_id: int) -> int:
+    """Return the version etag_conditional read for the resource, 0 when it has not been written yet.
+
+    Returns None when the request was served without reading versions.
+    """
+    if 'resource_versions' not in g:
+        return None
+    for row_scope, row_ref_id, version, _ in g.get('resource_versions', ()):
+        if row_scope == scope and row_ref_id == ref_id:
+            return version
+    return 0
+
+# Build an ETag and Last-Modified date from version rows
+def version_etag(*parts, versions: list) -> tuple:
+    """Return (etag, last_modified) for a representation identified by parts at the given versions."""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode('utf-8') + b'\0')
+    last_modified = None
+    for scope, ref_id, version, updated_on in versions:
+        digest.update(f'{scope}:{ref_id}:{version}\0'.encode('utf-8'))
+        if updated_on and (last_modified is None or updated_on > last_modified):
+            last_modified = updated_on
+    return digest.hexdigest(), last_modified
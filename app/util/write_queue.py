@@ -0,0 +1,199 @@
+# Group commit for the api
+#
+# SQLite has a single writer and every commit pays for its own sync, so with
+# WRITE_QUEUE_ENABLED the mutating views hand their unit of work to one writer
+# thread per worker. The writer runs the units that arrive within a short
+# window in one transaction, each inside its own savepoint so a failing unit
+# only undoes itself, commits once and hands every caller its own response.
+# Disabled, the same views run and commit in the request thread as before.
+
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from functools import wraps
+from flask import Response, copy_current_request_context, current_app, has_request_context, make_response, request
+from sqlalchemy import text
+from app.extensions import db
+from app.util.metrics import WRITE_BATCH_COMMIT, WRITE_BATCH_SIZE, WRITE_QUEUE_WAIT
+
+logger = logging.getLogger('app.write_queue')
+
+# Callbacks of the unit of work running in the writer, None outside of it
+_current_unit = contextvars.ContextVar('write_unit', default=None)
+
+# Queues whose writer thread a forked worker must not expect
+_queues = weakref.WeakSet()
+
+class _Unit:
+    """A function waiting to run in the writer inside the context of the request that submitted it."""
+
+    def __init__(self, f, args, kwargs):
+        self.call = copy_current_request_context(lambda: f(*args, **kwargs))
+        self.endpoint = request.endpoint or 'unmatched'
+        self.submitted = time.perf_counter()
+        self.future = Future()
+        self.callbacks = []
+        self.result = None
+
+class WriteQueue:
+    """Single writer thread batching the units of work of concurrent requests into one transaction."""
+
+    def __init__(self, app, window: float, max_batch: int):
+        self.app = app
+        self.window = window
+        self.max_batch = max(max_batch, 1)
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        _queues.add(self)
+
+    def submit(self, f, *args, **kwargs):
+        """Run f(*args, **kwargs) in the writer within the current request and return its result."""
+        unit = _Unit(f, args, kwargs)
+        self._ensure_writer()
+        self._queue.put(unit)
+        return unit.future.result()
+
+    def reset(self) -> None:
+        """Forget the writer thread and the queued units, for a forked child."""
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # The writer is started on first use so every forked worker gets its own
+    def _ensure_writer(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                with self.app.app_context():
+                    self._run_batch(batch)
+            except Exception as e:
+                # Keep the writer alive, its callers must not wait forever
+                logger.exception('Write queue batch failed')
+                for unit in batch:
+                    if not unit.future.done():
+                        unit.future.set_exception(e)
+
+    # Wait for a unit, then collect what arrives within the window
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_batch(self, batch: list) -> None:
+        WRITE_BATCH_SIZE.observe(len(batch))
+        done = []
+        try:
+            # Take the write lock up front and keep the savepoints inside one transaction
+            db.session.execute(text('BEGIN IMMEDIATE'))
+            for unit in batch:
+                WRITE_QUEUE_WAIT.observe(time.perf_counter() - unit.submitted, unit.endpoint)
+                if self._run_unit(unit):
+                    done.append(unit)
+            started = time.perf_counter()
+            db.session.commit()
+            WRITE_BATCH_COMMIT.observe(time.perf_counter() - started)
+        except Exception as e:
+            # Nothing of the batch was committed, so every caller still waiting gets the error
+            db.session.rollback()
+            for unit in batch:
+                if not unit.future.done():
+                    unit.future.set_exception(e)
+            return
+        for unit in done:
+            for callback in unit.callbacks:
+                callback()
+            unit.future.set_result(unit.result)
+
+    # Run one unit in its savepoint, returning whether it is part of the commit
+    def _run_unit(self, unit: _Unit) -> bool:
+        token = _current_unit.set(unit.callbacks)
+        savepoint = db.session.begin_nested()
+        try:
+            result = unit.call()
+        except Exception as e:
+            savepoint.rollback()
+            unit.future.set_exception(e)
+            return False
+        finally:
+            _current_unit.reset(token)
+        # A view answering with an error keeps none of its writes, as it would not have committed them
+        if isinstance(result, Response) and result.status_code >= 400:
+            savepoint.rollback()
+            unit.future.set_result(result)
+            return False
+        savepoint.commit()
+        unit.result = result
+        return True
+
+# Create the write queue of an app
+def init_write_queue(app) -> None:
+    """Enable group commit for the app when WRITE_QUEUE_ENABLED is set."""
+    if not app.config['WRITE_QUEUE_ENABLED']:
+        return
+    app.extensions['write_queue'] = WriteQueue(
+        app,
+        window=app.config['WRITE_QUEUE_WINDOW_MS'] / 1000,
+        max_batch=app.config['WRITE_QUEUE_MAX_BATCH']
+    )
+
+# Run a function as a unit of work of the current request
+def run_write(f, *args, **kwargs):
+    """Call f in the writer when group commit is enabled, otherwise in the request thread.
+
+    f must end its writes with commit_write() and defer side effects that
+    need the data to be committed with after_commit().
+    """
+    write_queue = current_app.extensions.get('write_queue') if has_request_context() else None
+    if write_queue is None or _current_unit.get() is not None:
+        return f(*args, **kwargs)
+    return write_queue.submit(f, *args, **kwargs)
+
+# Run a whole view as a unit of work
+def group_commit(f):
+    """Decorator running the view through run_write, its writes are kept unless it answers with an error."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        return run_write(lambda: make_response(f(*args, **kwargs)))
+    return decorated_function
+
+# Commit the writes of the current unit of work
+def commit_write() -> None:
+    """Commit the session, or flush it when the writer commits the batch."""
+    if _current_unit.get() is None:
+        db.session.commit()
+    else:
+        db.session.flush()
+
+# Run a callback once the current unit of work is committed
+def after_commit(callback) -> None:
+    """Call callback now outside the writer, or after the commit of the batch inside it."""
+    callbacks = _current_unit.get()
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+# A forked worker starts without the writer thread of its parent
+def _forget_writers() -> None:
+    for write_queue in list(_queues):
+        write_queue.reset()
+
+os.register_at_fork(after_in_child=_forget_writers)
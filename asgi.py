@@ -0,0 +1,6 @@
+# Set up for running the app with uvicorn or other ASGI servers, e.g. uvicorn asgi:app
+# Requires aiosqlite and sqlalchemy[asyncio] in addition to the WSGI dependencies
+
+from app.asgi import create_asgi_app
+
+app = create_asgi_app()
@@ -0,0 +1,6 @@
+# Benchmark suite for the api
+#
+# Seeds a large dataset, drives every route of the users, auth, teams, todos and
+# settings blueprints from a multi-threaded load generator and compares the
+# latency and throughput of each endpoint with a stored baseline.
+# Run with: python -m benchmarks --help
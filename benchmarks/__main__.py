@@ -0,0 +1,152 @@
+# Command line entry point of the benchmark suite
+#
+# python -m benchmarks                        seed (once) and run every scenario
+# python -m benchmarks --save-baseline        store the results as the baseline
+# python -m benchmarks --only todos.          run the scenarios whose name contains 'todos.'
+# python -m benchmarks --write-queue          run with group commit enabled
+#
+# The seeded database is kept under --workdir and copied before every run, so
+# the write scenarios of one run never change the dataset of the next. The run
+# exits with status 1 when an endpoint regresses against the stored baseline.
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Load and latency benchmarks for the api.')
+    parser.add_argument('--users', type=int, default=10000, help='users to seed (default 10000)')
+    parser.add_argument('--teams', type=int, default=2000, help='teams to seed (default 2000)')
+    parser.add_argument('--todos', type=int, default=1000000, help='todos to seed (default 1000000)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the dataset')
+    parser.add_argument('--reseed', action='store_true', help='rebuild the dataset even if it is cached')
+    parser.add_argument('--profile', choices=['default', 'production'], help='SQLite profile, defaults to TODONE_DB_PROFILE')
+    parser.add_argument('--write-queue', action='store_true', help='batch the commits of concurrent writes (TODONE_WRITE_QUEUE=1)')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients (default 8)')
+    parser.add_argument('--requests', type=int, default=50, help='timed requests per client and endpoint (default 50)')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed requests per client and endpoint (default 5)')
+    parser.add_argument('--only', action='append', default=[], help='only run scenarios whose name contains this text')
+    parser.add_argument('--baseline', default=os.path.join(ROOT, 'benchmarks', 'baseline.json'), help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed regression ratio (default 0.25)')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='ignore latency regressions smaller than this')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    parser.add_argument('--workdir', default=os.path.join(ROOT, 'benchmarks', '.data'), help='where datasets are kept')
+    args = parser.parse_args(argv)
+    if args.threads < 1 or args.requests < 1 or args.warmup < 0:
+        parser.error('--threads and --requests must be positive and --warmup not negative')
+    return args
+
+# Remove a database and its WAL files
+def _remove_database(path: str) -> None:
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+# Copy a database consistently, whatever its journal mode
+def _copy_database(source: str, target: str) -> None:
+    _remove_database(target)
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.profile:
+        os.environ['TODONE_DB_PROFILE'] = args.profile
+    profile = os.environ.get('TODONE_DB_PROFILE', 'default')
+    if args.write_queue:
+        os.environ['TODONE_WRITE_QUEUE'] = '1'
+    dataset_dir = os.path.join(args.workdir, f'u{args.users}-t{args.teams}-d{args.todos}-s{args.seed}')
+    pristine = os.path.join(dataset_dir, 'todone.db')
+    run_dir = os.path.join(dataset_dir, 'run')
+    run_db = os.path.join(run_dir, 'app', 'data', 'todone.db')
+    os.makedirs(os.path.dirname(run_db), exist_ok=True)
+    seeded = os.path.exists(pristine) and not args.reseed
+    if seeded:
+        _copy_database(pristine, run_db)
+    else:
+        _remove_database(run_db)
+
+    # The app resolves its data directory from the working directory at import time
+    os.chdir(run_dir)
+    from app import create_app
+    from app.extensions import db
+    from app.util.auth import shutdown_hashing
+    from benchmarks.load import run_scenario
+    from benchmarks.report import format_table, load_baseline, save_baseline, find_regressions
+    from benchmarks.scenarios import SCENARIOS, load_actors
+    from benchmarks.seed import seed
+
+    app = create_app()
+    try:
+        if not seeded:
+            with app.app_context():
+                seed(args.users, args.teams, args.todos, args.seed, log=lambda message: print(message, flush=True))
+                db.engine.dispose()
+            _copy_database(run_db, pristine)
+
+        config = {
+            'users': args.users, 'teams': args.teams, 'todos': args.todos, 'seed': args.seed,
+            'threads': args.threads, 'requests': args.requests, 'profile': profile,
+            'write_queue': os.environ.get('TODONE_WRITE_QUEUE') == '1'
+        }
+        scenarios = [s for s in SCENARIOS if not args.only or any(text in s.name for text in args.only)]
+        actors = load_actors(app, args.threads)
+        results = {}
+        for scenario in scenarios:
+            results[scenario.name] = run_scenario(app, scenario, actors, args.requests, args.warmup)
+            stats = results[scenario.name]
+            print(f"{scenario.name}: {stats['throughput']:.1f} req/s, p95 {stats['p95_ms']:.2f} ms", flush=True)
+    finally:
+        shutdown_hashing()
+
+    print()
+    print(format_table(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': config, 'endpoints': results}, f, indent=2, sort_keys=True)
+
+    status = 0
+    failed = {name: stats for name, stats in results.items() if stats['errors']}
+    for name, stats in failed.items():
+        print(f"\n{name}: {stats['errors']} unexpected responses, e.g.")
+        for sample in stats['error_samples']:
+            print(f'  {sample}')
+    if failed:
+        status = 1
+
+    baseline = load_baseline(args.baseline)
+    if args.save_baseline:
+        if failed:
+            print('\nNot saving a baseline from a run with errors.')
+        else:
+            save_baseline(args.baseline, results, config)
+            print(f'\nBaseline saved to {args.baseline}')
+    elif baseline is None:
+        print(f'\nNo baseline at {args.baseline}, run with --save-baseline to create one.')
+    elif baseline['dataset'] != config:
+        print(f"\nThe baseline was measured with {baseline['dataset']}, not comparable with {config}.")
+        status = status or 2
+    else:
+        regressions = find_regressions(results, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print('\nRegressions against the baseline:')
+            for regression in regressions:
+                print(f'  {regression}')
+            status = 1
+        else:
+            print('\nNo regressions against the baseline.')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# Multi-threaded load generator for the benchmark suite
+
+import statistics
+import threading
+import time
+
+# Drive one scenario from every actor at once
+def run_scenario(app, scenario, actors: list, requests: int, warmup: int) -> dict:
+    """Send warmup + requests requests per actor concurrently and return the latency and throughput stats."""
+    barrier = threading.Barrier(len(actors) + 1)
+    latencies = [[] for _ in actors]
+    errors = [[] for _ in actors]
+
+    def worker(actor, samples, failures):
+        try:
+            with app.app_context():
+                for i in range(warmup + requests):
+                    if i == warmup:
+                        barrier.wait()
+                    client, method, path, kwargs = scenario.request(actor)
+                    start = time.perf_counter()
+                    response = client.open(path, method=method, **kwargs)
+                    # Streamed bodies are only generated while they are read
+                    response.get_data()
+                    elapsed = time.perf_counter() - start
+                    if response.status_code != scenario.status:
+                        failures.append(f'{method} {path}: {response.status_code} {response.get_data(as_text=True)[:200]}')
+                    if i >= warmup:
+                        samples.append(elapsed)
+        except Exception as e:
+            # Release the other threads instead of leaving them waiting on the barrier
+            failures.append(f'{type(e).__name__}: {e}')
+            barrier.abort()
+
+    threads = [
+        threading.Thread(target=worker, args=(actor, latencies[i], errors[i]), name=f'bench-{i}')
+        for i, actor in enumerate(actors)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    samples = sorted(sample for actor_samples in latencies for sample in actor_samples)
+    failures = [failure for actor_errors in errors for failure in actor_errors]
+    return summarize(samples, wall, failures)
+
+# Reduce latency samples to the reported stats
+def summarize(samples: list, wall: float, failures: list) -> dict:
+    """Return throughput, mean and p50/p95/p99 latency in milliseconds for sorted samples."""
+    if len(samples) > 1:
+        cuts = statistics.quantiles(samples, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = samples[0] if samples else 0.0
+    return {
+        'requests': len(samples),
+        'errors': len(failures),
+        'error_samples': failures[:3],
+        'throughput': len(samples) / wall if wall else 0.0,
+        'mean_ms': statistics.fmean(samples) * 1000 if samples else 0.0,
+        'p50_ms': p50 * 1000,
+        'p95_ms': p95 * 1000,
+        'p99_ms': p99 * 1000
+    }
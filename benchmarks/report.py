@@ -0,0 +1,57 @@
+# Reporting and regression gates for the benchmark suite
+
+import json
+import os
+
+LATENCY_KEYS = ['p50_ms', 'p95_ms', 'p99_ms']
+
+# Print the results as a table
+def format_table(results: dict) -> str:
+    """Return the per-endpoint results as an aligned text table."""
+    width = max([len(name) for name in results] + [8])
+    lines = [f"{'endpoint':<{width}}  {'req/s':>9}  {'mean':>8}  {'p50':>8}  {'p95':>8}  {'p99':>8}  {'errors':>6}"]
+    for name, stats in results.items():
+        lines.append(
+            f"{name:<{width}}  {stats['throughput']:>9.1f}  {stats['mean_ms']:>8.2f}  {stats['p50_ms']:>8.2f}  "
+            f"{stats['p95_ms']:>8.2f}  {stats['p99_ms']:>8.2f}  {stats['errors']:>6}"
+        )
+    return '\n'.join(lines)
+
+# Load a stored baseline
+def load_baseline(path: str):
+    """Return the stored results at path, or None when there is no baseline yet."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# Store results as the new baseline
+def save_baseline(path: str, results: dict, dataset: dict) -> None:
+    """Write the results and the dataset they were measured on to path."""
+    stored = {'dataset': dataset, 'endpoints': {
+        name: {key: stats[key] for key in ['throughput', 'mean_ms'] + LATENCY_KEYS} for name, stats in results.items()
+    }}
+    with open(path, 'w') as f:
+        json.dump(stored, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+# Compare results with a baseline
+def find_regressions(results: dict, baseline: dict, threshold: float, min_delta_ms: float) -> list:
+    """Return a description of every endpoint whose latency or throughput regressed by more than threshold.
+
+    Latency changes smaller than min_delta_ms are ignored, so sub-millisecond
+    endpoints do not fail the run on timer noise.
+    """
+    regressions = []
+    for name, stats in results.items():
+        base = baseline['endpoints'].get(name)
+        if base is None:
+            continue
+        for key in LATENCY_KEYS:
+            limit = base[key] * (1 + threshold)
+            if stats[key] > limit and stats[key] - base[key] > min_delta_ms:
+                regressions.append(f'{name}: {key} {stats[key]:.2f} > {base[key]:.2f} (+{threshold:.0%})')
+        floor = base['throughput'] * (1 - threshold)
+        if stats['throughput'] < floor:
+            regressions.append(f"{name}: throughput {stats['throughput']:.1f} < {base['throughput']:.1f} (-{threshold:.0%})")
+    return regressions
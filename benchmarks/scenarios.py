@@ -0,0 +1,236 @@
+# Request scenarios for the benchmark suite
+#
+# One scenario per route of the users, auth, teams, todos and settings
+# blueprints, plus the paginated, conditional and compressed variants of the listings.
+# Fixtures a request consumes (a user to delete, a todo to delete, ...) are
+# created by prepare() outside of the timed section.
+
+import datetime
+import itertools
+from uuid import uuid4
+from sqlalchemy import insert, select
+from app.extensions import db
+from app.models import User, Settings, Team, TeamMember, TodoItem
+from app.util.serializers import dumps
+from benchmarks.seed import BENCH_PASSWORD
+
+class Actor:
+    """A benchmark user with its own logged-in test client, driven by one load thread."""
+
+    def __init__(self, app, index: int, user: dict, team: dict, todo_public_id: str):
+        self.app = app
+        self.index = index
+        self.user = user
+        self.team = team
+        self.todo_public_id = todo_public_id
+        self.client = app.test_client()
+        self.anonymous = app.test_client()
+        self.scratch = app.test_client()
+        self.counter = itertools.count()
+        self.etags = {}
+        self.sync_cursor = None
+
+    def login(self) -> None:
+        """Log the actor's client in."""
+        response = self.client.post('/auth/login', json={'email': self.user['email'], 'password': BENCH_PASSWORD})
+        if response.status_code != 200:
+            raise RuntimeError(f"Could not log in {self.user['email']}: {response.status_code}")
+
+    def unique(self, prefix: str) -> str:
+        """Return a name no other actor or run uses."""
+        return f'{prefix}{self.index}x{next(self.counter)}x{uuid4().hex[:8]}'
+
+    def as_user(self, public_id: str):
+        """Return a client whose session is logged in as the given user, without going through /auth/login."""
+        with self.scratch.session_transaction() as session:
+            session.clear()
+            session['user_public_id'] = public_id
+        return self.scratch
+
+    def etag(self, path: str) -> str:
+        """Return the current ETag of a listing, fetched once per actor."""
+        if path not in self.etags:
+            self.etags[path] = self.client.get(path).headers['ETag']
+        return self.etags[path]
+
+    def change_cursor(self) -> int:
+        """Return a recent sync cursor of the actor, fetched once per actor."""
+        if self.sync_cursor is None:
+            self.sync_cursor = self.client.get('/todos/changes').get_json()['cursor']
+        return self.sync_cursor
+
+    def new_user(self) -> dict:
+        """Insert a user and their settings directly and return the user."""
+        now = datetime.datetime.utcnow()
+        user = {
+            'public_id': str(uuid4()),
+            'profile_name': self.unique('guest'),
+            'email': self.unique('guest') + '@bench.local',
+            'password': self.user['password'],
+            'last_password_change': now,
+            'joined_on': now,
+            'last_update': now,
+            'last_activity': now
+        }
+        user['id'] = db.session.execute(insert(User.__table__), user).inserted_primary_key[0]
+        db.session.execute(insert(Settings.__table__), [{'public_id': str(uuid4()), 'user_id': user['id']}])
+        db.session.commit()
+        return user
+
+    def new_team(self) -> str:
+        """Insert a team owned by the actor directly and return its public_id."""
+        public_id = str(uuid4())
+        owner = self.user['public_id']
+        team_id = db.session.execute(insert(Team.__table__), {
+            'public_id': public_id, 'owner_id': self.user['id'], 'name': self.unique('team'), 'members': [owner],
+            'is_active': True, 'deleted': False
+        }).inserted_primary_key[0]
+        db.session.execute(insert(TeamMember.__table__), [{'team_id': team_id, 'user_id': self.user['id'], 'role': 'owner'}])
+        db.session.commit()
+        return public_id
+
+    def new_todo(self) -> str:
+        """Insert a todo owned by the actor directly and return its public_id."""
+        todo_id = str(uuid4())
+        owner = self.user['public_id']
+        db.session.execute(insert(TodoItem.__table__), [{
+            'public_id': todo_id, 'user_id': self.user['id'], 'title': 'Disposable todo', 'created_by': owner
+        }])
+        db.session.commit()
+        return todo_id
+
+# NDJSON upload of new todos for the import scenario
+def import_body(actor: Actor, count: int) -> bytes:
+    """Return an import of count todos with fresh titles and no public IDs."""
+    prefix = actor.unique('imported')
+    return b''.join(
+        dumps({'type': 'todo', 'data': {'title': f'{prefix} {i}', 'summary': 'Imported by the benchmark'}}) + b'\n'
+        for i in range(count)
+    )
+
+class Scenario:
+    """A single request shape: path, body and headers are built from the actor and the prepare() fixtures.
+
+    body is sent as JSON, data as the raw request body.
+    """
+
+    def __init__(self, name: str, method: str, path, body=None, headers=None, prepare=None, status: int = 200, data=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.data = data
+        self.headers = headers
+        self.prepare = prepare
+        self.status = status
+
+    def request(self, actor: Actor):
+        """Return (client, method, path, kwargs) for one request, running prepare() first."""
+        fixtures = self.prepare(actor) if self.prepare else {}
+        client = fixtures.pop('client', actor.client)
+        kwargs = {}
+        if self.body is not None:
+            kwargs['json'] = self.body(actor, fixtures)
+        if self.data is not None:
+            kwargs['data'] = self.data(actor, fixtures)
+        if self.headers is not None:
+            kwargs['headers'] = self.headers(actor, fixtures)
+        return client, self.method, self.path(actor, fixtures), kwargs
+
+# Pick the actors of a run: users owning a team and at least one todo
+def load_actors(app, count: int) -> list:
+    """Return count logged-in actors backed by seeded users."""
+    with app.app_context():
+        owners = select(Team.owner_id, Team.public_id, Team.name).where(Team.deleted == False).order_by(Team.id)
+        actors = []
+        seen = set()
+        for owner, team_id, team_name in db.session.execute(owners):
+            if owner in seen:
+                continue
+            todo_id = db.session.execute(
+                select(TodoItem.public_id).where(TodoItem.user_id == owner).limit(1)
+            ).scalar()
+            if todo_id is None:
+                continue
+            user = db.session.execute(
+                select(User.id, User.public_id, User.email, User.profile_name, User.password).where(User.id == owner)
+            ).mappings().one()
+            seen.add(owner)
+            actors.append(Actor(app, len(actors), dict(user), {'public_id': team_id, 'name': team_name}, todo_id))
+            if len(actors) == count:
+                break
+    if len(actors) < count:
+        raise RuntimeError(f'The dataset only has {len(actors)} usable actors, {count} requested')
+    for actor in actors:
+        actor.login()
+    return actors
+
+SCENARIOS = [
+    # Auth
+    Scenario('auth.login', 'POST', lambda a, f: '/auth/login',
+             body=lambda a, f: {'email': a.user['email'], 'password': BENCH_PASSWORD}),
+    Scenario('auth.logout', 'POST', lambda a, f: '/auth/logout',
+             prepare=lambda a: {'client': a.as_user(a.user['public_id'])}),
+
+    # Users
+    Scenario('users.index', 'GET', lambda a, f: '/users/'),
+    Scenario('users.get_user', 'GET', lambda a, f: f"/users/{a.user['public_id']}"),
+    Scenario('users.get_user_teams', 'GET', lambda a, f: f"/users/{a.user['public_id']}/teams"),
+    Scenario('users.lookup_users', 'GET', lambda a, f: '/users/lookup?prefix=USER1'),
+    Scenario('users.export_user', 'GET', lambda a, f: f"/users/{a.user['public_id']}/export"),
+    Scenario('users.import_user', 'POST', lambda a, f: f"/users/{a.user['public_id']}/import",
+             data=lambda a, f: import_body(a, 100), headers=lambda a, f: {'Content-Type': 'application/x-ndjson'}),
+    Scenario('users.create_user', 'POST', lambda a, f: '/users/create',
+             body=lambda a, f: {'profile_name': a.unique('new'), 'email': a.unique('new') + '@bench.local', 'password': BENCH_PASSWORD},
+             prepare=lambda a: {'client': a.anonymous}, status=201),
+    Scenario('users.edit_user', 'PUT', lambda a, f: f"/users/edit/{a.user['public_id']}",
+             body=lambda a, f: {'profile_name': a.user['profile_name']}),
+    Scenario('users.delete_user', 'DELETE', lambda a, f: f"/users/delete/{f['public_id']}",
+             prepare=lambda a: (lambda user: {'public_id': user['public_id'], 'client': a.as_user(user['public_id'])})(a.new_user())),
+
+    # Teams
+    Scenario('teams.get_teams', 'GET', lambda a, f: '/teams/'),
+    Scenario('teams.get_teams[etag]', 'GET', lambda a, f: '/teams/',
+             headers=lambda a, f: {'If-None-Match': a.etag('/teams/')}, status=304),
+    Scenario('teams.get_teams[gzip]', 'GET', lambda a, f: '/teams/',
+             headers=lambda a, f: {'Accept-Encoding': 'gzip'}),
+    Scenario('teams.get_team', 'GET', lambda a, f: f"/teams/{a.team['public_id']}"),
+    Scenario('teams.create_team', 'POST', lambda a, f: '/teams/create',
+             body=lambda a, f: {'name': a.unique('team'), 'description': 'Created by the benchmark'}, status=201),
+    Scenario('teams.edit_team', 'PUT', lambda a, f: f"/teams/edit/{a.team['public_id']}",
+             body=lambda a, f: {'description': f'Edited {next(a.counter)}'}),
+    Scenario('teams.invite_member', 'POST', lambda a, f: f"/teams/invite/{a.team['name']}",
+             body=lambda a, f: {'profile_name': f['profile_name']},
+             prepare=lambda a: {'profile_name': a.new_user()['profile_name']}),
+    Scenario('teams.delete_team', 'DELETE', lambda a, f: f"/teams/delete/{f['team_id']}",
+             prepare=lambda a: {'team_id': a.new_team()}),
+
+    # Todos
+    Scenario('todos.get_todos', 'GET', lambda a, f: '/todos/'),
+    Scenario('todos.get_todos[page]', 'GET', lambda a, f: '/todos/?limit=50'),
+    Scenario('todos.get_todos[filter]', 'GET', lambda a, f: '/todos/?completed=false&sort=due_date&limit=50'),
+    Scenario('todos.get_todos[etag]', 'GET', lambda a, f: '/todos/',
+             headers=lambda a, f: {'If-None-Match': a.etag('/todos/')}, status=304),
+    Scenario('todos.get_todos[gzip]', 'GET', lambda a, f: '/todos/',
+             headers=lambda a, f: {'Accept-Encoding': 'gzip'}),
+    Scenario('todos.get_todo', 'GET', lambda a, f: f'/todos/{a.todo_public_id}'),
+    Scenario('todos.get_todo_stats', 'GET', lambda a, f: '/todos/stats'),
+    Scenario('todos.get_todo_changes', 'GET', lambda a, f: f"/todos/changes?since={f['since']}",
+             prepare=lambda a: {'since': a.change_cursor()}),
+    Scenario('todos.search_todos', 'GET', lambda a, f: '/todos/search?q=benchmark+todo+1*'),
+    Scenario('todos.get_team_todos', 'GET', lambda a, f: f"/todos/team/{a.team['public_id']}"),
+    Scenario('todos.create_todo', 'POST', lambda a, f: '/todos/create',
+             body=lambda a, f: {'title': 'Benchmark todo', 'priority': 'high', 'due_date': '2030-01-01T09:00:00'}, status=201),
+    Scenario('todos.edit_todo', 'PUT', lambda a, f: f'/todos/edit/{a.todo_public_id}',
+             body=lambda a, f: {'summary': f'Edited {next(a.counter)}'}),
+    Scenario('todos.bulk_todos', 'POST', lambda a, f: '/todos/bulk',
+             body=lambda a, f: {'operations': [{'op': 'create', 'title': f'Bulk {i}'} for i in range(10)]}),
+    Scenario('todos.delete_todo', 'DELETE', lambda a, f: f"/todos/delete/{f['todo_id']}",
+             prepare=lambda a: {'todo_id': a.new_todo()}),
+
+    # Settings
+    Scenario('settings.get_settings', 'GET', lambda a, f: '/settings/'),
+    Scenario('settings.edit_settings', 'PUT', lambda a, f: '/settings/edit',
+             body=lambda a, f: {'theme': 'dark'}),
+    Scenario('settings.reset_settings', 'POST', lambda a, f: '/settings/reset')
+]
@@ -0,0 +1,133 @@
+# Dataset seeding for the benchmark suite
+#
+# Rows are written with executemany Core inserts in large batches, which is
+# orders of magnitude faster than going through the API. Every user shares one
+# precomputed password hash so seeding does not spend minutes hashing.
+
+import datetime
+import random
+from uuid import UUID
+from sqlalchemy import insert, text
+from app.extensions import db
+from app.models import User, Settings, Team, TeamMember, TodoItem
+from app.util.auth import hash_password
+
+BENCH_PASSWORD = 'BenchPassword1!'
+BATCH_SIZE = 10000
+PRIORITIES = ['low', 'normal', 'normal', 'high']
+
+# Deterministic uuid4 strings for a seeded random generator
+def _uuid(rng: random.Random) -> str:
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+# Team sizes follow a long tail: most teams are small, a few are large
+def _team_size(rng: random.Random, users: int) -> int:
+    return max(2, min(users, 200, int(rng.lognormvariate(1.6, 0.8))))
+
+# Insert rows in batches, committing after each one
+def _insert(model, rows) -> int:
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            db.session.execute(insert(model.__table__), batch)
+            db.session.commit()
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(model.__table__), batch)
+        db.session.commit()
+        count += len(batch)
+    return count
+
+def seed(users: int, teams: int, todos: int, seed: int = 0, log=print) -> dict:
+    """Seed the database of the current app with a deterministic dataset and return its sizes."""
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    password = hash_password(BENCH_PASSWORD)
+
+    # Rows go into empty tables, so ids are assigned here and references need no lookups
+    user_ids = [_uuid(rng) for _ in range(users)]
+    user_keys = {public_id: i + 1 for i, public_id in enumerate(user_ids)}
+    log(f'Seeding {users} users')
+    _insert(User, ({
+        'id': i + 1,
+        'public_id': public_id,
+        'profile_name': f'user{i}',
+        'email': f'user{i}@bench.local',
+        'password': password,
+        'last_password_change': now,
+        'joined_on': now,
+        'last_update': now,
+        'last_activity': now
+    } for i, public_id in enumerate(user_ids)))
+    _insert(Settings, ({
+        'public_id': _uuid(rng),
+        'user_id': user_keys[public_id],
+        'theme': 'light',
+        'separate_teams_todos': False,
+        'hide_completed_todos': False,
+        'language': 'en',
+        'timezone': 'UTC'
+    } for public_id in user_ids))
+
+    log(f'Seeding {teams} teams')
+    team_rows = []
+    member_rows = []
+    user_teams = {}
+    for i in range(teams):
+        team_id = i + 1
+        public_id = _uuid(rng)
+        owner = rng.choice(user_ids)
+        members = [owner] + [m for m in rng.sample(user_ids, _team_size(rng, users)) if m != owner]
+        team_rows.append({
+            'id': team_id,
+            'public_id': public_id,
+            'owner_id': user_keys[owner],
+            'name': f'team{i}',
+            'description': f'Benchmark team {i}',
+            'members': members,
+            'is_active': True,
+            'deleted': False,
+            'last_activity': now,
+            'created_on': now
+        })
+        for member in members:
+            member_rows.append({
+                'team_id': team_id,
+                'user_id': user_keys[member],
+                'role': 'owner' if member == owner else 'member',
+                'joined_on': now
+            })
+            user_teams.setdefault(member, []).append(team_id)
+    _insert(Team, team_rows)
+    memberships = _insert(TeamMember, member_rows)
+
+    log(f'Seeding {todos} todos')
+    def todo_rows():
+        for i in range(todos):
+            owner = rng.choice(user_ids)
+            teams_of_owner = user_teams.get(owner)
+            # About a third of the todos of team members are assigned to one of their teams
+            assigned = rng.choice(teams_of_owner) if teams_of_owner and rng.random() < 0.33 else None
+            due = now + datetime.timedelta(days=rng.randint(-60, 60)) if rng.random() < 0.8 else None
+            yield {
+                'public_id': _uuid(rng),
+                'user_id': user_keys[owner],
+                'visibility': 'team' if assigned else 'public',
+                'title': f'Todo {i}',
+                'summary': f'Benchmark todo {i}',
+                'due_date': due,
+                'completed': rng.random() < 0.4,
+                'priority': rng.choice(PRIORITIES),
+                'team_id': assigned,
+                'shared_with': None,
+                'created_by': owner,
+                'created_on': now
+            }
+    _insert(TodoItem, todo_rows())
+
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+    return {'users': users, 'teams': teams, 'team_members': memberships, 'todos': todos, 'seed': seed}
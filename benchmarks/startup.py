@@ -0,0 +1,106 @@
+# Startup benchmark for the api
+#
+# python -m benchmarks.startup                 measure and check the targets
+# python -m benchmarks.startup --runs 10       more runs for steadier medians
+#
+# Each run starts a fresh interpreter against an up-to-date database and times
+# importing the app, creating it and serving a first request. A preloaded
+# master then forks workers and times how long each takes to serve its first
+# request, which is what scaling out costs with gunicorn --preload. The run
+# exits with status 1 when a median misses its target.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Median targets in milliseconds
+STARTUP_TARGETS_MS = {
+    'import': 1000.0,
+    'boot': 100.0,
+    'first_request': 50.0,
+    'forked_first_request': 25.0
+}
+
+# Timed in a fresh interpreter, prints the phases as JSON
+PROBE = '''
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+imported = time.perf_counter()
+application = app.create_app()
+booted = time.perf_counter()
+application.test_client().get('/users/')
+served = time.perf_counter()
+results = {{
+    'import': (imported - started) * 1000,
+    'boot': (booted - imported) * 1000,
+    'first_request': (served - booted) * 1000,
+    'forked_first_request': []
+}}
+for _ in range({workers}):
+    read_end, write_end = os.pipe()
+    forked = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        application.test_client().get('/users/')
+        os.write(write_end, str((time.perf_counter() - forked) * 1000).encode())
+        os._exit(0)
+    os.close(write_end)
+    results['forked_first_request'].append(float(os.read(read_end, 64)))
+    os.close(read_end)
+    os.waitpid(pid, 0)
+print(json.dumps(results))
+'''
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup', description='Import and boot time of the api.')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to start (default 5)')
+    parser.add_argument('--workers', type=int, default=4, help='workers forked from each preloaded master (default 4)')
+    parser.add_argument('--workdir', help='directory of the database, a temporary one by default')
+    args = parser.parse_args(argv)
+    if args.runs < 1 or args.workers < 0:
+        parser.error('--runs must be positive and --workers not negative')
+    return args
+
+# Run the probe once in a fresh interpreter
+def _probe(workdir: str, workers: int) -> dict:
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE.format(root=ROOT, workers=workers)],
+        cwd=workdir, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as temporary:
+        workdir = args.workdir or temporary
+        os.makedirs(os.path.join(workdir, 'app', 'data'), exist_ok=True)
+        # The first boot creates and stamps the database, the timed ones find it current
+        _probe(workdir, 0)
+        samples = {phase: [] for phase in STARTUP_TARGETS_MS}
+        for _ in range(args.runs):
+            result = _probe(workdir, args.workers)
+            for phase in ('import', 'boot', 'first_request'):
+                samples[phase].append(result[phase])
+            samples['forked_first_request'].extend(result['forked_first_request'])
+
+    status = 0
+    print(f"{'phase':<22}  {'median':>8}  {'max':>8}  {'target':>8}")
+    for phase, target in STARTUP_TARGETS_MS.items():
+        if not samples[phase]:
+            continue
+        median = statistics.median(samples[phase])
+        missed = median > target
+        status = 1 if missed else status
+        print(f"{phase:<22}  {median:>8.1f}  {max(samples[phase]):>8.1f}  {target:>8.1f}{'  MISSED' if missed else ''}")
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,13 @@
+# Gunicorn settings for the api, read by gunicorn wsgi:app
+#
+# The app is created once in the master and the workers are forked from it, so
+# scaling out does not repeat the imports or the schema check. Each worker
+# opens its own SQLite connections after the fork (see app.dispose_engines).
+
+import multiprocessing
+import os
+
+bind = os.environ.get('TODONE_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('TODONE_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('TODONE_THREADS', 4))
+preload_app = True
@@ -2,8 +2,9 @@
 
 from app import create_app, config
 
-app = create_app()
 testing = config.Config.TESTING
 
+# Password hashing children are spawned and re-import this module, only the parent boots the app
 if __name__ == '__main__':
+    app = create_app()
     app.run(debug=testing)
@@ -0,0 +1,57 @@
+# Fixtures for the tests
+#
+# Every test gets an app on its own database under tmp_path. app.config derives
+# its paths from the working directory when it is imported, so the factory
+# moves into tmp_path and reloads it before creating the app.
+
+import importlib
+import os
+import pytest
+from app import config, create_app, dispose_engines
+
+PASSWORD = 'password1'
+SYSTEM_TOKEN = 'token'
+
+# Create apps on databases under tmp_path, keyword arguments override settings of Config
+@pytest.fixture
+def app_factory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('app/data', exist_ok=True)
+    apps = []
+
+    def make(**settings):
+        importlib.reload(config)
+        # Cheap hashes in the request thread, and purges run by the tests themselves
+        config.Config.PASSWORD_HASH_METHOD = 'pbkdf2:sha256'
+        config.Config.PASSWORD_HASH_ITERATIONS = 1000
+        config.Config.PASSWORD_HASH_WORKERS = 0
+        config.Config.PURGE_ENABLED = False
+        # Views going over their statement budget fail the test
+        config.Config.QUERY_BUDGET_STRICT = True
+        for name, value in settings.items():
+            setattr(config.Config, name, value)
+        app = create_app()
+        app.config['SYSTEM_TOKEN'] = SYSTEM_TOKEN
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        dispose_engines(app)
+
+# An app on an empty database
+@pytest.fixture
+def app(app_factory):
+    return app_factory()
+
+# Sign up users, each with a logged in client of its own
+@pytest.fixture
+def make_user(app):
+    def make(name: str):
+        client = app.test_client()
+        response = client.post('/users/create', json={'profile_name': name, 'email': f'{name}@example.com', 'password': PASSWORD})
+        assert response.status_code == 201, response.get_json()
+        response = client.post('/auth/login', json={'email': f'{name}@example.com', 'password': PASSWORD})
+        assert response.status_code == 200, response.get_json()
+        return client, response.get_json()['public_id']
+    return make
@@ -0,0 +1,77 @@
+# Tests for the ASGI entry point
+
+import asyncio
+from app.asgi import AsgiApp
+from app.util.async_db import ASYNC_VIEWS, dispose_async_db
+
+# Endpoints with a coroutine view, and the name it is registered under
+ASYNC_ENDPOINTS = [
+    ('/todos/', b'', 'todos.get_todos'),
+    ('/todos/', b'limit=2', 'todos.get_todos'),
+    ('/todos/', b'completed=false&sort=-title', 'todos.get_todos'),
+    ('/teams/', b'', 'teams.get_teams'),
+    ('/settings/', b'', 'settings.get_settings')
+]
+
+# Send a GET through the ASGI app, returning (status, headers, body)
+async def _get(asgi, path: str, query: bytes, headers: list) -> tuple:
+    messages = []
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+    async def send(message):
+        messages.append(message)
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': headers,
+        'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80)
+    }
+    await asgi(scope, receive, send)
+    start, *bodies = messages
+    return start['status'], dict(start['headers']), b''.join(message.get('body', b'') for message in bodies)
+
+def test_coroutine_views_answer_like_their_sync_views(app, make_user, monkeypatch):
+    client, _ = make_user('alice')
+    team = client.post('/teams/create', json={'name': 'alices'}).get_json()['public_id']
+    for title in ('b', 'a', 'c'):
+        client.post('/todos/create', json={'title': title, 'assigned_to': team})
+    cookie = [(b'cookie', f"session={client.get_cookie('session').value}".encode('latin-1'))]
+
+    # Count the requests the coroutine views served without handing them to the sync view
+    served = []
+    for endpoint, view in list(ASYNC_VIEWS.items()):
+        async def spy(*args, view=view, endpoint=endpoint, **kwargs):
+            response = await view(*args, **kwargs)
+            served.append(endpoint)
+            return response
+        monkeypatch.setitem(ASYNC_VIEWS, endpoint, spy)
+
+    async def run():
+        asgi = AsgiApp(app)
+        try:
+            for path, query, endpoint in ASYNC_ENDPOINTS:
+                expected = client.get(f"{path}?{query.decode('latin-1')}")
+                del served[:]
+                status, headers, body = await _get(asgi, path, query, cookie)
+                assert served == [endpoint]
+                assert (status, body) == (200, expected.get_data())
+                assert headers[b'etag'].decode('latin-1') == expected.headers['ETag']
+                status, _, body = await _get(asgi, path, query, cookie + [(b'if-none-match', headers[b'etag'])])
+                assert (status, body) == (304, b'')
+        finally:
+            await dispose_async_db(app)
+            asgi.executor.shutdown()
+    asyncio.run(run())
+
+def test_requests_without_a_coroutine_view_reach_the_sync_view(app, make_user):
+    client, _ = make_user('alice')
+    client.post('/todos/create', json={'title': 'only'})
+    cookie = [(b'cookie', f"session={client.get_cookie('session').value}".encode('latin-1'))]
+
+    async def run():
+        asgi = AsgiApp(app)
+        try:
+            status, _, body = await _get(asgi, '/todos/stats', b'', cookie)
+            assert (status, body) == (200, client.get('/todos/stats').get_data())
+        finally:
+            await dispose_async_db(app)
+            asgi.executor.shutdown()
+    asyncio.run(run())
@@ -0,0 +1,49 @@
+# Tests for authentication
+
+import os
+from sqlalchemy import select
+from app.extensions import db
+from app.models import User
+from app.util import auth
+from tests.conftest import PASSWORD
+
+# Stored password hash of a user
+def _stored_hash(app, email: str) -> str:
+    with app.app_context():
+        return db.session.scalar(select(User.password).where(User.email == email))
+
+def test_login_rehashes_passwords_made_with_outdated_parameters(app_factory):
+    old = app_factory()
+    client = old.test_client()
+    client.post('/users/create', json={'profile_name': 'alice', 'email': 'alice@example.com', 'password': PASSWORD})
+    assert _stored_hash(old, 'alice@example.com').startswith('pbkdf2:sha256:1000$')
+
+    new = app_factory(PASSWORD_HASH_ITERATIONS=2000)
+    client = new.test_client()
+    assert client.post('/auth/login', json={'email': 'alice@example.com', 'password': 'wrong'}).status_code == 401
+    assert _stored_hash(new, 'alice@example.com').startswith('pbkdf2:sha256:1000$')
+    assert client.post('/auth/login', json={'email': 'alice@example.com', 'password': PASSWORD}).status_code == 200
+    assert _stored_hash(new, 'alice@example.com').startswith('pbkdf2:sha256:2000$')
+    assert new.test_client().post('/auth/login', json={'email': 'alice@example.com', 'password': PASSWORD}).status_code == 200
+
+def test_hashes_run_in_the_process_pool(app_factory):
+    app_factory(PASSWORD_HASH_WORKERS=1)
+    try:
+        assert auth._run(os.getpid) != os.getpid()
+        hashed = auth.hash_password(PASSWORD)
+        assert auth.verify_password(PASSWORD, hashed) is True
+        assert auth.verify_password('wrong', hashed) is False
+    finally:
+        auth.shutdown_hashing()
+
+def test_a_full_hashing_queue_answers_503(app_factory):
+    app = app_factory(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_QUEUE_DEPTH=1)
+    client = app.test_client()
+    assert auth._slots.acquire(blocking=False)
+    try:
+        response = client.post('/users/create', json={'profile_name': 'alice', 'email': 'alice@example.com', 'password': PASSWORD})
+    finally:
+        auth._slots.release()
+        auth.shutdown_hashing()
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
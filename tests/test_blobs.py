@@ -0,0 +1,39 @@
+# Tests for stored images
+
+import base64
+import hashlib
+import os
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 64
+
+# Digests of the blobs on disk
+def _stored(app) -> list:
+    return sorted(name for _, _, names in os.walk(app.config['BLOB_STORE_PATH']) for name in names)
+
+def test_images_are_stored_once_and_served_by_digest(app, make_user):
+    client, _ = make_user('alice')
+    image = base64.b64encode(PNG).decode('ascii')
+    first = client.post('/teams/create', json={'name': 'first', 'team_image': image}).get_json()['public_id']
+    second = client.post('/teams/create', json={'name': 'second', 'team_image': image}).get_json()['public_id']
+    digest = client.get(f'/teams/{first}').get_json()['team_image']
+    assert digest == hashlib.sha256(PNG).hexdigest()
+    assert client.get(f'/teams/{second}').get_json()['team_image'] == digest
+    assert _stored(app) == [digest]
+
+    response = client.get(f'/blobs/{digest}')
+    assert (response.status_code, response.mimetype, response.get_data()) == (200, 'image/png', PNG)
+    assert 'private' in response.headers['Cache-Control'] and 'immutable' in response.headers['Cache-Control']
+    assert client.get(f'/blobs/{digest}', headers={'If-None-Match': f'"{digest}"'}).status_code == 304
+    assert client.get('/blobs/not-a-digest').status_code == 404
+    assert app.test_client().get(f'/blobs/{digest}').status_code == 401
+
+def test_rejected_edits_leave_no_blob_behind(app, make_user):
+    client, alice = make_user('alice')
+    team = client.post('/teams/create', json={'name': 'plain'}).get_json()['public_id']
+    image = base64.b64encode(PNG).decode('ascii')
+    response = client.put(f'/teams/edit/{team}', json={'team_image': image, 'members': ['missing']})
+    assert response.status_code == 400
+    response = client.put(f'/users/edit/{alice}', json={'profile_picture': image, 'password': 'wrong', 'new_password': 'password2'})
+    assert response.status_code == 400
+    assert _stored(app) == []
+    assert client.get(f'/teams/{team}').get_json()['team_image'] is None
@@ -0,0 +1,72 @@
+# Tests for the in-process caches
+
+import types
+import pytest
+from app.util import cache
+from app.util.cache import LRUCache, settings_cache, user_cache
+from app.util.query_budget import query_budget
+from tests.conftest import PASSWORD, SYSTEM_TOKEN
+
+# A clock the cache reads instead of time.monotonic
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+def test_least_recently_used_entries_are_evicted_first(clock):
+    lru = LRUCache('test', maxsize=2, ttl=60)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (1, None, 3)
+    assert lru.stats()['evictions'] == 1
+
+def test_entries_expire_after_the_ttl(clock):
+    lru = LRUCache('test', maxsize=10, ttl=60)
+    lru.set('a', 1)
+    clock[0] += 59
+    assert lru.get('a') == 1
+    clock[0] += 2
+    assert lru.get('a') is None
+    assert lru.stats()['size'] == 0
+
+def test_loaded_none_is_not_cached(clock):
+    lru = LRUCache('test', maxsize=10, ttl=60)
+    loads = []
+    assert lru.get_or_load('a', lambda: loads.append('a')) is None
+    assert lru.get_or_load('a', lambda: loads.append('a') or 7) == 7
+    assert lru.get_or_load('a', lambda: loads.append('a')) == 7
+    assert loads == ['a', 'a']
+    lru.invalidate('a')
+    assert lru.get('a') is None
+
+def test_cached_settings_are_served_without_reading_them_again(make_user):
+    client, _ = make_user('alice')
+    client.get('/settings/')
+    with query_budget(100, strict=False) as warm:
+        client.get('/settings/')
+    settings_cache.clear()
+    with query_budget(100, strict=False) as cold:
+        client.get('/settings/')
+    assert warm.count < cold.count
+
+def test_profile_edits_invalidate_the_cached_user(app, make_user):
+    client, alice = make_user('alice')
+    assert client.get(f'/users/{alice}').get_json()['profile_name'] == 'alice'
+    assert user_cache.get(alice) is not None
+    client.put(f'/users/edit/{alice}', json={'profile_name': 'Alicia', 'email': 'alicia@example.com'})
+    assert client.get(f'/users/{alice}').get_json()['profile_name'] == 'Alicia'
+
+    login = app.test_client()
+    assert login.post('/auth/login', json={'email': 'alice@example.com', 'password': PASSWORD}).status_code == 401
+    assert login.post('/auth/login', json={'email': 'alicia@example.com', 'password': PASSWORD}).status_code == 200
+
+def test_cache_stats_count_hits_and_misses(app, make_user):
+    client, _ = make_user('alice')
+    client.get('/settings/')
+    client.get('/settings/')
+    stats = app.test_client().get('/cache/stats', headers={'Authorization': f'Bearer {SYSTEM_TOKEN}'}).get_json()
+    assert stats['settings']['hits'] >= 1
+    assert stats['settings']['misses'] >= 1
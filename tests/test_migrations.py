@@ -0,0 +1,111 @@
+# Tests for migrations
+
+import logging
+import sqlite3
+from app.migrations import latest_version
+from tests.conftest import PASSWORD
+
+# The schema before migration 1, keyed by public IDs
+LEGACY_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL, public_id VARCHAR(120) NOT NULL, profile_name VARCHAR(120) NOT NULL,
+    email VARCHAR(120) NOT NULL, password VARCHAR(128) NOT NULL, last_password_change DATETIME,
+    joined_on DATETIME, last_update DATETIME, last_activity DATETIME, profile_picture BLOB,
+    PRIMARY KEY (id), UNIQUE (public_id), UNIQUE (email)
+);
+CREATE TABLE teams (
+    id INTEGER NOT NULL, public_id VARCHAR(120) NOT NULL, owner_public_id VARCHAR(120) NOT NULL,
+    name VARCHAR(120) NOT NULL, description VARCHAR(500), members JSON, team_image BLOB,
+    is_active BOOLEAN, deleted BOOLEAN, last_activity DATETIME, created_on DATETIME,
+    PRIMARY KEY (id), UNIQUE (public_id)
+);
+CREATE TABLE settings (
+    id INTEGER NOT NULL, public_id VARCHAR(120) NOT NULL, user_public_id VARCHAR(120) NOT NULL,
+    theme VARCHAR(50), separate_teams_todos BOOLEAN, hide_completed_todos BOOLEAN,
+    language VARCHAR(50), timezone VARCHAR(50),
+    PRIMARY KEY (id), UNIQUE (public_id),
+    FOREIGN KEY(user_public_id) REFERENCES users (public_id) ON DELETE CASCADE
+);
+CREATE TABLE todo_items (
+    id INTEGER NOT NULL, public_id VARCHAR(120) NOT NULL, user_public_id VARCHAR(120) NOT NULL,
+    visibility VARCHAR(50), title VARCHAR(200) NOT NULL, summary VARCHAR(500), due_date DATETIME,
+    completed BOOLEAN, priority VARCHAR(50), assigned_to VARCHAR(120), shared_with JSON,
+    created_by VARCHAR(50) NOT NULL, created_on DATETIME,
+    PRIMARY KEY (id), UNIQUE (public_id),
+    FOREIGN KEY(user_public_id) REFERENCES users (public_id)
+);
+INSERT INTO users (id, public_id, profile_name, email, password, joined_on) VALUES
+    (1, 'u-alice', 'Alice', 'alice@example.com', 'x', '2021-01-01 00:00:00'),
+    (2, 'u-bob', 'bob', 'bob@example.com', 'x', '2020-01-01 00:00:00');
+INSERT INTO teams (id, public_id, owner_public_id, name, members, is_active, deleted) VALUES
+    (1, 't-one', 'u-alice', 'one', '["u-alice", "u-bob", "u-ghost"]', 1, 0),
+    (2, 't-orphan', 'u-ghost', 'orphan', '["u-ghost"]', 1, 0),
+    (3, 't-inherited', 'u-ghost', 'inherited', '["u-ghost", "u-alice", "u-bob"]', 1, 0);
+INSERT INTO settings (id, public_id, user_public_id, theme) VALUES
+    (1, 's-alice', 'u-alice', 'dark'),
+    (2, 's-ghost', 'u-ghost', 'dark');
+INSERT INTO todo_items (id, public_id, user_public_id, title, summary, completed, assigned_to, created_by) VALUES
+    (1, 'a-1', 'u-alice', 'water the plants', NULL, 0, 't-one', 'u-alice'),
+    (2, 'a-2', 'u-alice', 'file taxes', 'before april', 1, 't-gone', 'u-alice'),
+    (3, 'b-1', 'u-bob', 'buy milk', NULL, 0, NULL, 'u-bob'),
+    (4, 'g-1', 'u-ghost', 'haunt', NULL, 0, NULL, 'u-ghost'),
+    (5, 'a-3', 'u-alice', 'orphaned task', NULL, 0, 't-orphan', 'u-alice');
+"""
+
+# Create the legacy database where the app will find it, then start the app on it
+def _upgraded(tmp_path, app_factory) -> sqlite3.Connection:
+    path = tmp_path / 'app' / 'data' / 'todone.db'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with sqlite3.connect(path) as connection:
+        connection.executescript(LEGACY_SCHEMA)
+    connection.close()
+    app_factory()
+    return sqlite3.connect(path)
+
+def test_legacy_database_is_upgraded_to_the_latest_version(tmp_path, app_factory):
+    connection = _upgraded(tmp_path, app_factory)
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == latest_version()
+    assert connection.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+    assert connection.execute('PRAGMA foreign_key_check').fetchall() == []
+
+def test_references_become_integer_keys_and_dangling_rows_go(tmp_path, app_factory, caplog):
+    with caplog.at_level(logging.WARNING, logger='app.migrations'):
+        connection = _upgraded(tmp_path, app_factory)
+    assert connection.execute('SELECT id, owner_id FROM teams ORDER BY id').fetchall() == [(1, 1), (3, 2)]
+    assert connection.execute('SELECT id, user_id FROM settings ORDER BY id').fetchall() == [(1, 1)]
+    assert connection.execute('SELECT id, user_id, team_id FROM todo_items ORDER BY id').fetchall() == [
+        (1, 1, 1), (2, 1, None), (3, 2, None), (5, 1, None)
+    ]
+    assert connection.execute('SELECT team_id, user_id, role FROM team_members ORDER BY team_id, user_id').fetchall() == [
+        (1, 1, 'owner'), (1, 2, 'member'), (3, 1, 'member'), (3, 2, 'owner')
+    ]
+    # Every row dropped or changed is reported
+    assert 'Team t-inherited of missing user u-ghost was handed to its member u-bob' in caplog.text
+    assert 'Dropped 1 teams rows whose owner_public_id names a missing row of users: t-orphan' in caplog.text
+    assert 'Dropped 1 settings rows whose user_public_id names a missing row of users: s-ghost' in caplog.text
+    assert 'Dropped 1 todo_items rows whose user_public_id names a missing row of users: g-1' in caplog.text
+    assert 'Cleared assigned_to of 2 todo_items rows naming a missing row of teams: a-2, a-3' in caplog.text
+
+def test_derived_tables_are_filled_from_existing_rows(tmp_path, app_factory):
+    connection = _upgraded(tmp_path, app_factory)
+    counters = dict(connection.execute(
+        "SELECT scope || ':' || ref_id || ':' || bucket, count FROM todo_counters WHERE bucket IN ('total', 'open', 'completed')"
+    ).fetchall())
+    assert counters == {
+        'user:1:total': 3, 'user:1:open': 2, 'user:1:completed': 1,
+        'user:2:total': 1, 'user:2:open': 1,
+        'team:1:total': 1, 'team:1:open': 1
+    }
+    matches = connection.execute("SELECT rowid FROM todo_items_fts WHERE todo_items_fts MATCH 'april'").fetchall()
+    assert matches == [(2,)]
+    assert connection.execute('SELECT count(*) FROM todo_items WHERE change_seq = 0').fetchone()[0] == 0
+    assert connection.execute('SELECT profile_name_key FROM users ORDER BY id').fetchall() == [('alice',), ('bob',)]
+
+def test_upgraded_database_serves_its_users(tmp_path, app_factory):
+    _upgraded(tmp_path, app_factory).close()
+    client = app_factory().test_client()
+    client.post('/users/create', json={'profile_name': 'carol', 'email': 'carol@example.com', 'password': PASSWORD})
+    client.post('/auth/login', json={'email': 'carol@example.com', 'password': PASSWORD})
+    assert client.post('/todos/create', json={'title': 'after the upgrade'}).status_code == 201
+    assert [todo['title'] for todo in client.get('/todos/').get_json()] == ['after the upgrade']
+    assert [user['profile_name'] for user in client.get('/users/lookup?prefix=al').get_json()] == ['Alice']
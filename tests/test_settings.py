@@ -1 +1,47 @@
-# Tests for settings
\ No newline at end of file
+# Tests for settings
+
+from sqlalchemy import select, update
+from app.extensions import db
+from app.models import Settings, User
+from app.util.versions import bump_versions
+
+# Change settings the way another worker would, leaving this worker's cache alone
+def _write_from_another_worker(app, public_id: str, **values) -> None:
+    with app.app_context():
+        user_id = db.session.scalar(select(User.id).where(User.public_id == public_id))
+        db.session.execute(update(Settings).where(Settings.user_id == user_id).values(**values))
+        bump_versions(users=[user_id])
+        db.session.commit()
+
+def test_settings_answer_304_until_edited(make_user):
+    client, _ = make_user('alice')
+    response = client.get('/settings/')
+    assert response.get_json()['theme'] == 'light'
+    etag = response.headers['ETag']
+    assert client.get('/settings/', headers={'If-None-Match': etag}).status_code == 304
+    assert client.put('/settings/edit', json={'theme': 'dark'}).status_code == 200
+    response = client.get('/settings/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['theme'] == 'dark'
+
+def test_cached_settings_follow_writes_of_other_workers(app, make_user):
+    client, alice = make_user('alice')
+    assert client.get('/settings/').get_json()['theme'] == 'light'
+    _write_from_another_worker(app, alice, theme='solarized')
+    assert client.get('/settings/').get_json()['theme'] == 'solarized'
+
+def test_listing_defaults_follow_settings_written_by_other_workers(app, make_user):
+    client, alice = make_user('alice')
+    done = client.post('/todos/create', json={'title': 'done'}).get_json()['public_id']
+    client.post('/todos/create', json={'title': 'open'})
+    client.put(f'/todos/edit/{done}', json={'completed': True})
+    assert len(client.get('/todos/').get_json()) == 2
+    _write_from_another_worker(app, alice, hide_completed_todos=True)
+    assert [todo['title'] for todo in client.get('/todos/').get_json()] == ['open']
+
+def test_reset_restores_the_defaults(make_user):
+    client, _ = make_user('alice')
+    client.put('/settings/edit', json={'theme': 'dark', 'language': 'fr'})
+    assert client.post('/settings/reset').status_code == 200
+    settings = client.get('/settings/').get_json()
+    assert (settings['theme'], settings['language']) == ('light', 'en')
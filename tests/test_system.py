@@ -0,0 +1,24 @@
+# Tests for the operational endpoints
+
+import pytest
+from tests.conftest import SYSTEM_TOKEN
+
+SYSTEM_ENDPOINTS = ['/metrics', '/cache/stats', '/purge/stats']
+
+@pytest.mark.parametrize('path', SYSTEM_ENDPOINTS)
+def test_system_endpoints_require_the_token(app, path):
+    client = app.test_client()
+    assert client.get(path).status_code == 403
+    assert client.get(path, headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get(path, headers={'Authorization': f'Bearer {SYSTEM_TOKEN}'}).status_code == 200
+
+@pytest.mark.parametrize('path', SYSTEM_ENDPOINTS)
+def test_system_endpoints_are_hidden_without_a_token(app, path):
+    app.config['SYSTEM_TOKEN'] = None
+    assert app.test_client().get(path, headers={'Authorization': 'Bearer anything'}).status_code == 404
+
+def test_purge_stats_report_pending_jobs(app, make_user):
+    client, alice = make_user('alice')
+    client.delete(f'/users/delete/{alice}')
+    stats = app.test_client().get('/purge/stats', headers={'Authorization': f'Bearer {SYSTEM_TOKEN}'}).get_json()
+    assert stats['pending'] == 1
@@ -1 +1,90 @@
-# Tests for teams
\ No newline at end of file
+# Tests for teams
+
+from sqlalchemy import func, select
+from app.extensions import db
+from app.models import Team, TodoItem
+from app.util.purge import purge_pending
+
+def test_members_see_the_todos_assigned_to_the_team(make_user):
+    alice, alice_id = make_user('alice')
+    bob, bob_id = make_user('bob')
+    team = alice.post('/teams/create', json={'name': 'shared', 'members': [alice_id, bob_id]}).get_json()['public_id']
+    alice.post('/todos/create', json={'title': 'for the team', 'assigned_to': team})
+    alice.post('/todos/create', json={'title': 'private'})
+
+    assert [todo['title'] for todo in bob.get(f'/todos/team/{team}').get_json()] == ['for the team']
+    assert [todo['title'] for todo in bob.get('/todos/').get_json()] == ['for the team']
+    assert [team['name'] for team in bob.get('/teams/').get_json()] == ['shared']
+
+def test_edit_does_not_set_the_deleted_flag(make_user):
+    alice, _ = make_user('alice')
+    team = alice.post('/teams/create', json={'name': 'kept'}).get_json()['public_id']
+    response = alice.put(f'/teams/edit/{team}', json={'description': 'still here', 'deleted': True})
+    assert response.status_code == 200
+    listed = alice.get(f'/teams/{team}').get_json()
+    assert listed['description'] == 'still here'
+    assert listed['deleted'] is False
+
+def test_only_the_owner_deletes_a_team(make_user):
+    alice, _ = make_user('alice')
+    bob, bob_id = make_user('bob')
+    team = alice.post('/teams/create', json={'name': 'owned', 'members': [bob_id]}).get_json()['public_id']
+    assert bob.delete(f'/teams/delete/{team}').status_code == 403
+    assert alice.delete(f'/teams/delete/{team}').status_code == 200
+    assert bob.get('/teams/').get_json() == []
+    assert bob.get(f'/teams/{team}').status_code == 404
+
+def test_deleted_team_is_purged_with_its_todos(app, make_user):
+    alice, _ = make_user('alice')
+    team = alice.post('/teams/create', json={'name': 'doomed'}).get_json()['public_id']
+    alice.post('/todos/bulk', json={'operations': [{'op': 'create', 'title': f't{i}', 'assigned_to': team} for i in range(5)]})
+    alice.delete(f'/teams/delete/{team}')
+
+    with app.app_context():
+        assert purge_pending(db.engine, chunk_size=2) > 0
+        assert db.session.scalar(select(func.count()).select_from(Team).where(Team.public_id == team)) == 0
+        assert db.session.scalar(select(func.count()).select_from(TodoItem)) == 0
+    assert alice.get('/todos/stats').get_json()['own']['total'] == 0
+
+def test_purged_team_todos_invalidate_the_etags_of_their_owners(app, make_user):
+    alice, alice_id = make_user('alice')
+    bob, bob_id = make_user('bob')
+    team = alice.post('/teams/create', json={'name': 'doomed', 'members': [alice_id, bob_id]}).get_json()['public_id']
+    bob.post('/todos/create', json={'title': 'for the team', 'assigned_to': team})
+    alice.delete(f'/teams/delete/{team}')
+    etag = bob.get('/todos/').headers['ETag']
+    assert bob.get('/todos/', headers={'If-None-Match': etag}).status_code == 304
+
+    with app.app_context():
+        purge_pending(db.engine, chunk_size=2)
+    response = bob.get('/todos/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json() == []
+
+def test_purged_account_todos_invalidate_the_etags_of_their_teams(app, make_user):
+    bob, bob_id = make_user('bob')
+    carol, carol_id = make_user('carol')
+    team = bob.post('/teams/create', json={'name': 'kept', 'members': [bob_id, carol_id]}).get_json()['public_id']
+    carol.post('/todos/create', json={'title': 'from carol', 'assigned_to': team})
+    carol.delete(f'/users/delete/{carol_id}')
+    etag = bob.get(f'/todos/team/{team}').headers['ETag']
+    assert bob.get(f'/todos/team/{team}', headers={'If-None-Match': etag}).status_code == 304
+
+    with app.app_context():
+        purge_pending(db.engine, chunk_size=2)
+    response = bob.get(f'/todos/team/{team}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json() == []
+
+def test_team_listings_are_paginated_by_key(make_user):
+    alice, alice_id = make_user('alice')
+    for index in range(5):
+        alice.post('/teams/create', json={'name': f'team {index}'})
+    first = alice.get('/teams/?limit=2').get_json()
+    second = alice.get(f"/teams/?limit=2&after={first['next_cursor']}").get_json()
+    third = alice.get(f"/teams/?limit=2&after={second['next_cursor']}").get_json()
+    names = [team['name'] for page in (first, second, third) for team in page['items']]
+    assert names == [f'team {index}' for index in range(5)]
+    assert third['next_cursor'] is None
+    streamed = alice.get(f'/users/{alice_id}/teams?stream=1')
+    assert [team['name'] for team in streamed.get_json()] == names
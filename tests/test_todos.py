@@ -1 +1,385 @@
-# Tests for todos
\ No newline at end of file
+# Tests for todos
+
+import datetime
+import gzip
+import logging
+from random import Random
+import pytest
+from sqlalchemy import text
+from app.extensions import db
+from app.util.counters import rebuild_todo_counters
+from app.util.purge import purge_pending
+from app.util.query_budget import LIST_QUERY_BUDGET, QueryBudgetExceeded, query_budget
+
+# List endpoints with the statement budget of their view, {user} and {team} are filled in per user
+LIST_ENDPOINTS = [
+    ('/todos/', LIST_QUERY_BUDGET + 2),
+    ('/todos/?limit=10', LIST_QUERY_BUDGET + 2),
+    ('/todos/?stream=1', LIST_QUERY_BUDGET + 2),
+    ('/todos/team/{team}', LIST_QUERY_BUDGET),
+    ('/todos/search?q=title', LIST_QUERY_BUDGET),
+    ('/todos/stats', 2),
+    ('/todos/changes?since=0', 4),
+    ('/teams/', LIST_QUERY_BUDGET),
+    ('/users/{user}/teams', LIST_QUERY_BUDGET),
+    ('/users/lookup?prefix=member', 1)
+]
+
+# Give a user a number of teams and todos, half of the todos assigned to the first team
+def _seed(client, name: str, rows: int) -> str:
+    teams = []
+    for index in range(1 + rows // 20):
+        response = client.post('/teams/create', json={'name': f'{name}-team-{index}'})
+        assert response.status_code == 201
+        teams.append(response.get_json()['public_id'])
+    operations = [
+        {'op': 'create', 'title': f'title {index}', 'due_date': '2030-01-01T10:00:00', 'assigned_to': teams[0] if index % 2 else None}
+        for index in range(rows)
+    ]
+    assert client.post('/todos/bulk', json={'operations': operations}).status_code == 200
+    return teams[0]
+
+# Statements issued by one request, after a first one warmed the caches
+def _statements(client, path: str, budget: int) -> int:
+    assert client.get(path).status_code == 200
+    with query_budget(budget, strict=False) as block:
+        response = client.get(path)
+        response.get_data()
+    assert response.status_code == 200
+    return block.count
+
+@pytest.mark.parametrize('path, budget', LIST_ENDPOINTS)
+def test_list_statements_do_not_grow_with_rows(make_user, path, budget):
+    counts = []
+    for rows in (5, 200):
+        client, user = make_user(f'member{rows}')
+        team = _seed(client, f'member{rows}', rows)
+        counts.append(_statements(client, path.format(user=user, team=team), budget))
+    assert counts[0] == counts[1]
+    assert counts[1] <= budget
+
+def test_exceeded_budget_raises_only_when_strict(app, caplog):
+    with app.app_context():
+        with pytest.raises(QueryBudgetExceeded):
+            with query_budget(0, name='strict'):
+                db.session.execute(text('SELECT 1'))
+        app.config['QUERY_BUDGET_STRICT'] = False
+        with caplog.at_level(logging.WARNING, logger='app.query_budget'):
+            with query_budget(0, name='lenient'):
+                db.session.execute(text('SELECT 1'))
+    assert 'lenient issued 1 SQL statements' in caplog.text
+
+# Follow next_cursor through every page of a listing, returning the pages
+def _pages(client, path: str) -> list:
+    pages = []
+    cursor = None
+    while True:
+        response = client.get(path + (f'&after={cursor}' if cursor else ''))
+        assert response.status_code == 200
+        page = response.get_json()
+        pages.append([todo['title'] for todo in page['items']])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return pages
+
+def test_keyset_pages_cover_every_todo_once(make_user):
+    client, _ = make_user('alice')
+    titles = [f'todo {index:02}' for index in range(25)]
+    client.post('/todos/bulk', json={'operations': [{'op': 'create', 'title': title} for title in titles]})
+    assert _pages(client, '/todos/?limit=10') == [titles[:10], titles[10:20], titles[20:]]
+    assert _pages(client, '/todos/?limit=10&stream=1') == [titles[:10], titles[10:20], titles[20:]]
+    assert _pages(client, '/todos/?limit=25') == [titles]
+
+def test_keyset_pages_follow_the_sort_order(make_user):
+    client, _ = make_user('alice')
+    # Repeated titles make the id break the ties
+    client.post('/todos/bulk', json={'operations': [{'op': 'create', 'title': f'title {index % 3}'} for index in range(10)]})
+    listed = [todo['title'] for todo in client.get('/todos/?sort=-title').get_json()]
+    assert listed == sorted(listed, reverse=True)
+    pages = _pages(client, '/todos/?sort=-title&limit=4')
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert sum(pages, []) == listed
+
+def test_writes_between_pages_neither_skip_nor_repeat_rows(make_user):
+    client, _ = make_user('alice')
+    response = client.post('/todos/bulk', json={'operations': [{'op': 'create', 'title': f't{index}'} for index in range(6)]})
+    ids = [result['public_id'] for result in response.get_json()['results']]
+    first = client.get('/todos/?limit=3').get_json()
+    client.delete(f'/todos/delete/{ids[0]}')
+    client.post('/todos/create', json={'title': 'late'})
+    second = client.get(f"/todos/?limit=3&after={first['next_cursor']}").get_json()
+    third = client.get(f"/todos/?limit=3&after={second['next_cursor']}").get_json()
+    assert [todo['title'] for todo in first['items'] + second['items'] + third['items']] == ['t0', 't1', 't2', 't3', 't4', 't5', 'late']
+    assert third['next_cursor'] is None
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=many', 'limit=2&after=not-a-cursor', 'sort=-title&limit=2&after=MQ=='])
+def test_malformed_page_requests_are_rejected(make_user, query):
+    client, _ = make_user('alice')
+    assert client.get(f'/todos/?{query}').status_code == 400
+
+def test_bulk_applies_every_operation_in_one_batch(make_user):
+    client, _ = make_user('alice')
+    response = client.post('/todos/bulk', json={'operations': [{'op': 'create', 'title': f't{i}'} for i in range(3)]})
+    first, second, third = [result['public_id'] for result in response.get_json()['results']]
+    response = client.post('/todos/bulk', json={'operations': [
+        {'op': 'update', 'public_id': first, 'title': 'renamed'},
+        {'op': 'complete', 'public_id': second},
+        {'op': 'delete', 'public_id': third}
+    ]})
+    assert response.status_code == 200
+    assert [result['status'] for result in response.get_json()['results']] == [200, 200, 200]
+    todos = {todo['public_id']: todo for todo in client.get('/todos/').get_json()}
+    assert set(todos) == {first, second}
+    assert todos[first]['title'] == 'renamed'
+    assert todos[second]['completed'] is True
+
+def test_bulk_with_an_invalid_operation_applies_nothing(make_user):
+    client, _ = make_user('alice')
+    response = client.post('/todos/bulk', json={'operations': [
+        {'op': 'create', 'title': 'kept out'},
+        {'op': 'delete', 'public_id': 'missing'}
+    ]})
+    assert response.status_code == 400
+    assert response.get_json()['results'][1]['error'] == 'Todo not found'
+    assert client.get('/todos/').get_json() == []
+
+def test_etag_answers_304_until_a_write(make_user):
+    client, _ = make_user('alice')
+    client.post('/todos/create', json={'title': 'one'})
+    etag = client.get('/todos/').headers['ETag']
+    assert client.get('/todos/', headers={'If-None-Match': etag}).status_code == 304
+    client.post('/todos/create', json={'title': 'two'})
+    response = client.get('/todos/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 2
+
+def test_etag_differs_by_path_and_user(make_user):
+    alice, _ = make_user('alice')
+    bob, _ = make_user('bob')
+    first = alice.post('/todos/create', json={'title': 'one'}).get_json()['public_id']
+    second = alice.post('/todos/create', json={'title': 'two'}).get_json()['public_id']
+    etag = alice.get(f'/todos/{first}').headers['ETag']
+    assert alice.get(f'/todos/{second}').headers['ETag'] != etag
+    assert alice.get(f'/todos/{second}', headers={'If-None-Match': etag}).status_code == 200
+    listing = alice.get('/todos/').headers['ETag']
+    assert bob.get('/todos/', headers={'If-None-Match': listing}).status_code == 200
+
+def test_overdue_listing_has_no_etag(make_user):
+    client, _ = make_user('alice')
+    client.post('/todos/create', json={'title': 'late', 'due_date': '2000-01-01T00:00:00'})
+    response = client.get('/todos/?overdue=1')
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    assert [todo['title'] for todo in response.get_json()] == ['late']
+
+def test_edits_parse_the_due_date(make_user):
+    client, _ = make_user('alice')
+    todo = client.post('/todos/create', json={'title': 'dated'}).get_json()['public_id']
+    assert client.put(f'/todos/edit/{todo}', json={'due_date': 'soon'}).status_code == 400
+    assert client.put(f'/todos/edit/{todo}', json={'due_date': '2000-01-01T10:00:00'}).status_code == 200
+    assert client.get(f'/todos/{todo}').get_json()['due_date'] == 'Sat, 01 Jan 2000 10:00:00 GMT'
+    assert client.get('/todos/stats').get_json()['own']['overdue'] == 1
+
+# Titles of the todos GET /todos/ lists for a query string
+def _listed(client, query: str = '') -> list:
+    response = client.get(f'/todos/?{query}')
+    assert response.status_code == 200, response.get_json()
+    return [todo['title'] for todo in response.get_json()]
+
+# Todos of every kind the filters tell apart
+def _seed_filters(make_user):
+    alice, alice_id = make_user('alice')
+    bob, bob_id = make_user('bob')
+    team = alice.post('/teams/create', json={'name': 'shared', 'members': [alice_id, bob_id]}).get_json()['public_id']
+    alice.post('/todos/bulk', json={'operations': [
+        {'op': 'create', 'title': 'old high', 'priority': 'high', 'due_date': '2000-01-01T00:00:00'},
+        {'op': 'create', 'title': 'done low', 'priority': 'low', 'completed': True, 'due_date': '2000-01-02T00:00:00'},
+        {'op': 'create', 'title': 'future normal', 'due_date': '2100-01-01T00:00:00', 'visibility': 'private'},
+        {'op': 'create', 'title': 'undated'}
+    ]})
+    bob.post('/todos/create', json={'title': 'team todo', 'priority': 'high', 'assigned_to': team})
+    return alice, team
+
+def test_listing_filters_by_each_parameter(make_user):
+    alice, team = _seed_filters(make_user)
+    assert _listed(alice) == ['old high', 'done low', 'future normal', 'undated', 'team todo']
+    assert _listed(alice, 'completed=true') == ['done low']
+    assert _listed(alice, 'priority=high,low') == ['old high', 'done low', 'team todo']
+    assert _listed(alice, 'visibility=private') == ['future normal']
+    assert _listed(alice, 'due_after=2000-01-02&due_before=2100-01-01') == ['done low']
+    assert _listed(alice, 'overdue=true') == ['old high']
+    assert _listed(alice, 'scope=own') == ['old high', 'done low', 'future normal', 'undated']
+    assert _listed(alice, 'scope=teams') == ['team todo']
+    assert _listed(alice, f'assigned_to={team}') == ['team todo']
+    assert _listed(alice, 'assigned_to=none&priority=high') == ['old high']
+    assert _listed(alice, 'assigned_to=unknown') == []
+
+def test_listing_sorts_with_undated_todos_last(make_user):
+    alice, _ = _seed_filters(make_user)
+    assert _listed(alice, 'sort=due_date') == ['old high', 'done low', 'future normal', 'undated', 'team todo']
+    assert _listed(alice, 'sort=-due_date') == ['future normal', 'done low', 'old high', 'team todo', 'undated']
+    assert _listed(alice, 'sort=priority')[:2] == ['old high', 'team todo']
+    assert _listed(alice, 'sort=-id')[0] == 'team todo'
+
+def test_settings_provide_the_listing_defaults(make_user):
+    alice, _ = _seed_filters(make_user)
+    alice.put('/settings/edit', json={'hide_completed_todos': True, 'separate_teams_todos': True})
+    assert _listed(alice) == ['old high', 'future normal', 'undated']
+    assert _listed(alice, 'completed=all&scope=all') == ['old high', 'done low', 'future normal', 'undated', 'team todo']
+
+@pytest.mark.parametrize('query', ['completed=maybe', 'priority=urgent', 'scope=everyone', 'due_after=tomorrow', 'sort=colour'])
+def test_malformed_filters_are_rejected(make_user, query):
+    client, _ = make_user('alice')
+    response = client.get(f'/todos/?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+# Titles of the todos a search returns, best match first
+def _search(client, q: str, **params) -> list:
+    response = client.get('/todos/search', query_string={'q': q, **params})
+    assert response.status_code == 200, response.get_json()
+    return [todo['title'] for todo in response.get_json()['items']]
+
+def test_search_ranks_title_matches_above_summary_matches(make_user):
+    client, _ = make_user('alice')
+    client.post('/todos/create', json={'title': 'call the bank', 'summary': 'about the garden loan'})
+    client.post('/todos/create', json={'title': 'garden work', 'summary': 'weeding'})
+    client.post('/todos/create', json={'title': 'unrelated'})
+    assert _search(client, 'garden') == ['garden work', 'call the bank']
+    assert _search(client, 'gar*') == ['garden work', 'call the bank']
+    assert _search(client, '"garden loan"') == ['call the bank']
+    assert _search(client, '"loan garden"') == []
+    assert _search(client, 'Gärden') == ['garden work', 'call the bank']
+
+def test_search_treats_fts_operators_as_words(make_user):
+    client, _ = make_user('alice')
+    client.post('/todos/create', json={'title': 'this OR that'})
+    assert _search(client, 'OR') == ['this OR that']
+    assert _search(client, 'title: NEAR(') == []
+    assert client.get('/todos/search?q=%20*%20').status_code == 400
+
+def test_search_follows_edits_deletes_and_visibility(make_user):
+    alice, alice_id = make_user('alice')
+    bob, bob_id = make_user('bob')
+    team = alice.post('/teams/create', json={'name': 'shared', 'members': [alice_id, bob_id]}).get_json()['public_id']
+    todo = alice.post('/todos/create', json={'title': 'draft report'}).get_json()['public_id']
+    alice.post('/todos/create', json={'title': 'team report', 'assigned_to': team})
+    bob.post('/todos/create', json={'title': 'private report'})
+
+    assert sorted(_search(alice, 'report')) == ['draft report', 'team report']
+    assert sorted(_search(bob, 'report')) == ['private report', 'team report']
+    alice.put(f'/todos/edit/{todo}', json={'title': 'final summary'})
+    assert _search(alice, 'draft') == []
+    assert _search(alice, 'final') == ['final summary']
+    alice.delete(f'/todos/delete/{todo}')
+    assert _search(alice, 'final') == []
+
+def test_search_results_are_paged(make_user):
+    client, _ = make_user('alice')
+    client.post('/todos/bulk', json={'operations': [{'op': 'create', 'title': f'chore {index}'} for index in range(5)]})
+    first = client.get('/todos/search?q=chore&limit=3').get_json()
+    second = client.get(f"/todos/search?q=chore&limit=3&after={first['next_cursor']}").get_json()
+    titles = [todo['title'] for todo in first['items'] + second['items']]
+    assert sorted(titles) == [f'chore {index}' for index in range(5)]
+    assert second['next_cursor'] is None
+
+# Every counter row, as maintained by the triggers and as a recount gives them
+def _counters_and_recount(app) -> tuple:
+    with app.app_context():
+        with db.engine.connect() as connection:
+            read = lambda: sorted(connection.execute(text('SELECT scope, ref_id, bucket, count FROM todo_counters')).all())
+            maintained = read()
+            rebuild_todo_counters(connection)
+            recounted = read()
+            connection.rollback()
+    return maintained, recounted
+
+def test_counters_match_a_recount_after_every_kind_of_write(app, make_user):
+    alice, alice_id = make_user('alice')
+    bob, bob_id = make_user('bob')
+    teams = [alice.post('/teams/create', json={'name': f'team {index}', 'members': [alice_id, bob_id]}).get_json()['public_id'] for index in range(2)]
+    random = Random(17)
+    todos = []
+    for step in range(120):
+        client = random.choice([alice, bob])
+        values = {
+            'priority': random.choice(['high', 'normal', 'low']),
+            'completed': random.random() < 0.3,
+            'due_date': random.choice([None, '2000-01-01T08:00:00', '2030-05-06T09:00:00', '2030-05-07T23:59:00']),
+            'assigned_to': random.choice([None, *teams])
+        }
+        action = random.random()
+        if action < 0.4 or not todos:
+            response = client.post('/todos/create', json={'title': f'todo {step}', **values})
+            todos.append((client, response.get_json()['public_id']))
+        elif action < 0.7:
+            owner, public_id = random.choice(todos)
+            field = random.choice(list(values))
+            assert owner.put(f'/todos/edit/{public_id}', json={field: values[field]}).status_code == 200
+        elif action < 0.85:
+            owner, public_id = todos.pop(random.randrange(len(todos)))
+            assert owner.delete(f'/todos/delete/{public_id}').status_code == 200
+        else:
+            owned = [public_id for owner, public_id in todos if owner is client][:3]
+            operations = [{'op': 'complete', 'public_id': public_id} for public_id in owned[:2]]
+            operations.append({'op': 'create', 'title': f'bulk {step}', **values})
+            response = client.post('/todos/bulk', json={'operations': operations})
+            assert response.status_code == 200
+            todos.append((client, response.get_json()['results'][-1]['public_id']))
+    alice.delete(f'/teams/delete/{teams[1]}')
+    with app.app_context():
+        purge_pending(db.engine, chunk_size=7)
+
+    maintained, recounted = _counters_and_recount(app)
+    assert maintained == recounted
+    own = alice.get('/todos/stats').get_json()['own']
+    assert own['total'] == own['open'] + own['completed'] == len(alice.get('/todos/?scope=own&completed=all').get_json())
+    assert sum(own['open_by_priority'].values()) == own['open']
+
+def test_stats_count_overdue_and_due_today(make_user):
+    client, _ = make_user('alice')
+    today = datetime.datetime.utcnow().replace(hour=23, minute=59, second=0, microsecond=0)
+    client.post('/todos/bulk', json={'operations': [
+        {'op': 'create', 'title': 'overdue', 'due_date': '2000-01-01T00:00:00', 'priority': 'high'},
+        {'op': 'create', 'title': 'today', 'due_date': today.isoformat()},
+        {'op': 'create', 'title': 'done', 'due_date': '2000-01-01T00:00:00', 'completed': True},
+        {'op': 'create', 'title': 'undated', 'priority': 'low'}
+    ]})
+    own = client.get('/todos/stats').get_json()['own']
+    assert (own['total'], own['open'], own['completed'], own['overdue'], own['due_today']) == (4, 3, 1, 1, 1)
+    assert own['open_by_priority'] == {'high': 1, 'normal': 1, 'low': 1}
+
+def test_changes_return_upserts_and_deletes_since_the_cursor(make_user):
+    client, _ = make_user('alice')
+    kept = client.post('/todos/create', json={'title': 'kept'}).get_json()['public_id']
+    removed = client.post('/todos/create', json={'title': 'removed'}).get_json()['public_id']
+    full = client.get('/todos/changes?since=0').get_json()
+    assert {todo['public_id'] for todo in full['upserts']} == {kept, removed}
+    assert full['deletes'] == []
+
+    client.put(f'/todos/edit/{kept}', json={'title': 'edited'})
+    client.delete(f'/todos/delete/{removed}')
+    delta = client.get(f"/todos/changes?since={full['cursor']}").get_json()
+    assert [todo['title'] for todo in delta['upserts']] == ['edited']
+    assert delta['deletes'] == [removed]
+    assert delta['cursor'] > full['cursor']
+    assert client.get(f"/todos/changes?since={delta['cursor']}").get_json()['upserts'] == []
+
+def test_changes_reject_a_malformed_cursor(make_user):
+    client, _ = make_user('alice')
+    assert client.get('/todos/changes?since=abc').status_code == 400
+
+def test_listings_are_gzipped_per_url(make_user):
+    client, _ = make_user('alice')
+    client.post('/todos/bulk', json={'operations': [{'op': 'create', 'title': f'todo number {i}'} for i in range(50)]})
+    for path in ('/todos/', '/todos/?limit=40', '/todos/'):
+        plain = client.get(path)
+        encoded = client.get(path, headers={'Accept-Encoding': 'gzip'})
+        assert encoded.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in encoded.headers['Vary']
+        assert gzip.decompress(encoded.get_data()) == plain.get_data()
+
+def test_small_responses_are_not_compressed(make_user):
+    client, _ = make_user('alice')
+    response = client.get('/todos/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
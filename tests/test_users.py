@@ -1 +1,106 @@
-# Tests for users
\ No newline at end of file
+# Tests for users
+
+import json
+from sqlalchemy import func, select, text
+from app.extensions import db
+from app.models import PurgeJob, Settings, TeamMember, TodoItem, User
+from app.util import purge
+from tests.conftest import PASSWORD
+
+# Run the queued purge jobs like the purger thread does
+def _purge(app) -> int:
+    with app.app_context():
+        return purge.purge_pending(db.engine, chunk_size=2)
+
+# Rows left of a user, by table
+def _rows_of(app, public_id: str) -> dict:
+    with app.app_context():
+        user_id = db.session.scalar(select(User.id).where(User.public_id == public_id))
+        return {
+            'users': 0 if user_id is None else 1,
+            'todo_items': db.session.scalar(select(func.count()).select_from(TodoItem).where(TodoItem.user_id == user_id)),
+            'settings': db.session.scalar(select(func.count()).select_from(Settings).where(Settings.user_id == user_id)),
+            'team_members': db.session.scalar(select(func.count()).select_from(TeamMember).where(TeamMember.user_id == user_id))
+        }
+
+def test_deleted_account_is_purged(app, make_user):
+    client, carol = make_user('carol')
+    bob, bob_id = make_user('bob')
+    team = bob.post('/teams/create', json={'name': 'bobs'}).get_json()['public_id']
+    bob.post('/teams/invite/bobs', json={'profile_name': 'carol'})
+    client.post('/todos/bulk', json={'operations': [{'op': 'create', 'title': f't{i}'} for i in range(5)]})
+
+    assert client.delete(f'/users/delete/{carol}').status_code == 200
+    assert bob.get(f'/teams/{team}').get_json()['members'] == [bob_id]
+    assert app.test_client().post('/auth/login', json={'email': 'carol@example.com', 'password': PASSWORD}).status_code == 401
+
+    assert _purge(app) > 0
+    assert _rows_of(app, carol) == {'users': 0, 'todo_items': 0, 'settings': 0, 'team_members': 0}
+    with app.app_context():
+        assert db.session.scalar(select(PurgeJob.finished_on).where(PurgeJob.public_id == carol)) is not None
+
+def test_sessions_of_a_deleted_account_are_turned_away(app, make_user):
+    client, carol = make_user('carol')
+    other_session = app.test_client()
+    other_session.post('/auth/login', json={'email': 'carol@example.com', 'password': PASSWORD})
+    client.delete(f'/users/delete/{carol}')
+
+    assert other_session.get('/todos/').status_code == 401
+    assert other_session.post('/todos/create', json={'title': 'late'}).status_code == 401
+    _purge(app)
+    assert other_session.post('/todos/create', json={'title': 'later'}).status_code == 401
+
+def test_purge_starts_over_when_rows_arrive_during_the_job(app, make_user, monkeypatch):
+    client, carol = make_user('carol')
+    client.post('/todos/create', json={'title': 'early'})
+    client.delete(f'/users/delete/{carol}')
+
+    # A todo written by a request that checked the account just before it was marked
+    delete_chunk = purge._delete_chunk
+    added = []
+    def delete_chunk_adding_a_todo(connection, table, criterion, chunk_size):
+        if table.name == 'settings' and not added:
+            connection.execute(text(
+                "INSERT INTO todo_items (public_id, user_id, title, created_by, change_seq) "
+                "SELECT 'late', id, 'late', public_id, 0 FROM users WHERE public_id = :public_id"
+            ), {'public_id': carol})
+            added.append(True)
+        return delete_chunk(connection, table, criterion, chunk_size)
+    monkeypatch.setattr(purge, '_delete_chunk', delete_chunk_adding_a_todo)
+
+    _purge(app)
+    assert added
+    assert _rows_of(app, carol) == {'users': 0, 'todo_items': 0, 'settings': 0, 'team_members': 0}
+
+def test_export_writes_iso_dates_and_imports_back(app, make_user):
+    client, alice = make_user('alice')
+    client.post('/teams/create', json={'name': 'alices'})
+    client.post('/todos/create', json={'title': 'dated', 'due_date': '2030-01-02T10:00:00'})
+    response = client.get(f'/users/{alice}/export')
+    assert response.mimetype == 'application/x-ndjson'
+    records = [json.loads(line) for line in response.get_data().splitlines()]
+    assert [record['type'] for record in records] == ['export', 'user', 'settings', 'team', 'todo']
+    assert records[-1]['data']['due_date'] == '2030-01-02T10:00:00'
+    assert 'GMT' not in response.get_data(as_text=True)
+
+    bob, bob_id = make_user('bob')
+    todo = json.dumps({'type': 'todo', 'data': dict(records[-1]['data'], public_id=None, assigned_to=None)})
+    report = bob.post(f'/users/{bob_id}/import', data=todo + '\nnot json\n', content_type='application/x-ndjson').get_json()
+    assert report['imported']['todos'] == 1
+    assert report['errors'] == [{'error': 'Invalid JSON', 'line': 2}]
+    assert bob.get('/todos/').get_json()[0]['due_date'] == 'Wed, 02 Jan 2030 10:00:00 GMT'
+
+def test_lookup_matches_name_prefixes_case_insensitively(make_user):
+    client, _ = make_user('alice')
+    make_user('Albert')
+    make_user('bob')
+    response = client.get('/users/lookup?prefix=AL')
+    assert response.status_code == 200
+    assert sorted(user['profile_name'] for user in response.get_json()) == ['Albert', 'alice']
+
+def test_edit_rejects_an_invalid_profile_name(make_user):
+    client, alice = make_user('alice')
+    assert client.put(f'/users/edit/{alice}', json={'profile_name': 123}).get_json() == {'error': 'Invalid name'}
+    assert client.put(f'/users/edit/{alice}', json={'profile_name': 'x'}).status_code == 400
+    assert client.put(f'/users/edit/{alice}', json={'profile_name': 'Alicia'}).status_code == 200
+    assert [user['profile_name'] for user in client.get('/users/lookup?prefix=ALI').get_json()] == ['Alicia']
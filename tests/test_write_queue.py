@@ -0,0 +1,74 @@
+# Tests for group commit
+
+import threading
+import uuid
+from flask import jsonify, make_response
+from sqlalchemy import select
+from app.extensions import db
+from app.models import TodoItem, User
+from app.util.write_queue import WriteQueue, _Unit, after_commit, commit_write
+from tests.conftest import PASSWORD
+
+# A unit of work adding a todo, then ending the way the test asks
+def _adding_unit(user_id: int, title: str, ending, committed: list):
+    def unit():
+        db.session.add(TodoItem(public_id=str(uuid.uuid4()), user_id=user_id, title=title, created_by='test'))
+        commit_write()
+        after_commit(lambda: committed.append(title))
+        return ending()
+    return unit
+
+def _fail():
+    raise ValueError('unit failed')
+
+def test_failing_units_only_undo_their_own_writes(app, make_user):
+    _, alice = make_user('alice')
+    with app.app_context():
+        user_id = db.session.scalar(select(User.id).where(User.public_id == alice))
+    write_queue = WriteQueue(app, window=0, max_batch=10)
+    committed = []
+    with app.test_request_context('/todos/create', method='POST'):
+        units = [
+            _Unit(_adding_unit(user_id, 'kept', lambda: make_response(jsonify({'ok': True})), committed), (), {}),
+            _Unit(_adding_unit(user_id, 'raised', _fail, committed), (), {}),
+            _Unit(_adding_unit(user_id, 'rejected', lambda: make_response(jsonify({'error': 'no'}), 400), committed), (), {}),
+            _Unit(_adding_unit(user_id, 'also kept', lambda: make_response(jsonify({'ok': True})), committed), (), {})
+        ]
+    with app.app_context():
+        write_queue._run_batch(units)
+        titles = db.session.scalars(select(TodoItem.title).where(TodoItem.user_id == user_id).order_by(TodoItem.id)).all()
+
+    assert titles == ['kept', 'also kept']
+    assert committed == ['kept', 'also kept']
+    assert [unit.future.result().status_code for unit in (units[0], units[2], units[3])] == [200, 400, 200]
+    assert isinstance(units[1].future.exception(), ValueError)
+
+def test_concurrent_writes_share_a_commit(app_factory, monkeypatch):
+    app = app_factory(WRITE_QUEUE_ENABLED=True, WRITE_QUEUE_WINDOW_MS=200)
+    app.test_client().post('/users/create', json={'profile_name': 'alice', 'email': 'alice@example.com', 'password': PASSWORD})
+    clients = [app.test_client() for _ in range(8)]
+    for client in clients:
+        client.post('/auth/login', json={'email': 'alice@example.com', 'password': PASSWORD})
+
+    batches = []
+    run_batch = WriteQueue._run_batch
+    def recording_run_batch(self, batch):
+        batches.append(len(batch))
+        return run_batch(self, batch)
+    monkeypatch.setattr(WriteQueue, '_run_batch', recording_run_batch)
+
+    barrier = threading.Barrier(len(clients))
+    statuses = []
+    def create(client, index):
+        barrier.wait()
+        statuses.append(client.post('/todos/create', json={'title': f'todo {index}'}).status_code)
+    threads = [threading.Thread(target=create, args=(client, index)) for index, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses == [201] * len(clients)
+    assert sum(batches) == len(clients)
+    assert max(batches) > 1
+    assert sorted(todo['title'] for todo in clients[0].get('/todos/').get_json()) == [f'todo {index}' for index in range(8)]
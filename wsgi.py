@@ -1 +1,6 @@
-# Set up for running the app with gunicorn or other WSGI servers
\ No newline at end of file
+# Set up for running the app with gunicorn or other WSGI servers, e.g. gunicorn wsgi:app
+# gunicorn.conf.py preloads the app, so workers fork from a booted master
+
+from app import create_app
+
+app = create_app()